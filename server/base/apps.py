@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class BaseConfig(AppConfig):
+    name = "server.base"
+
+    def ready(self):
+        # record metrics on the background tasks this process runs
+        from .. import task_metrics  # noqa: F401
+        from ..task_queues import route_spinachd_tasks
+
+        route_spinachd_tasks(settings.NOTEBOOKS_TASK_QUEUE)
@@ -0,0 +1,33 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from ....metrics import start_metrics_server
+
+
+class Command(BaseCommand):
+    help = "Run a pool of Spinach workers consuming one of the task queues"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "queue", choices=sorted(settings.TASK_QUEUE_WORKER_THREADS), help="Queue to consume"
+        )
+        parser.add_argument(
+            "--threads",
+            type=int,
+            help="Number of worker threads, overriding TASK_QUEUE_WORKER_THREADS",
+        )
+        parser.add_argument(
+            "--metrics-port",
+            dest="metrics_port",
+            type=int,
+            default=settings.WORKER_METRICS_PORT,
+            help="Port to serve the metrics of the workers on, if METRICS_ENABLED",
+        )
+
+    def handle(self, *args, **options):
+        queue = options["queue"]
+        threads = options["threads"] or settings.TASK_QUEUE_WORKER_THREADS[queue]
+        if settings.METRICS_ENABLED and options["metrics_port"]:
+            start_metrics_server(options["metrics_port"])
+        call_command("spinach", queue=queue, threads=threads)
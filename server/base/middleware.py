@@ -0,0 +1,114 @@
+import tempfile
+import zlib
+
+from django.conf import settings
+from django.core.handlers.wsgi import LimitedStream
+from django.http import HttpResponse
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+DECOMPRESSION_CHUNK_SIZE = 64 * 1024
+# decompressed bodies are only kept in memory up to this size
+SPOOL_MAX_MEMORY_SIZE = 1024 * 1024
+
+
+class DecompressionError(ValueError):
+    pass
+
+
+def _decompress_zlib(stream, wbits, chunk_size):
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        for data in iter(lambda: stream.read(chunk_size), b""):
+            # never inflate more than a chunk at a time, however small the
+            # compressed data
+            while data and not decompressor.eof:
+                yield decompressor.decompress(data, chunk_size)
+                data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+    except zlib.error as e:
+        raise DecompressionError(str(e))
+    if not decompressor.eof:
+        raise DecompressionError("Truncated body")
+
+
+def _decompress_zstd(stream, chunk_size):
+    reader = zstandard.ZstdDecompressor().stream_reader(stream)
+    try:
+        yield from iter(lambda: reader.read(chunk_size), b"")
+    except zstandard.ZstdError as e:
+        raise DecompressionError(str(e))
+
+
+def get_decompressors():
+    """
+    Returns a dictionary of the content encodings which request bodies can
+    use to functions yielding their decompressed content in chunks
+    """
+    decompressors = {
+        "gzip": lambda stream, chunk_size: _decompress_zlib(
+            stream, 16 + zlib.MAX_WBITS, chunk_size
+        ),
+        "deflate": lambda stream, chunk_size: _decompress_zlib(stream, zlib.MAX_WBITS, chunk_size),
+    }
+    if zstandard is not None:
+        decompressors["zstd"] = _decompress_zstd
+    return decompressors
+
+
+class RequestDecompressionMiddleware(object):
+    """
+    Decompresses the bodies of API requests sent with a `Content-Encoding`
+    (gzip, deflate or, if the zstandard package is installed, zstd), so that
+    large revisions and files can be uploaded compressed
+
+    Bodies are decompressed a chunk at a time into a temporary file (only kept
+    in memory while small), and refused as soon as they get larger than
+    `REQUEST_BODY_MAX_DECOMPRESSED_SIZE`, so that a small upload can't
+    expand into an unbounded amount of data.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.decompressors = get_decompressors()
+
+    def __call__(self, request):
+        encoding = request.META.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if not encoding or encoding == "identity" or not request.path.startswith("/api/"):
+            return self.get_response(request)
+
+        decompress = self.decompressors.get(encoding)
+        if decompress is None:
+            response = HttpResponse(f"Unsupported content encoding: {encoding}", status=415)
+            response["Accept-Encoding"] = ", ".join(self.decompressors)
+            return response
+
+        max_size = settings.REQUEST_BODY_MAX_DECOMPRESSED_SIZE
+        body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY_SIZE)
+        size = 0
+        try:
+            for chunk in decompress(request._stream, DECOMPRESSION_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    body.close()
+                    return HttpResponse(
+                        f"Decompressed body larger than {max_size} bytes", status=413
+                    )
+                body.write(chunk)
+        except DecompressionError as e:
+            body.close()
+            return HttpResponse(f"Invalid {encoding} body: {e}", status=400)
+        body.seek(0)
+
+        # the rest of the request handling sees the decompressed body instead,
+        # as if it had been sent as is
+        request._stream = LimitedStream(body, size)
+        request.META["CONTENT_LENGTH"] = str(size)
+        del request.META["HTTP_CONTENT_ENCODING"]
+        try:
+            return self.get_response(request)
+        finally:
+            body.close()
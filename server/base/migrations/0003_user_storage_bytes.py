@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-19 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('base', '0002_user_can_create_on_behalf_of_others'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='storage_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -5,3 +5,5 @@ from django.db import models
 class User(AbstractUser):
     avatar = models.URLField(null=True)
     can_create_on_behalf_of_others = models.BooleanField(default=False)
+    # bytes used by all of the user's notebooks (see `Notebook.storage_bytes`)
+    storage_bytes = models.BigIntegerField(default=0)
@@ -0,0 +1 @@
+default_app_config = "server.files.apps.FilesConfig"
@@ -1,21 +1,27 @@
 import json
 
 from django.core.exceptions import PermissionDenied
+from django.db import transaction
 from django.http import Http404
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
 from rest_framework import viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
 
 from ..notebooks.models import Notebook
+from ..notebooks.storage import check_storage_quota
 from .models import File, FileSource, FileUpdateOperation
+from .progress import get_progress
 from .serializers import (
+    PREFETCH_LATEST_FILE_UPDATE_OPERATION,
     FileSourceDetailSerializer,
     FileSourceDetailWithoutURLSerializer,
     FileSourceSerializer,
     FilesSerializer,
     FileUpdateOperationSerializer,
 )
-from .tasks import execute_file_update_operation, tasks
+from .tasks import execute_file_update_operation, reclaim_stale_file_update_operations, tasks
 
 
 class FileViewSet(viewsets.ModelViewSet):
@@ -37,6 +43,7 @@ class FileViewSet(viewsets.ModelViewSet):
         notebook = get_object_or_404(Notebook, id=metadata["notebook_id"])
         if notebook.owner != self.request.user:
             raise PermissionDenied
+        check_storage_quota(notebook, file.size)
 
         file_obj = File.objects.create(
             notebook_id=notebook.id, filename=metadata["filename"], content=file.read()
@@ -55,6 +62,7 @@ class FileViewSet(viewsets.ModelViewSet):
         updated_filename = metadata["filename"].strip()
         file_obj_to_update.filename = updated_filename
         if file:
+            check_storage_quota(notebook, file.size - file_obj_to_update.content_size)
             file_obj_to_update.content = file.read()
         file_obj_to_update.save()
 
@@ -84,26 +92,32 @@ class NotebookFileSourceViewSet(viewsets.ModelViewSet):
 
     http_method_names = ["get"]
 
+    def get_notebook(self):
+        # looked up once per request, as both the serializer class and context
+        # depend on it
+        if not hasattr(self, "_notebook"):
+            notebook_id = int(self.kwargs["notebook_id"])
+            notebook = Notebook.objects.only("id", "owner_id").filter(id=notebook_id).first()
+            if notebook is None:
+                raise Http404("Notebook with id %s does not exist" % notebook_id)
+            self._notebook = notebook
+        return self._notebook
+
     def get_serializer_class(self):
         request = self.request
         if not request.user.is_authenticated:
             return FileSourceDetailWithoutURLSerializer
-        notebook_id = int(self.kwargs["notebook_id"])
-        notebook = get_object_or_404(Notebook, id=notebook_id)
-        owner_id = notebook.owner.id
-        requester_id = request.user.id
-        if not owner_id == requester_id:
+        if self.get_notebook().owner_id != request.user.id:
             return FileSourceDetailWithoutURLSerializer
         return FileSourceDetailSerializer
 
     def get_serializer_context(self):
-        notebook_id = int(self.kwargs["notebook_id"])
-        if not Notebook.objects.filter(id=notebook_id).exists():
-            raise Http404("Notebook with id %s does not exist" % notebook_id)
-        return {"notebook_id": notebook_id}
+        return {"notebook_id": self.get_notebook().id}
 
     def get_queryset(self):
-        base = FileSource.objects.filter(notebook_id=self.kwargs["notebook_id"])
+        base = FileSource.objects.filter(notebook_id=self.kwargs["notebook_id"]).prefetch_related(
+            PREFETCH_LATEST_FILE_UPDATE_OPERATION
+        )
         filter_by_id = self.request.query_params.getlist("id")
         if filter_by_id:
             return base.filter(id__in=filter_by_id)
@@ -131,7 +145,11 @@ class FileSourceViewSet(viewsets.ModelViewSet):
         if self.request.user != serializer.validated_data["notebook"].owner:
             raise PermissionDenied
 
-        serializer.save()
+        if serializer.validated_data["url"] != serializer.instance.url:
+            # validators from the old url mean nothing for the new one
+            serializer.save(etag=None, last_modified=None, content_hash=None)
+        else:
+            serializer.save()
 
 
 class FileUpdateOperationViewSet(viewsets.ModelViewSet):
@@ -142,11 +160,65 @@ class FileUpdateOperationViewSet(viewsets.ModelViewSet):
     http_method_names = ["get", "post"]
 
     def create(self, serializer):
-        file_source = get_object_or_404(FileSource, id=self.request.data["file_source_id"])
-        if self.request.user != file_source.notebook.owner:
-            raise PermissionDenied
-
-        update_operation = FileUpdateOperation.objects.create(file_source=file_source)
-        tasks.schedule(execute_file_update_operation, update_operation.id)
+        with transaction.atomic():
+            # lock the file source, so the scheduler can't queue an operation
+            # for it at the same time
+            file_source = get_object_or_404(
+                FileSource.objects.select_for_update(of=("self",)).select_related("notebook"),
+                id=self.request.data["file_source_id"],
+            )
+            if self.request.user != file_source.notebook.owner:
+                raise PermissionDenied
+
+            # operations stuck for too long don't count
+            run_now = bool(reclaim_stale_file_update_operations([file_source.id], timezone.now()))
+
+            # if the file source is already being updated, there's no need to
+            # do it again
+            update_operation, created = FileUpdateOperation.objects.get_or_create(
+                file_source=file_source, status__in=FileUpdateOperation.ACTIVE_STATUSES
+            )
+            if (
+                update_operation.status == FileUpdateOperation.PENDING
+                and update_operation.next_attempt_at is not None
+            ):
+                # a retry waiting for its turn: run it now instead, as asked
+                update_operation.next_attempt_at = None
+                update_operation.save(update_fields=["next_attempt_at"])
+                run_now = True
+        if created or run_now:
+            tasks.schedule(execute_file_update_operation, update_operation.id)
+
+        return Response(
+            FileUpdateOperationSerializer(update_operation).data, status=201 if created else 200
+        )
 
-        return Response(FileUpdateOperationSerializer(update_operation).data, status=201)
+    @action(detail=True)
+    def progress(self, request, pk):
+        """
+        Returns the live progress of an operation
+
+        Progress is read from the cache, so that clients can poll this (every
+        `FILE_UPDATE_PROGRESS_INTERVAL` seconds, as it is published no more
+        often) rather than the operation itself. It returns straight away:
+        waiting for progress here would hold on to a (synchronous) web worker
+        for as long as it did.
+        """
+        try:
+            # as progress is published under the operation's (integer) id
+            update_operation_id = int(pk)
+        except ValueError:
+            raise Http404("File update operation with id %s does not exist" % pk)
+        progress = get_progress(update_operation_id)
+        if progress is None:
+            # nothing was published recently, the operation has either not
+            # started yet or ended a while ago
+            update_operation = get_object_or_404(
+                FileUpdateOperation.objects.only("status"), pk=update_operation_id
+            )
+            progress = {
+                "status": update_operation.status,
+                "bytes_downloaded": None,
+                "expected_bytes": None,
+            }
+        return Response(progress)
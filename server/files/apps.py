@@ -2,4 +2,7 @@ from django.apps import AppConfig
 
 
 class FilesConfig(AppConfig):
-    name = "files"
+    name = "server.files"
+
+    def ready(self):
+        from . import signals  # noqa
@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from ..metrics import Counter, Gauge
+
+cache_hits = Counter("iodide_file_cache_hits_total", "File reads served from the cache")
+cache_misses = Counter("iodide_file_cache_misses_total", "File reads not served from the cache")
+cache_hit_ratio = Gauge("iodide_file_cache_hit_ratio", "Ratio of file reads served from the cache")
+cache_served_bytes = Counter(
+    "iodide_file_cache_served_bytes_total", "Bytes of file content served from the cache"
+)
+cache_size_bytes = Gauge("iodide_file_cache_size_bytes", "Bytes of file content in the cache")
+
+
+class FileContentCache:
+    """
+    A size-bounded, least-recently-used cache of file contents, local to the
+    current process
+
+    Entries are stored along with the hash of their content, and are only
+    returned if the hash matches the one requested, so a stale entry can
+    never be served (even if it was modified by another process)
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    @property
+    def max_bytes(self):
+        return settings.FILE_CONTENT_CACHE_MAX_BYTES
+
+    @property
+    def size(self):
+        return self._size
+
+    def _record_lookup(self, hit):
+        (cache_hits if hit else cache_misses).inc()
+        hits = cache_hits.get()
+        cache_hit_ratio.set(hits / (hits + cache_misses.get()))
+
+    def _remove(self, key):
+        _, content = self._entries.pop(key)
+        self._size -= len(content)
+
+    def get(self, notebook_id, filename, content_hash):
+        key = (notebook_id, filename)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != content_hash:
+                self._record_lookup(False)
+                return None
+            self._entries.move_to_end(key)
+            self._record_lookup(True)
+
+        content = entry[1]
+        cache_served_bytes.inc(len(content))
+        return content
+
+    def set(self, notebook_id, filename, content_hash, content):
+        if len(content) > self.max_bytes:
+            return
+        key = (notebook_id, filename)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (content_hash, content)
+            self._size += len(content)
+            # evict the least recently used entries until we're under budget
+            while self._size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+            cache_size_bytes.set(self._size)
+
+    def invalidate(self, notebook_id, filename):
+        with self._lock:
+            if (notebook_id, filename) in self._entries:
+                self._remove((notebook_id, filename))
+                cache_size_bytes.set(self._size)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            cache_size_bytes.set(0)
+
+
+file_content_cache = FileContentCache()
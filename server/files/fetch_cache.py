@@ -0,0 +1,90 @@
+"""
+A cache of recently fetched file source urls, shared by all workers
+
+When several file sources point at the same url, it only needs downloading
+once every `FILE_FETCH_CACHE_TIMEOUT` seconds: the other sources copy the
+content of the file it was saved to.
+"""
+
+import collections
+import hashlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..metrics import Counter
+from .models import File
+
+fetches = Counter("iodide_file_source_fetches_total", "Urls downloaded to refresh file sources")
+saved_fetches = Counter(
+    "iodide_file_source_saved_fetches_total",
+    "File source refreshes served without downloading their url",
+)
+saved_bytes = Counter(
+    "iodide_file_source_saved_bytes_total",
+    "Bytes of file source content which didn't need downloading",
+)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# a copy of the content at `url` is in the file with the given id
+CachedFetch = collections.namedtuple(
+    "CachedFetch", ["file_id", "content_hash", "size", "etag", "last_modified"]
+)
+
+
+def normalize_url(url):
+    """
+    Returns a canonical form of a url, so that trivially different ways of
+    writing it (e.g. with a different case for the host, an explicit default
+    port, a fragment or query parameters in another order) are considered the
+    same
+    """
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.hostname or ""
+    if ":" in netloc:
+        netloc = f"[{netloc}]"
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo = f"{userinfo}:{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def _get_cache_key(url):
+    return "file-fetch:" + hashlib.sha256(url.encode()).hexdigest()
+
+
+def get_cached_fetches(urls):
+    """
+    Returns a dictionary of the (normalized) urls which were fetched recently
+    to the `CachedFetch` holding their content
+    """
+    if not settings.FILE_FETCH_CACHE_TIMEOUT:
+        return {}
+    keys = {_get_cache_key(url): url for url in urls}
+    cached_fetches = {
+        keys[key]: CachedFetch(*value) for (key, value) in cache.get_many(keys).items()
+    }
+    # the files may have been changed or deleted since
+    available = set(
+        File.objects.filter(
+            id__in=[cached_fetch.file_id for cached_fetch in cached_fetches.values()]
+        ).values_list("id", "content_hash")
+    )
+    return {
+        url: cached_fetch
+        for (url, cached_fetch) in cached_fetches.items()
+        if (cached_fetch.file_id, cached_fetch.content_hash) in available
+    }
+
+
+def cache_fetch(url, cached_fetch):
+    if settings.FILE_FETCH_CACHE_TIMEOUT:
+        cache.set(_get_cache_key(url), tuple(cached_fetch), settings.FILE_FETCH_CACHE_TIMEOUT)
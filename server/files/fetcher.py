@@ -0,0 +1,358 @@
+"""
+Fetching of file source contents
+
+Batches of urls are fetched concurrently: an asyncio event loop hands each
+(blocking) request to a pool of threads, while enforcing a global cap on the
+number of requests in flight, a cap per host, and a deadline per request.
+Fetching never touches the database, so that callers can write the results
+back in bulk once a whole batch is done.
+"""
+
+import asyncio
+import collections
+import hashlib
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+import urllib3
+from django.conf import settings
+
+from ..metrics import Counter, Histogram
+
+fetch_durations = Histogram(
+    "iodide_file_source_fetch_duration_seconds",
+    "Time taken to fetch file source urls, by host and phase (connect, ttfb or total)",
+    ["host", "phase"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+fetch_outcomes = Counter(
+    "iodide_file_source_host_fetches_total",
+    "File source urls fetched, by host and outcome",
+    ["host", "outcome"],
+)
+fetch_bytes = Counter(
+    "iodide_file_source_fetch_bytes_total",
+    "Bytes downloaded from file source urls, by host",
+    ["host"],
+)
+
+# fetches from hosts beyond the first FILE_FETCH_METRICS_MAX_HOSTS seen by the
+# process are all recorded under this label
+OTHER_HOSTS_LABEL = "other"
+
+_host_labels = set()
+_host_labels_lock = threading.Lock()
+
+# `progress`, if given, is called with the number of bytes downloaded so far
+# and expected (or None if unknown) as the download goes, and with
+# `final=True` once it is done
+FetchJob = collections.namedtuple("FetchJob", ["url", "headers", "progress"], defaults=[None])
+
+# `content` is a file object holding the downloaded content (or None if the
+# url was not modified), which should be closed once used, and `duration` how
+# long the fetch took in seconds (also set on the exceptions of failed fetches)
+FetchResult = collections.namedtuple(
+    "FetchResult",
+    ["not_modified", "content", "content_hash", "size", "etag", "last_modified", "duration"],
+    defaults=[None],
+)
+
+# how long a fetch which ran out of time is given to notice it, once its
+# connection is shut down, before its result is given up on
+ABANDON_GRACE_PERIOD = 5
+
+
+class _Fetch:
+    """
+    The state of a running fetch: its timings, and the connection its
+    request went through, so that it can be cut off from another thread
+    """
+
+    def __init__(self, timings):
+        self.timings = timings
+        self.connection = None
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+        sock = getattr(self.connection, "sock", None)
+        if sock is not None:
+            try:
+                # wakes up the fetch if it is blocked reading from the socket
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+# the fetch running in the current thread
+_current = threading.local()
+
+
+class _TimedConnectionMixin:
+    """
+    Adds the time taken to open connections (resolving the host name,
+    connecting and, for https, the TLS handshake) to the timings of the
+    current fetch, and lets it know which connection its request used
+    """
+
+    def connect(self):
+        start = time.monotonic()
+        try:
+            return super().connect()
+        finally:
+            fetch = getattr(_current, "fetch", None)
+            if fetch is not None:
+                fetch.timings["connect"] = (
+                    fetch.timings.get("connect", 0) + time.monotonic() - start
+                )
+
+    def request(self, *args, **kwargs):
+        fetch = getattr(_current, "fetch", None)
+        if fetch is not None:
+            fetch.connection = self
+        return super().request(*args, **kwargs)
+
+
+class _TimedHTTPConnectionPool(urllib3.HTTPConnectionPool):
+    ConnectionCls = type(
+        "TimedHTTPConnection", (_TimedConnectionMixin, urllib3.HTTPConnectionPool.ConnectionCls), {}
+    )
+
+
+class _TimedHTTPSConnectionPool(urllib3.HTTPSConnectionPool):
+    ConnectionCls = type(
+        "TimedHTTPSConnection",
+        (_TimedConnectionMixin, urllib3.HTTPSConnectionPool.ConnectionCls),
+        {},
+    )
+
+
+class _TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool,
+        }
+
+
+def _spool_content(response, progress=None, deadline=None):
+    """
+    Downloads the body of a response in chunks, returning it in a temporary
+    file (only kept in memory while small) along with its md5 digest and size
+
+    Raises a `requests.exceptions.Timeout` if the download is still going at
+    `deadline` (a `time.monotonic()` value).
+    """
+    # the length of an encoded body says nothing about the decoded content
+    expected_size = None
+    if "Content-Encoding" not in response.headers and "Content-Length" in response.headers:
+        expected_size = int(response.headers["Content-Length"])
+    if expected_size is not None and expected_size > settings.MAX_FILE_SIZE:
+        raise ValueError("File too large")
+
+    chunk_size = settings.FILE_FETCH_CHUNK_SIZE
+    spool = tempfile.SpooledTemporaryFile(max_size=chunk_size)
+    digest = hashlib.md5()
+    size = 0
+    try:
+        if progress:
+            progress(size, expected_size)
+        for chunk in response.iter_content(chunk_size):
+            if deadline is not None and time.monotonic() > deadline:
+                raise requests.exceptions.Timeout("Download took too long")
+            size += len(chunk)
+            if size > settings.MAX_FILE_SIZE:
+                raise ValueError("File too large")
+            digest.update(chunk)
+            spool.write(chunk)
+            if progress:
+                progress(size, expected_size)
+        if progress:
+            progress(size, expected_size, final=True)
+    except Exception:
+        spool.close()
+        raise
+    finally:
+        response.close()
+    spool.seek(0)
+    return spool, digest.hexdigest(), size
+
+
+def fetch(session, job, timings=None):
+    """
+    Fetches a single url, raising a `requests.exceptions.RequestException`
+    or a `ValueError` if it can't (or shouldn't) be stored
+
+    If given, `timings` is filled with the time taken (in seconds) to open
+    connections, if any, and until the response headers were received.
+
+    The whole fetch must be done within `FILE_FETCH_TIMEOUT` seconds (the
+    timeout given to requests only bounds each read from the socket, which a
+    server sending a trickle of data never hits): past that, its connection
+    is shut down and a `requests.exceptions.Timeout` raised.
+    """
+    timings = {} if timings is None else timings
+    timeout = settings.FILE_FETCH_TIMEOUT
+    start = time.monotonic()
+    current = _current.fetch = _Fetch(timings)
+    watchdog = threading.Timer(timeout, current.abort)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        try:
+            response = session.get(job.url, headers=job.headers, stream=True, timeout=timeout)
+        finally:
+            _current.fetch = None
+        timings["ttfb"] = time.monotonic() - start
+        response.raise_for_status()
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 304:
+            response.close()
+            return FetchResult(True, None, None, None, etag, last_modified)
+
+        content, content_hash, size = _spool_content(response, job.progress, start + timeout)
+        if current.aborted:
+            # the body may have been cut short without an error
+            content.close()
+            raise requests.exceptions.Timeout(f"Timed out after {timeout} seconds")
+        return FetchResult(False, content, content_hash, size, etag, last_modified)
+    except requests.exceptions.RequestException as e:
+        if current.aborted and not isinstance(e, requests.exceptions.Timeout):
+            raise requests.exceptions.Timeout(f"Timed out after {timeout} seconds") from e
+        raise
+    finally:
+        watchdog.cancel()
+
+
+def _get_outcome(result):
+    if isinstance(result, FetchResult):
+        return "not_modified" if result.not_modified else "ok"
+    if isinstance(result, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(result, requests.exceptions.ConnectionError):
+        return "connection_error"
+    if isinstance(result, requests.exceptions.HTTPError):
+        return "http_error"
+    return "error"
+
+
+def _get_host_label(host):
+    """
+    Returns the label recording the fetches from a host under: the host itself
+    for the first `FILE_FETCH_METRICS_MAX_HOSTS` hosts seen, `OTHER_HOSTS_LABEL`
+    for any other, so that urls (which users choose) can't make the number of
+    series kept in memory grow without bound
+    """
+    with _host_labels_lock:
+        if host in _host_labels:
+            return host
+        if len(_host_labels) < settings.FILE_FETCH_METRICS_MAX_HOSTS:
+            _host_labels.add(host)
+            return host
+    return OTHER_HOSTS_LABEL
+
+
+def _record_metrics(host, result, timings):
+    host = _get_host_label(host)
+    for phase, duration in timings.items():
+        fetch_durations.observe(duration, host=host, phase=phase)
+    fetch_outcomes.inc(host=host, outcome=_get_outcome(result))
+    if isinstance(result, FetchResult) and result.size:
+        fetch_bytes.inc(result.size, host=host)
+
+
+def iter_chunks(content):
+    """
+    Yields the content of a fetch result in chunks, from its start
+    """
+    content.seek(0)
+    yield from iter(lambda: content.read(settings.FILE_FETCH_CHUNK_SIZE), b"")
+
+
+def close_result(result):
+    """
+    Closes the content of a fetch result, if it has any
+    """
+    if isinstance(result, FetchResult) and result.content is not None:
+        result.content.close()
+
+
+def _close_abandoned_result(future):
+    if not future.cancelled() and future.exception() is None:
+        close_result(future.result())
+
+
+def _fetch_or_error(session, job):
+    start = time.monotonic()
+    timings = {}
+    try:
+        result = fetch(session, job, timings)
+    except (requests.exceptions.RequestException, ValueError) as e:
+        result = e
+    timings["total"] = time.monotonic() - start
+    _record_metrics(urlsplit(job.url).hostname, result, timings)
+    if isinstance(result, FetchResult):
+        return result._replace(duration=timings["total"])
+    result.duration = timings["total"]
+    return result
+
+
+async def _fetch_concurrently(session, executor, jobs):
+    timeout = settings.FILE_FETCH_TIMEOUT
+    global_limit = asyncio.Semaphore(settings.FILE_FETCH_CONCURRENCY)
+    host_limits = collections.defaultdict(
+        lambda: asyncio.Semaphore(settings.FILE_FETCH_PER_HOST_CONCURRENCY)
+    )
+
+    async def fetch_with_limits(job):
+        # wait for a slot on the host first, so that requests queued up for a
+        # busy host don't hold global slots other hosts could be using
+        async with host_limits[urlsplit(job.url).hostname]:
+            async with global_limit:
+                future = executor.submit(_fetch_or_error, session, job)
+                try:
+                    # fetches time out on their own, this is only a backstop
+                    # in case one gets stuck regardless
+                    return await asyncio.wait_for(
+                        asyncio.shield(asyncio.wrap_future(future)),
+                        timeout + ABANDON_GRACE_PERIOD,
+                    )
+                except asyncio.TimeoutError:
+                    # the request itself carries on in its thread, and is
+                    # recorded in the metrics once it ends
+                    future.add_done_callback(_close_abandoned_result)
+                    error = requests.exceptions.Timeout(f"Timed out after {timeout} seconds")
+                    error.duration = timeout
+                    return error
+
+    return await asyncio.gather(*(fetch_with_limits(job) for job in jobs))
+
+
+def fetch_all(jobs, concurrent=True):
+    """
+    Fetches a list of `FetchJob`, returning (in the same order) either a
+    `FetchResult` or the exception which made the fetch fail
+
+    If `concurrent` is false, jobs are fetched one after the other in the
+    calling thread instead.
+    """
+    with requests.Session() as session:
+        adapter = _TimedHTTPAdapter(pool_maxsize=settings.FILE_FETCH_PER_HOST_CONCURRENCY)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        if not concurrent:
+            return [_fetch_or_error(session, job) for job in jobs]
+        executor = ThreadPoolExecutor(max_workers=settings.FILE_FETCH_CONCURRENCY)
+        try:
+            return asyncio.run(_fetch_concurrently(session, executor, jobs))
+        finally:
+            # don't wait for abandoned fetches, which clean up after
+            # themselves whenever they end
+            executor.shutdown(wait=False)
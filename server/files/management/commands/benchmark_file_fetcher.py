@@ -0,0 +1,100 @@
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from ...fetcher import FetchJob, fetch_all
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """
+    Serves `size` bytes after sleeping for `delay` milliseconds (both taken
+    from the query string)
+    """
+
+    def do_GET(self):
+        params = parse_qs(urlsplit(self.path).query)
+        time.sleep(int(params["delay"][0]) / 1000)
+        body = b"x" * int(params["size"][0])
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure how long the file source fetcher takes to download a batch of urls from "
+        "local stand-in servers (one per 127.0.0.x address) with varied latency"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sources", type=int, default=1000, help="Number of urls to fetch")
+        parser.add_argument("--hosts", type=int, default=10, help="Number of distinct hosts")
+        parser.add_argument("--size", type=int, default=10 * 1024, help="Size of each response")
+        parser.add_argument("--concurrency", type=int, help="Override FILE_FETCH_CONCURRENCY")
+        parser.add_argument(
+            "--per-host-concurrency",
+            dest="per_host_concurrency",
+            type=int,
+            help="Override FILE_FETCH_PER_HOST_CONCURRENCY",
+        )
+        parser.add_argument(
+            "--sequential",
+            action="store_true",
+            help="Also fetch the urls one at a time, for comparison",
+        )
+
+    def handle(self, *args, **options):
+        servers = [
+            ThreadingHTTPServer((f"127.0.0.{i + 1}", 0), SlowHandler)
+            for i in range(options["hosts"])
+        ]
+        for server in servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # mostly fast responses, with a long tail of slow ones
+        rng = random.Random(42)
+        jobs = []
+        for i in range(options["sources"]):
+            host, port = servers[i % len(servers)].server_address
+            delay = 1000 if rng.random() < 0.01 else rng.randint(10, 250)
+            jobs.append(
+                FetchJob(f"http://{host}:{port}/{i}?delay={delay}&size={options['size']}", {})
+            )
+
+        overrides = {}
+        if options["concurrency"]:
+            overrides["FILE_FETCH_CONCURRENCY"] = options["concurrency"]
+        if options["per_host_concurrency"]:
+            overrides["FILE_FETCH_PER_HOST_CONCURRENCY"] = options["per_host_concurrency"]
+        try:
+            with override_settings(**overrides):
+                modes = [True, False] if options["sequential"] else [True]
+                for concurrent in modes:
+                    self.run(jobs, concurrent)
+        finally:
+            for server in servers:
+                server.shutdown()
+
+    def run(self, jobs, concurrent):
+        start = time.monotonic()
+        results = fetch_all(jobs, concurrent=concurrent)
+        elapsed = time.monotonic() - start
+        failures = sum(isinstance(result, Exception) for result in results)
+        self.stdout.write(
+            "{}: fetched {} urls in {:.2f}s ({:.1f} urls/s, {} failed)".format(
+                "concurrent" if concurrent else "sequential",
+                len(jobs),
+                elapsed,
+                len(jobs) / elapsed,
+                failures,
+            )
+        )
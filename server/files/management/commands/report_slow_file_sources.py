@@ -0,0 +1,48 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db.models import Avg, Count, F, Max, Q
+from django.utils import timezone
+
+from ...models import FileUpdateOperation
+
+
+class Command(BaseCommand):
+    help = "Report the file source urls which were slowest to fetch, or failed most, recently"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days", type=float, default=7, help="Only consider operations from the last days"
+        )
+        parser.add_argument("--limit", type=int, default=20, help="Number of urls to list")
+
+    def handle(self, *args, **options):
+        since = timezone.now() - datetime.timedelta(days=options["days"])
+        stats = (
+            FileUpdateOperation.objects.filter(scheduled_at__gte=since)
+            .values(url=F("file_source__url"))
+            .annotate(
+                operations=Count("id"),
+                failures=Count("id", filter=Q(status=FileUpdateOperation.FAILED)),
+                average_duration=Avg("fetch_duration"),
+                max_duration=Max("fetch_duration"),
+            )
+        )
+        limit = options["limit"]
+
+        slowest = stats.filter(average_duration__isnull=False).order_by("-average_duration")
+        most_failing = stats.filter(failures__gt=0).order_by("-failures", "-operations")
+
+        self.stdout.write("Slowest urls (average / max fetch duration, operations):")
+        for row in slowest[:limit]:
+            self.stdout.write(
+                "  {:8.2f}s {:8.2f}s {:6d}  {}".format(
+                    row["average_duration"], row["max_duration"], row["operations"], row["url"]
+                )
+            )
+
+        self.stdout.write("Most failing urls (failures / operations):")
+        for row in most_failing[:limit]:
+            self.stdout.write(
+                "  {:6d} / {:6d}  {}".format(row["failures"], row["operations"], row["url"])
+            )
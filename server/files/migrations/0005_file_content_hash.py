@@ -0,0 +1,22 @@
+# Generated by Django 3.0.7 on 2026-10-19 17:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_increase_max_size_of_file_source_url'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.RunSQL(
+            "UPDATE file SET content_hash = md5(content)",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
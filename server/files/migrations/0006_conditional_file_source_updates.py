@@ -0,0 +1,28 @@
+# Generated by Django 3.0.7 on 2026-10-19 18:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_file_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filesource',
+            name='etag',
+            field=models.CharField(blank=True, max_length=256, null=True),
+        ),
+        migrations.AddField(
+            model_name='filesource',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='fileupdateoperation',
+            name='outcome',
+            field=models.CharField(choices=[('updated', 'updated'), ('not_modified', 'not modified')], max_length=32, null=True),
+        ),
+    ]
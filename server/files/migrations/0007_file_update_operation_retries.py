@@ -0,0 +1,29 @@
+# Generated by Django 3.0.7 on 2026-10-19 18:40
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0006_conditional_file_source_updates'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileupdateoperation',
+            name='attempt_history',
+            field=django.contrib.postgres.fields.jsonb.JSONField(default=list),
+        ),
+        migrations.AddField(
+            model_name='fileupdateoperation',
+            name='attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='fileupdateoperation',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
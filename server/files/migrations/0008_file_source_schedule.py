@@ -0,0 +1,50 @@
+# Generated by Django 3.0.7 on 2026-10-19 19:20
+
+import datetime
+import hashlib
+
+import django.core.validators
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def schedule_file_sources(apps, schema_editor):
+    # same as FileSource.get_next_run, which isn't available on historical models
+    FileSource = apps.get_model('files', 'FileSource')
+    now = timezone.now()
+    file_sources = list(FileSource.objects.filter(update_interval__isnull=False))
+    for file_source in file_sources:
+        interval_seconds = int(file_source.update_interval.total_seconds())
+        digest = hashlib.md5(str(file_source.id).encode()).digest()
+        offset = int.from_bytes(digest[:8], 'big') % interval_seconds
+        phase = (now.timestamp() - offset) % interval_seconds
+        file_source.next_run_at = now + datetime.timedelta(
+            seconds=(interval_seconds - phase) % interval_seconds
+        )
+    FileSource.objects.bulk_update(file_sources, ['next_run_at'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_file_update_operation_retries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filesource',
+            name='last_run_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='filesource',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='filesource',
+            name='update_interval',
+            field=models.DurationField(blank=True, null=True, validators=[django.core.validators.MinValueValidator(datetime.timedelta(seconds=3600))]),
+        ),
+        migrations.RunPython(schedule_file_sources, migrations.RunPython.noop),
+    ]
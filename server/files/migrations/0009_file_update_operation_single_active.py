@@ -0,0 +1,45 @@
+# Generated by Django 3.0.7 on 2026-10-19 19:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_file_source_schedule'),
+    ]
+
+    operations = [
+        # operations which have been running for a while were left behind by
+        # workers long gone, and will never end
+        migrations.RunSQL(
+            """
+            UPDATE file_update_operation
+            SET status = 'failed', failure_reason = 'Abandoned while running',
+                ended_at = now()
+            WHERE status = 'running'
+            AND (started_at IS NULL OR started_at < now() - interval '30 minutes')
+            """,
+            migrations.RunSQL.noop,
+        ),
+        # only keep the latest of any remaining concurrent operations for a
+        # source (pending ones whose job was lost are queued again later, see
+        # `reclaim_stale_file_update_operations`)
+        migrations.RunSQL(
+            """
+            UPDATE file_update_operation
+            SET status = 'failed', failure_reason = 'Superseded by a later operation',
+                ended_at = now()
+            WHERE status IN ('pending', 'running') AND id NOT IN (
+                SELECT max(id) FROM file_update_operation
+                WHERE status IN ('pending', 'running')
+                GROUP BY file_source_id
+            )
+            """,
+            migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name='fileupdateoperation',
+            constraint=models.UniqueConstraint(condition=models.Q(status__in=['pending', 'running']), fields=('file_source',), name='file_update_operation_single_active'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-19 20:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0009_file_update_operation_single_active'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='fileupdateoperation',
+            name='outcome',
+            field=models.CharField(choices=[('updated', 'updated'), ('not_modified', 'not modified'), ('unchanged', 'unchanged')], max_length=32, null=True),
+        ),
+    ]
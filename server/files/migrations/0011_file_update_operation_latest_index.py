@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-19 21:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0010_file_update_operation_unchanged_outcome'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='fileupdateoperation',
+            index=models.Index(fields=['file_source', 'id'], name='file_update_operation_latest'),
+        ),
+    ]
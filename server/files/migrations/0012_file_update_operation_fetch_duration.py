@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-19 22:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_file_update_operation_latest_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileupdateoperation',
+            name='fetch_duration',
+            field=models.FloatField(null=True),
+        ),
+    ]
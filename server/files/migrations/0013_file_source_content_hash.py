@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-19 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0012_file_update_operation_fetch_duration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filesource',
+            name='content_hash',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+    ]
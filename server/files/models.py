@@ -1,12 +1,43 @@
+import binascii
+import hashlib
 from datetime import timedelta
 
-from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.core.validators import MinValueValidator
+from django.db import connection, models, transaction
+from django.utils import timezone
 
-from ..notebooks.models import Notebook
+from ..notebooks.models import Notebook, NotebookContentModel
 from ..settings import MAX_FILE_SIZE, MAX_FILE_SOURCE_URL_LENGTH, MAX_FILENAME_LENGTH
 
 
-class File(models.Model):
+class _HexCopyReader:
+    """
+    A file-like object reading an iterable of chunks of binary data as a
+    single row of bytea in the text format of `COPY`
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._started = False
+        self._done = False
+
+    def read(self, size=-1):
+        # whatever the size asked for, the data is given a chunk at a time
+        if self._done:
+            return b""
+        if not self._started:
+            self._started = True
+            # the "\x" prefix of the hex format, its backslash escaped
+            return b"\\\\x"
+        for chunk in self._chunks:
+            if chunk:
+                return binascii.hexlify(chunk)
+        self._done = True
+        return b"\n"
+
+
+class File(NotebookContentModel):
     """
     Represents a file saved on the server
     """
@@ -16,8 +47,107 @@ class File(models.Model):
     # other things)
     filename = models.CharField(max_length=MAX_FILENAME_LENGTH)
     content = models.BinaryField(max_length=MAX_FILE_SIZE)
+    # md5 digest of the content, kept up to date on save so that we can tell
+    # whether a file changed without reading the (potentially large) blob
+    content_hash = models.CharField(max_length=32, blank=True, default="")
     last_updated = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        if "content" not in self.get_deferred_fields():
+            self.content_hash = hashlib.md5(self.content).hexdigest()
+        super().save(*args, **kwargs)
+
+    # inserts a file, or replaces the content of the existing one unless it
+    # is already the same, returning its id, new size and previous size (or
+    # nothing if it was unchanged)
+    UPSERT_SQL = """
+        WITH previous AS (
+            SELECT OCTET_LENGTH(content) AS size FROM file
+            WHERE notebook_id = %(notebook_id)s AND filename = %(filename)s
+        )
+        INSERT INTO file (notebook_id, filename, content, content_hash, last_updated)
+        VALUES (%(notebook_id)s, %(filename)s, {content}, %(content_hash)s, %(now)s)
+        ON CONFLICT (notebook_id, filename) DO UPDATE
+        SET content = EXCLUDED.content,
+            content_hash = EXCLUDED.content_hash,
+            last_updated = EXCLUDED.last_updated
+        WHERE file.content_hash <> EXCLUDED.content_hash
+        RETURNING id, OCTET_LENGTH(file.content), (SELECT size FROM previous)
+    """
+
+    @classmethod
+    def _upsert(cls, notebook_id, filename, content_hash, content_sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                cls.UPSERT_SQL.format(content=content_sql),
+                {
+                    "notebook_id": notebook_id,
+                    "filename": filename,
+                    "content_hash": content_hash,
+                    "now": timezone.now(),
+                    **params,
+                },
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        file_id, size, previous_size = row
+        Notebook.update_storage_bytes(notebook_id, size - (previous_size or 0))
+        return file_id
+
+    @classmethod
+    def upsert_content_chunks(cls, notebook_id, filename, chunks, content_hash):
+        """
+        Creates or updates a file with its content taken from an iterable of
+        chunks, streaming them to the database so that the whole file is
+        never held in memory
+
+        The chunks are copied (hex-encoded, so twice their size goes over the
+        wire) into a temporary table, which isn't written to the WAL, and the
+        file's content set from it in a single statement: large contents are
+        then only written (and TOASTed) once, rather than rewritten as each
+        chunk is appended to them.
+
+        `content_hash` is the md5 digest of the full content. If the file
+        already has that content, it is left untouched and None is returned,
+        otherwise the id of the file is.
+        """
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("CREATE TEMPORARY TABLE file_upload (content bytea)")
+                cursor.copy_expert("COPY file_upload (content) FROM STDIN", _HexCopyReader(chunks))
+            file_id = cls._upsert(
+                notebook_id, filename, content_hash, "(SELECT content FROM file_upload)", {}
+            )
+            with connection.cursor() as cursor:
+                cursor.execute("DROP TABLE file_upload")
+        return file_id
+
+    @classmethod
+    def upsert_content_from(cls, notebook_id, filename, file_id, content_hash):
+        """
+        Creates or updates a file with the same content as another one,
+        copying it within the database rather than through this process
+
+        Returns like `upsert_content_chunks`, or raises `File.DoesNotExist`
+        if the other file no longer has the expected content hash.
+        """
+        with transaction.atomic():
+            # make sure the content we copy stays around until we're done
+            if not (
+                File.objects.filter(id=file_id, content_hash=content_hash)
+                .select_for_update()
+                .exists()
+            ):
+                raise File.DoesNotExist(f"File {file_id} no longer has content {content_hash}")
+            return cls._upsert(
+                notebook_id,
+                filename,
+                content_hash,
+                "(SELECT content FROM file WHERE id = %(file_id)s)",
+                {"file_id": file_id},
+            )
+
     def __str__(self):  # pragma: no cover
         return self.filename
 
@@ -34,16 +164,67 @@ class FileSource(models.Model):
     Represents a source for files (an external URL)
     """
 
+    HOURLY = timedelta(hours=1)
     DAILY = timedelta(days=1)
     WEEKLY = timedelta(weeks=1)
-    UPDATE_INTERVALS = ((DAILY, "daily"), (WEEKLY, "weekly"))
+    # any interval of at least an hour is allowed, these are the usual ones
+    UPDATE_INTERVALS = ((HOURLY, "hourly"), (DAILY, "daily"), (WEEKLY, "weekly"))
+    MIN_UPDATE_INTERVAL = HOURLY
 
     notebook = models.ForeignKey(Notebook, on_delete=models.CASCADE)
     # FIXME: add a validator for filename (for minimum length and maybe
     # other things)
     filename = models.CharField(max_length=MAX_FILENAME_LENGTH)
     url = models.URLField(max_length=MAX_FILE_SOURCE_URL_LENGTH)
-    update_interval = models.DurationField(null=True, choices=UPDATE_INTERVALS)
+    update_interval = models.DurationField(
+        null=True, blank=True, validators=[MinValueValidator(MIN_UPDATE_INTERVAL)]
+    )
+    # when the next refresh is due (null if the source is never refreshed),
+    # and when the last one was queued
+    next_run_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    last_run_at = models.DateTimeField(null=True, blank=True)
+    # validators returned by the upstream server on the last successful
+    # fetch, used to make conditional requests on refresh
+    etag = models.CharField(max_length=256, null=True, blank=True)
+    last_modified = models.CharField(max_length=64, null=True, blank=True)
+    # the hash of the content that fetch downloaded, which the validators
+    # are only good for as long as the file still holds it
+    content_hash = models.CharField(max_length=32, null=True, blank=True)
+
+    def get_schedule_offset(self):
+        """
+        Returns the offset (in seconds) within its update interval at which
+        the source should be refreshed
+
+        The offset is derived from a hash of the id, so it is stable over time
+        and sources are spread evenly over the interval.
+        """
+        digest = hashlib.md5(str(self.id).encode()).digest()
+        return int.from_bytes(digest[:8], "big") % int(self.update_interval.total_seconds())
+
+    def get_next_run(self, start):
+        """
+        Returns the first time, at or after `start`, at which the source is
+        due for a refresh
+        """
+        interval_seconds = int(self.update_interval.total_seconds())
+        phase = (start.timestamp() - self.get_schedule_offset()) % interval_seconds
+        return start + timedelta(seconds=(interval_seconds - phase) % interval_seconds)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "update_interval" not in update_fields:
+            return super().save(*args, **kwargs)
+        if update_fields is not None:
+            kwargs["update_fields"] = [*update_fields, "next_run_at"]
+
+        with transaction.atomic():
+            if self.id is None:
+                # the schedule depends on the id, so we need one first
+                super().save(*args, **kwargs)
+                args, kwargs = (), {"update_fields": ["next_run_at"]}
+            self.next_run_at = self.get_next_run(timezone.now()) if self.update_interval else None
+            super().save(*args, **kwargs)
 
     def __str__(self):  # pragma: no cover
         return self.url
@@ -71,6 +252,18 @@ class FileUpdateOperation(models.Model):
         (COMPLETED, "completed"),
         (FAILED, "failed"),
     )
+    # there is at most one active operation per file source at any time
+    ACTIVE_STATUSES = (PENDING, RUNNING)
+
+    # what a completed operation did to the file
+    UPDATED = "updated"
+    NOT_MODIFIED = "not_modified"
+    UNCHANGED = "unchanged"
+    OPERATION_OUTCOMES = (
+        (UPDATED, "updated"),
+        (NOT_MODIFIED, "not modified"),
+        (UNCHANGED, "unchanged"),
+    )
 
     file_source = models.ForeignKey(FileSource, on_delete=models.CASCADE)
     scheduled_at = models.DateTimeField(auto_now_add=True)
@@ -78,6 +271,52 @@ class FileUpdateOperation(models.Model):
     ended_at = models.DateTimeField(null=True)
     status = models.CharField(max_length=32, choices=OPERATION_STATUSES, default=PENDING)
     failure_reason = models.CharField(max_length=128, null=True)
+    outcome = models.CharField(max_length=32, choices=OPERATION_OUTCOMES, null=True)
+    # operations failing for transient reasons go back to pending and are
+    # retried later, with each attempt recorded in the history
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True)
+    attempt_history = JSONField(default=list)
+    # how long the url took to fetch, in seconds (None if it wasn't fetched,
+    # e.g. because it was recently fetched for another file source)
+    fetch_duration = models.FloatField(null=True)
+
+    # deletes up to `limit` operations of the given file sources, other than
+    # the `keep` latest ones of each source, active ones and failures since
+    # `failures_since`
+    PRUNE_SQL = """
+        DELETE FROM file_update_operation WHERE id IN (
+            SELECT id FROM (
+                SELECT id, status, scheduled_at, ROW_NUMBER() OVER (
+                    PARTITION BY file_source_id ORDER BY id DESC
+                ) AS position
+                FROM file_update_operation
+                WHERE file_source_id = ANY(%(file_source_ids)s)
+            ) AS operations
+            WHERE position > %(keep)s
+            AND status NOT IN ('pending', 'running')
+            AND NOT (status = 'failed' AND scheduled_at >= %(failures_since)s)
+            LIMIT %(limit)s
+        )
+    """
+
+    @classmethod
+    def prune(cls, file_source_ids, keep, failures_since, limit):
+        """
+        Deletes old operations of some file sources (see `PRUNE_SQL`),
+        returning how many were deleted
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                cls.PRUNE_SQL,
+                {
+                    "file_source_ids": list(file_source_ids),
+                    "keep": keep,
+                    "failures_since": failures_since,
+                    "limit": limit,
+                },
+            )
+            return cursor.rowcount
 
     def __str__(self):  # pragma: no cover
         return "{} update ({})".format(self.file_source, self.OPERATION_STATUSES[self.status][1])
@@ -87,3 +326,12 @@ class FileUpdateOperation(models.Model):
         verbose_name_plural = "File Update Operations"
         ordering = ("id",)
         db_table = "file_update_operation"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["file_source"],
+                condition=models.Q(status__in=["pending", "running"]),
+                name="file_update_operation_single_active",
+            )
+        ]
+        # for looking up the latest operation of file sources
+        indexes = [models.Index(fields=["file_source", "id"], name="file_update_operation_latest")]
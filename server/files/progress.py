@@ -0,0 +1,72 @@
+"""
+Live progress of file update operations
+
+While a file source is downloaded, the number of bytes received so far (and
+expected, if known) is published to the cache, which all web and worker
+processes share, so that clients can follow an operation without querying
+the database.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import FileUpdateOperation
+
+# how long progress is kept after its last update
+PROGRESS_TIMEOUT = 5 * 60
+
+
+def _get_cache_key(update_operation_id):
+    return f"file-update-progress:{update_operation_id}"
+
+
+def set_progress(update_operation_ids, status, bytes_downloaded=None, expected_bytes=None):
+    cache.set_many(
+        {
+            _get_cache_key(update_operation_id): {
+                "status": status,
+                "bytes_downloaded": bytes_downloaded,
+                "expected_bytes": expected_bytes,
+            }
+            for update_operation_id in update_operation_ids
+        },
+        PROGRESS_TIMEOUT,
+    )
+
+
+def get_progress(update_operation_id):
+    """
+    Returns the last progress published for an operation, as a dictionary
+    with its status, bytes downloaded and expected bytes (either of which may
+    be None), or None if there is none
+    """
+    return cache.get(_get_cache_key(update_operation_id))
+
+
+class ProgressReporter:
+    """
+    Publishes the progress of a download shared by one or more operations,
+    no more than once every `FILE_UPDATE_PROGRESS_INTERVAL` seconds
+    """
+
+    def __init__(self, update_operation_ids):
+        self.update_operation_ids = update_operation_ids
+        self.last_published_at = None
+
+    def __call__(self, bytes_downloaded, expected_bytes, final=False):
+        now = time.monotonic()
+        if (
+            not final
+            and self.last_published_at is not None
+            and now - self.last_published_at < settings.FILE_UPDATE_PROGRESS_INTERVAL
+        ):
+            return
+        self.last_published_at = now
+        set_progress(
+            self.update_operation_ids,
+            FileUpdateOperation.RUNNING,
+            bytes_downloaded,
+            expected_bytes,
+        )
@@ -1,7 +1,10 @@
+from django.core.validators import MinValueValidator
+from django.db.models import Prefetch
 from rest_framework import serializers
 
 from ..notebooks.models import Notebook
 from .models import File, FileSource, FileUpdateOperation
+from .progress import get_progress
 
 
 class FilesSerializer(serializers.ModelSerializer):
@@ -14,6 +17,16 @@ class FilesSerializer(serializers.ModelSerializer):
         fields = ("id", "notebook_id", "filename", "last_updated")
 
 
+class UpdateIntervalField(serializers.DurationField):
+    """
+    Accepts any duration, but represents it as a number of seconds (e.g.
+    "86400.0"), which is what clients expect
+    """
+
+    def to_representation(self, value):
+        return str(value.total_seconds())
+
+
 class FileSourceSerializer(serializers.ModelSerializer):
     """
     All the properties of a file source, which can be used to retrieve or
@@ -23,6 +36,11 @@ class FileSourceSerializer(serializers.ModelSerializer):
     notebook_id = serializers.PrimaryKeyRelatedField(
         source="notebook", queryset=Notebook.objects.all()
     )
+    update_interval = UpdateIntervalField(
+        allow_null=True,
+        required=False,
+        validators=[MinValueValidator(FileSource.MIN_UPDATE_INTERVAL)],
+    )
 
     class Meta:
         model = FileSource
@@ -42,6 +60,12 @@ class FileUpdateOperationSerializer(serializers.ModelSerializer):
         source="file_source", queryset=FileSource.objects.all()
     )
     status = StatusField(choices=FileUpdateOperation.OPERATION_STATUSES)
+    progress = serializers.SerializerMethodField()
+
+    def get_progress(self, obj):
+        if obj.status != FileUpdateOperation.RUNNING:
+            return None
+        return get_progress(obj.id)
 
     class Meta:
         model = FileUpdateOperation
@@ -53,6 +77,11 @@ class FileUpdateOperationSerializer(serializers.ModelSerializer):
             "ended_at",
             "status",
             "failure_reason",
+            "outcome",
+            "attempts",
+            "next_attempt_at",
+            "attempt_history",
+            "progress",
         )
 
 
@@ -72,12 +101,39 @@ class FileUpdateOperationWithoutReasonSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = FileUpdateOperation
-        fields = ("id", "file_source_id", "scheduled_at", "started_at", "ended_at", "status")
+        fields = (
+            "id",
+            "file_source_id",
+            "scheduled_at",
+            "started_at",
+            "ended_at",
+            "status",
+            "outcome",
+            "attempts",
+            "next_attempt_at",
+        )
+
+
+# prefetches the latest operation of each file source in a list with a single
+# query, for the serializers below (which otherwise need one per source)
+PREFETCH_LATEST_FILE_UPDATE_OPERATION = Prefetch(
+    "fileupdateoperation_set",
+    queryset=FileUpdateOperation.objects.order_by("file_source_id", "-id").distinct(
+        "file_source_id"
+    ),
+    to_attr="latest_file_update_operations",
+)
+
+
+def _get_latest_file_update_operation(file_source):
+    if hasattr(file_source, "latest_file_update_operations"):
+        return next(iter(file_source.latest_file_update_operations), None)
+    return FileUpdateOperation.objects.filter(file_source_id=file_source.id).last()
 
 
 class FileUpdateOperationLatestSerializer(serializers.RelatedField):
     def get_attribute(self, obj):
-        return FileUpdateOperation.objects.filter(file_source_id=obj.id).last()
+        return _get_latest_file_update_operation(obj)
 
     def to_representation(self, value):
         if value:
@@ -89,6 +145,7 @@ class FileUpdateOperationLatestSerializer(serializers.RelatedField):
                 "ended_at": obj["ended_at"],
                 "status": obj["status"],
                 "failure_reason": obj["failure_reason"],
+                "outcome": obj["outcome"],
             }
 
         return None
@@ -96,7 +153,7 @@ class FileUpdateOperationLatestSerializer(serializers.RelatedField):
 
 class FileUpdateOperationWithoutReasonLatestSerializer(serializers.RelatedField):
     def get_attribute(self, obj):
-        return FileUpdateOperation.objects.filter(file_source_id=obj.id).last()
+        return _get_latest_file_update_operation(obj)
 
     def to_representation(self, value):
         if value:
@@ -107,6 +164,7 @@ class FileUpdateOperationWithoutReasonLatestSerializer(serializers.RelatedField)
                 "started": obj["started_at"],
                 "ended": obj["ended_at"],
                 "status": obj["status"],
+                "outcome": obj["outcome"],
             }
 
         return None
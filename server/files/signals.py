@@ -0,0 +1,13 @@
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from .content_cache import file_content_cache
+from .models import File
+
+
+# only on save: a receiver of deletions would keep Django from deleting files
+# in bulk (a deleted file's entry can only be served for a later file with the
+# very same content, and is evicted like any other)
+@receiver(post_save, sender=File)
+def invalidate_file_content_cache(sender, instance, **kwargs):
+    file_content_cache.invalidate(instance.notebook_id, instance.filename)
@@ -1,68 +1,538 @@
+import collections
 import datetime
 import logging
+import random
 
 import requests
 from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
 from django.utils import timezone
 from spinach import Tasks
 
+from ..notebooks.models import OctetLength
+from ..task_queues import deferred_jobs, is_queue_full
+from .fetch_cache import (
+    CachedFetch,
+    cache_fetch,
+    fetches,
+    get_cached_fetches,
+    normalize_url,
+    saved_bytes,
+    saved_fetches,
+)
+from .fetcher import FetchJob, FetchResult, close_result, fetch_all, iter_chunks
 from .models import File, FileSource, FileUpdateOperation
+from .progress import ProgressReporter, set_progress
 
 logger = logging.getLogger(__name__)
 
-tasks = Tasks()
+tasks = Tasks(queue=settings.FILES_TASK_QUEUE)
 
-ONE_DAY = datetime.timedelta(days=1)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
 
 
-@tasks.task(name="files:execute_file_update_operation")
-def execute_file_update_operation(update_operation_id):
-    update_operation = FileUpdateOperation.objects.get(id=update_operation_id)
+def _holds_fetched_content(file_source, existing_files):
+    """
+    Returns whether the files all hold the content last downloaded for the
+    file source
+    """
+    return file_source.content_hash is not None and all(
+        existing_file is not None and existing_file.content_hash == file_source.content_hash
+        for existing_file in existing_files
+    )
+
+
+def _get_fetch_job(update_operations, existing_files):
+    """
+    Returns the job fetching the (common) url of the file sources of one or
+    more operations, publishing its progress for all of them
+    """
+    file_sources = [update_operation.file_source for update_operation in update_operations]
+    headers = {}
+    # only make a conditional request if the files still hold the content
+    # the validators were issued for (it may have been replaced since), and
+    # they all refer to the same version
+    validators = {
+        (file_source.etag, file_source.last_modified, file_source.content_hash)
+        for file_source in file_sources
+    }
+    if len(validators) == 1 and _holds_fetched_content(file_sources[0], existing_files):
+        etag, last_modified, _ = validators.pop()
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    return FetchJob(
+        file_sources[0].url,
+        headers,
+        ProgressReporter([update_operation.id for update_operation in update_operations]),
+    )
 
-    # set status to RUNNING
-    update_operation.status = FileUpdateOperation.RUNNING
-    update_operation.started_at = timezone.now()
-    update_operation.save()
 
-    # actually run the query against the URL
+def _save_result(update_operation, existing_file, result):
+    """
+    Updates an operation (and its file) from the result of a fetch, returning
+    a `CachedFetch` pointing at the file if it now holds the url's content
+    """
     file_source = update_operation.file_source
-    try:
-        logger.info("Fetching file resource %s for notebook %s", file_source, file_source.notebook)
-        request = requests.get(file_source.url, stream=True)
-        request.raise_for_status()
-        content = request.raw.read(settings.MAX_FILE_SIZE + 1, decode_content=True)
-        if len(content) > settings.MAX_FILE_SIZE:
-            raise ValueError("File too large")
+    if isinstance(result, Exception):
+        update_operation.status = FileUpdateOperation.FAILED
+        update_operation.failure_reason = str(result)
+        return None
+
+    if isinstance(result, FetchResult) and result.not_modified:
+        # the file may only be trusted to hold the url's content (and shared
+        # with other sources) if it still holds what we last downloaded
+        if not _holds_fetched_content(file_source, [existing_file]):
+            update_operation.status = FileUpdateOperation.FAILED
+            update_operation.failure_reason = "Unexpected not modified response"
+            return None
+        logger.info("File resource %s not modified", file_source)
+        update_operation.status = FileUpdateOperation.COMPLETED
+        update_operation.outcome = FileUpdateOperation.NOT_MODIFIED
+        # a 304 may omit validators, in which case the previous ones remain valid
+        file_source.etag = result.etag or file_source.etag
+        file_source.last_modified = result.last_modified or file_source.last_modified
+        return CachedFetch(
+            existing_file.id,
+            file_source.content_hash,
+            existing_file.size,
+            file_source.etag,
+            file_source.last_modified,
+        )
+
+    update_operation.status = FileUpdateOperation.COMPLETED
+    if existing_file is not None and existing_file.content_hash == result.content_hash:
+        # no need to rewrite the same content
+        file_id = None
+    elif isinstance(result, CachedFetch):
+        # someone else downloaded the same url recently
         try:
-            file = File.objects.get(notebook=file_source.notebook, filename=file_source.filename)
-            file.content = content
-            file.save()
-        except File.DoesNotExist:
-            File.objects.create(
-                notebook=file_source.notebook, filename=file_source.filename, content=content
+            file_id = File.upsert_content_from(
+                file_source.notebook_id, file_source.filename, result.file_id, result.content_hash
             )
-        update_operation.status = FileUpdateOperation.COMPLETED
-    except (requests.exceptions.RequestException, ValueError) as e:
+        except File.DoesNotExist as e:
+            update_operation.status = FileUpdateOperation.FAILED
+            update_operation.failure_reason = str(e)
+            return None
+    else:
+        file_id = File.upsert_content_chunks(
+            file_source.notebook_id,
+            file_source.filename,
+            iter_chunks(result.content),
+            result.content_hash,
+        )
+
+    if isinstance(result, CachedFetch):
+        saved_fetches.inc()
+        saved_bytes.inc(result.size)
+    if file_id is None:
+        logger.info("File resource %s unchanged", file_source)
+        update_operation.outcome = FileUpdateOperation.UNCHANGED
+        file_id = (
+            existing_file.id
+            if existing_file is not None
+            else File.objects.filter(
+                notebook_id=file_source.notebook_id, filename=file_source.filename
+            )
+            .values_list("id", flat=True)
+            .get()
+        )
+    else:
+        update_operation.outcome = FileUpdateOperation.UPDATED
+    file_source.etag = result.etag
+    file_source.last_modified = result.last_modified
+    file_source.content_hash = result.content_hash
+    return CachedFetch(
+        file_id, result.content_hash, result.size, file_source.etag, file_source.last_modified
+    )
+
+
+def _should_retry(update_operation, error):
+    if update_operation.attempts >= settings.FILE_FETCH_MAX_ATTEMPTS:
+        return False
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return (
+        isinstance(error, requests.exceptions.HTTPError)
+        and error.response is not None
+        and error.response.status_code in RETRYABLE_STATUS_CODES
+    )
+
+
+def _get_retry_delay(attempts, error):
+    """
+    Returns how long to wait before the next attempt, in seconds: an
+    exponential backoff with jitter, or longer if the server asked for it
+    """
+    delay = min(
+        settings.FILE_FETCH_RETRY_BASE_DELAY * 2 ** (attempts - 1),
+        settings.FILE_FETCH_RETRY_MAX_DELAY,
+    )
+    delay = random.uniform(delay / 2, delay)
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), settings.FILE_FETCH_RETRY_MAX_DELAY))
+    return delay
+
+
+def _record_attempt(update_operation):
+    update_operation.attempt_history.append(
+        {
+            "attempt": update_operation.attempts,
+            "started_at": update_operation.started_at.isoformat(),
+            "ended_at": update_operation.ended_at.isoformat(),
+            "status": update_operation.status,
+            "failure_reason": update_operation.failure_reason,
+            "fetch_duration": update_operation.fetch_duration,
+        }
+    )
+
+
+def _prepare_retry(update_operation, error):
+    """
+    Puts a failed operation back to pending until its next attempt (which is
+    up to the caller to schedule)
+    """
+    delay = _get_retry_delay(update_operation.attempts, error)
+    logger.info(
+        "Retrying file update operation %s in %.0f seconds (%s)", update_operation.id, delay, error
+    )
+    update_operation.status = FileUpdateOperation.PENDING
+    update_operation.next_attempt_at = update_operation.ended_at + datetime.timedelta(seconds=delay)
+    update_operation.started_at = None
+    update_operation.ended_at = None
+    update_operation.failure_reason = None
+
+
+# the fields of an operation saved once it has run, and those changed when it
+# is put back to pending for a retry
+RESULT_FIELDS = [
+    "status",
+    "failure_reason",
+    "outcome",
+    "ended_at",
+    "attempt_history",
+    "fetch_duration",
+]
+RETRY_FIELDS = ["status", "failure_reason", "started_at", "ended_at", "next_attempt_at"]
+
+
+def _save_operation(update_operation, existing_file, result):
+    """
+    Saves the result of an operation (see `_save_result`) in a transaction of
+    its own, so that the other operations of a batch are saved whatever
+    happens to this one: if it can't be, it is marked as failed instead
+    """
+    history_length = len(update_operation.attempt_history)
+    try:
+        with transaction.atomic():
+            cached_fetch = _save_result(update_operation, existing_file, result)
+            update_operation.ended_at = timezone.now()
+            _record_attempt(update_operation)
+            file_source = update_operation.file_source
+            FileSource.objects.filter(id=file_source.id).update(
+                etag=file_source.etag,
+                last_modified=file_source.last_modified,
+                content_hash=file_source.content_hash,
+            )
+            FileUpdateOperation.objects.filter(id=update_operation.id).update(
+                **{field: getattr(update_operation, field) for field in RESULT_FIELDS}
+            )
+            # check deferred foreign keys (e.g. to a notebook deleted since
+            # the fetch started) now, rather than when the transaction ends
+            connection.check_constraints()
+        return cached_fetch
+    except Exception as e:
+        logger.exception("Failed to save file update operation %s", update_operation.id)
+        del update_operation.attempt_history[history_length:]
         update_operation.status = FileUpdateOperation.FAILED
-        update_operation.failure_reason = str(e)
+        update_operation.outcome = None
+        update_operation.failure_reason = f"Failed to save the result ({type(e).__name__})"
+        update_operation.ended_at = timezone.now()
+        _record_attempt(update_operation)
+        FileUpdateOperation.objects.filter(id=update_operation.id).update(
+            **{field: getattr(update_operation, field) for field in RESULT_FIELDS}
+        )
+        return None
+
+
+def _execute_file_update_operations(update_operations, concurrent, use_cache):
+    # set status to RUNNING, skipping any operation that some other job
+    # already picked up
+    with transaction.atomic():
+        update_operations = list(
+            update_operations.select_for_update(of=("self",), skip_locked=True)
+            .filter(status=FileUpdateOperation.PENDING)
+            .select_related("file_source")
+        )
+        now = timezone.now()
+        for update_operation in update_operations:
+            update_operation.status = FileUpdateOperation.RUNNING
+            update_operation.started_at = now
+            update_operation.next_attempt_at = None
+            update_operation.attempts += 1
+        FileUpdateOperation.objects.bulk_update(
+            update_operations, ["status", "started_at", "next_attempt_at", "attempts"]
+        )
+    if not update_operations:
+        return
+    set_progress(
+        [update_operation.id for update_operation in update_operations],
+        FileUpdateOperation.RUNNING,
+    )
+    file_sources = [update_operation.file_source for update_operation in update_operations]
+
+    # look up the files we may be replacing, without loading their content
+    existing_files = {
+        (file.notebook_id, file.filename): file
+        for file in File.objects.filter(
+            notebook_id__in=[file_source.notebook_id for file_source in file_sources],
+            filename__in=[file_source.filename for file_source in file_sources],
+        )
+        .annotate(size=OctetLength("content"))
+        .defer("content")
+    }
+    existing_files = [
+        existing_files.get((file_source.notebook_id, file_source.filename))
+        for file_source in file_sources
+    ]
+
+    # sources pointing at the same url share a single fetch, unless it was
+    # fetched recently enough that we can reuse the result
+    operation_indexes = collections.defaultdict(list)
+    for i, file_source in enumerate(file_sources):
+        operation_indexes[normalize_url(file_source.url)].append(i)
+    results = get_cached_fetches(operation_indexes) if use_cache else {}
+    urls_to_fetch = [url for url in operation_indexes if url not in results]
+    logger.info("Fetching %s url(s) for %s file resource(s)", len(urls_to_fetch), len(file_sources))
+    fetches.inc(len(urls_to_fetch))
+    jobs = [
+        _get_fetch_job(
+            [update_operations[i] for i in operation_indexes[url]],
+            [existing_files[i] for i in operation_indexes[url]],
+        )
+        for url in urls_to_fetch
+    ]
+    results.update(zip(urls_to_fetch, fetch_all(jobs, concurrent=concurrent)))
 
-    update_operation.ended_at = timezone.now()
-    update_operation.save()
+    retries = []
+    retry_budget = None
+    cached_fetches = {}
+    try:
+        for url, indexes in operation_indexes.items():
+            result = results[url]
+            # recently fetched content is reused without a fetch (or duration)
+            fetch_duration = getattr(result, "duration", None)
+            for i in indexes:
+                update_operation = update_operations[i]
+                update_operation.fetch_duration = fetch_duration
+                cached_fetch = _save_operation(update_operation, existing_files[i], result)
+                if cached_fetch is not None:
+                    # the other sources can copy the content of this one
+                    cached_fetches[url] = result = cached_fetch
+                elif update_operation.status == FileUpdateOperation.FAILED and _should_retry(
+                    update_operation, result
+                ):
+                    if retry_budget is None:
+                        # operations already waiting for a retry use up the budget
+                        retry_budget = (
+                            settings.FILE_FETCH_RETRY_BUDGET
+                            - FileUpdateOperation.objects.filter(
+                                status=FileUpdateOperation.PENDING, attempts__gt=0
+                            ).count()
+                        )
+                    if retry_budget > 0:
+                        _prepare_retry(update_operation, result)
+                        retry_budget -= 1
+                        retries.append(update_operation)
+                        FileUpdateOperation.objects.filter(id=update_operation.id).update(
+                            **{field: getattr(update_operation, field) for field in RETRY_FIELDS}
+                        )
+    finally:
+        for result in results.values():
+            close_result(result)
+
+    for url, cached_fetch in cached_fetches.items():
+        cache_fetch(url, cached_fetch)
+    for status in {update_operation.status for update_operation in update_operations}:
+        set_progress(
+            [
+                update_operation.id
+                for update_operation in update_operations
+                if update_operation.status == status
+            ],
+            status,
+        )
+
+    # retries are delayed by the broker, so they don't hold on to a worker
+    # while waiting
+    for update_operation in retries:
+        tasks.schedule_at(
+            execute_file_update_operation, update_operation.next_attempt_at, update_operation.id
+        )
+
+
+@tasks.task(name="files:execute_file_update_operation")
+def execute_file_update_operation(update_operation_id):
+    # refreshes requested one at a time (e.g. by users) always fetch the url
+    _execute_file_update_operations(
+        FileUpdateOperation.objects.filter(id=update_operation_id),
+        concurrent=False,
+        use_cache=False,
+    )
 
 
-@tasks.task(name="files:execute_scheduled_file_operations", periodicity=ONE_DAY)
+@tasks.task(name="files:execute_file_update_operations")
+def execute_file_update_operations(update_operation_ids):
+    _execute_file_update_operations(
+        FileUpdateOperation.objects.filter(id__in=update_operation_ids),
+        concurrent=True,
+        use_cache=True,
+    )
+
+
+def reclaim_stale_file_update_operations(file_source_ids, now):
+    """
+    Reclaims the active operations of some file sources which have been stuck
+    for longer than `FILE_UPDATE_OPERATION_STALE_TIMEOUT`: running ones are
+    marked as failed, and the ids of pending ones (whose job, or delayed
+    retry, must have been lost) are returned, for the caller to queue them
+    again once its transaction is committed
+    """
+    stale_before = now - datetime.timedelta(seconds=settings.FILE_UPDATE_OPERATION_STALE_TIMEOUT)
+    update_operations = FileUpdateOperation.objects.filter(file_source_id__in=file_source_ids)
+    abandoned = update_operations.filter(
+        status=FileUpdateOperation.RUNNING, started_at__lt=stale_before
+    ).update(
+        status=FileUpdateOperation.FAILED,
+        failure_reason="Abandoned while running",
+        ended_at=now,
+    )
+    if abandoned:
+        logger.warning("Marked %s abandoned file update operation(s) as failed", abandoned)
+    lost = update_operations.filter(status=FileUpdateOperation.PENDING).filter(
+        Q(next_attempt_at__isnull=True, scheduled_at__lt=stale_before)
+        | Q(next_attempt_at__lt=stale_before)
+    )
+    lost_ids = list(lost.values_list("id", flat=True))
+    if lost_ids:
+        logger.warning("Queuing %s lost file update operation(s) again", len(lost_ids))
+        # so that they aren't queued again until they're stale once more
+        FileUpdateOperation.objects.filter(id__in=lost_ids).update(
+            scheduled_at=now, next_attempt_at=None
+        )
+    return lost_ids
+
+
+def _queue_due_file_operations(now):
+    """
+    Claims up to a batch of file sources due for a refresh, advancing their
+    schedule and queuing an operation for each (unless one is already
+    pending or running), and returns how many were claimed and queued
+
+    Rows locked by another poller are skipped, so that several of them can
+    share the work without queuing anything twice.
+    """
+    with transaction.atomic():
+        file_sources = list(
+            FileSource.objects.select_for_update(skip_locked=True)
+            .filter(next_run_at__lte=now)
+            .order_by("next_run_at")[: settings.FILE_FETCH_BATCH_SIZE]
+        )
+        if not file_sources:
+            return 0, 0
+        for file_source in file_sources:
+            # however many runs were missed, only catch up once: the next run is
+            # the first one due after now
+            file_source.next_run_at = file_source.get_next_run(now + datetime.timedelta(seconds=1))
+            file_source.last_run_at = now
+        FileSource.objects.bulk_update(file_sources, ["next_run_at", "last_run_at"])
+        lost_ids = reclaim_stale_file_update_operations(
+            [file_source.id for file_source in file_sources], now
+        )
+        busy_file_source_ids = set(
+            FileUpdateOperation.objects.filter(
+                file_source__in=file_sources, status__in=FileUpdateOperation.ACTIVE_STATUSES
+            ).values_list("file_source_id", flat=True)
+        )
+        update_operations = FileUpdateOperation.objects.bulk_create(
+            [
+                FileUpdateOperation(file_source=file_source)
+                for file_source in file_sources
+                if file_source.id not in busy_file_source_ids
+            ]
+        )
+
+    for update_operation_id in lost_ids:
+        tasks.schedule(execute_file_update_operation, update_operation_id)
+    # each batch is downloaded concurrently by one job
+    if update_operations:
+        tasks.schedule(
+            execute_file_update_operations,
+            [update_operation.id for update_operation in update_operations],
+        )
+    return len(file_sources), len(update_operations)
+
+
+@tasks.task(
+    name="files:execute_scheduled_file_operations",
+    periodicity=datetime.timedelta(seconds=settings.FILE_SOURCE_SCHEDULER_INTERVAL),
+)
 def execute_scheduled_file_operations():
-    # this runs once a day, always queue daily operations
-    intervals_to_queue = [ONE_DAY]
-    # if it is monday, include the weekly ones as well
-    if datetime.datetime.today().weekday() == 0:
-        intervals_to_queue.append(datetime.timedelta(weeks=1))
+    now = timezone.now()
+    queued = 0
+    while True:
+        if is_queue_full(settings.FILES_TASK_QUEUE):
+            # the remaining sources stay due, and are queued once workers
+            # catch up
+            deferred_jobs.inc(task=execute_file_update_operations.task_name)
+            logger.warning("File task queue full, postponing scheduled file operations")
+            break
+        claimed, batch_queued = _queue_due_file_operations(now)
+        queued += batch_queued
+        if claimed < settings.FILE_FETCH_BATCH_SIZE:
+            break
+    logger.info("Queued %s scheduled file operation(s)", queued)
 
-    logger.info(
-        "Running scheduled file operations (intervals: %s)",
-        ", ".join(str(i) for i in intervals_to_queue),
+
+@tasks.task(
+    name="files:prune_file_update_operations",
+    periodicity=datetime.timedelta(seconds=settings.FILE_UPDATE_OPERATION_PRUNE_INTERVAL),
+)
+def prune_file_update_operations():
+    """
+    Deletes the update operations which fall out of the retention policy
+
+    File sources are handled a batch at a time, and each statement deletes a
+    bounded number of rows, so that no lock is held for long.
+    """
+    keep = settings.FILE_UPDATE_OPERATION_RETENTION_COUNT
+    if not keep:
+        return
+    failures_since = timezone.now() - datetime.timedelta(
+        days=settings.FILE_UPDATE_OPERATION_FAILURE_RETENTION_DAYS
     )
-    file_sources = FileSource.objects.filter(update_interval__in=intervals_to_queue)
-    for file_source in file_sources:
-        update_operation = FileUpdateOperation.objects.create(file_source=file_source)
-        tasks.schedule(execute_file_update_operation, update_operation.id)
+    batch_size = settings.FILE_UPDATE_OPERATION_PRUNE_BATCH_SIZE
+    deleted = 0
+    last_file_source_id = 0
+    while True:
+        file_source_ids = list(
+            FileSource.objects.filter(id__gt=last_file_source_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not file_source_ids:
+            break
+        while True:
+            batch_deleted = FileUpdateOperation.prune(
+                file_source_ids, keep, failures_since, batch_size
+            )
+            deleted += batch_deleted
+            if batch_deleted < batch_size:
+                break
+        last_file_source_id = file_source_ids[-1]
+    logger.info("Pruned %s file update operation(s)", deleted)
@@ -1,12 +1,17 @@
 from django.conf.urls import url
 
 from ..settings import MAX_FILENAME_LENGTH
-from .views import file_view
+from .views import file_preview_view, file_view
 
 urlpatterns = [
+    url(
+        r"^(?P<notebook_pk>[0-9]+)/files/(?P<filename>[^/]{0,%s})/preview/?$" % MAX_FILENAME_LENGTH,
+        file_preview_view,
+        name="file-preview",
+    ),
     url(
         r"^(?P<notebook_pk>[0-9]+)/files/(?P<filename>[^/]{0,%s})/?$" % MAX_FILENAME_LENGTH,
         file_view,
         name="file-view",
-    )
+    ),
 ]
@@ -1,15 +1,122 @@
 import io
+import itertools
 import mimetypes
 
-from django.http import FileResponse
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.functions import Substr
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 
+from .content_cache import file_content_cache
 from .models import File
 
 
-def file_view(request, notebook_pk, filename):
-    file = File.objects.values_list("content", flat=True).get(
-        notebook_id=notebook_pk, filename=filename
+def _get_file_content(notebook_id, filename):
+    files = File.objects.filter(notebook_id=notebook_id, filename=filename)
+    if not file_content_cache.max_bytes:
+        return files.values_list("content", flat=True).get()
+
+    # checking the hash is cheap compared to reading the content, and ensures
+    # we never serve a version of the file that has since been replaced
+    content = file_content_cache.get(
+        notebook_id, filename, files.values_list("content_hash", flat=True).get()
     )
+    if content is None:
+        content_hash, content = files.values_list("content_hash", "content").get()
+        content = bytes(content)
+        file_content_cache.set(notebook_id, filename, content_hash, content)
+    return content
+
+
+def file_view(request, notebook_pk, filename):
+    file = _get_file_content(int(notebook_pk), filename)
     return FileResponse(
         io.BytesIO(file), content_type=mimetypes.guess_type(filename)[0] or "text/plain"
     )
+
+
+def _iter_content_chunks(file_id, chunk_size):
+    """
+    Yields the content of a file in chunks, fetching each one from the
+    database separately so the whole blob is never loaded at once
+    """
+    offset = 1  # SQL substring offsets are 1-based
+    while True:
+        chunk = bytes(
+            File.objects.filter(id=file_id)
+            .annotate(chunk=Substr("content", offset, chunk_size))
+            .values_list("chunk", flat=True)
+            .get()
+        )
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        offset += chunk_size
+
+
+def _get_preview_content_type(filename, is_binary):
+    default = "application/octet-stream" if is_binary else "text/plain"
+    return mimetypes.guess_type(filename)[0] or default
+
+
+def _stream_preview(chunks, rows, is_binary, cache_key):
+    """
+    Yields the first `rows` lines of a text file (or the first bytes of a
+    binary one), storing the result in the cache once it is complete
+    """
+    preview = []
+    preview_size = 0
+    lines = 0
+    for chunk in chunks:
+        end = len(chunk)
+        if not is_binary:
+            start = 0
+            while lines < rows:
+                newline = chunk.find(b"\n", start)
+                if newline == -1:
+                    break
+                lines += 1
+                start = newline + 1
+            if lines == rows:
+                end = start
+        piece = chunk[: min(end, settings.FILE_PREVIEW_MAX_BYTES - preview_size)]
+        preview.append(piece)
+        preview_size += len(piece)
+        yield piece
+        if preview_size >= settings.FILE_PREVIEW_MAX_BYTES or lines == rows:
+            break
+
+    cache.set(cache_key, (is_binary, b"".join(preview)), settings.FILE_PREVIEW_CACHE_TIMEOUT)
+
+
+def file_preview_view(request, notebook_pk, filename):
+    try:
+        rows = int(request.GET.get("rows", settings.FILE_PREVIEW_DEFAULT_ROWS))
+    except ValueError:
+        return HttpResponseBadRequest(content=f'Invalid number of rows: {request.GET["rows"]}')
+    if not 0 < rows <= settings.FILE_PREVIEW_MAX_ROWS:
+        return HttpResponseBadRequest(
+            content=f"Number of rows must be between 1 and {settings.FILE_PREVIEW_MAX_ROWS}"
+        )
+
+    file_id, content_hash = get_object_or_404(
+        File.objects.values_list("id", "content_hash"), notebook_id=notebook_pk, filename=filename
+    )
+
+    # previews are keyed by content, so identical files share a cache entry
+    # and a modified file never sees a stale one
+    cache_key = f"file-preview:{content_hash}:{rows}"
+    cached_preview = cache.get(cache_key)
+    if cached_preview is not None:
+        is_binary, preview = cached_preview
+        return HttpResponse(preview, content_type=_get_preview_content_type(filename, is_binary))
+
+    chunks = _iter_content_chunks(file_id, settings.FILE_PREVIEW_CHUNK_SIZE)
+    first_chunk = next(chunks, b"")
+    is_binary = b"\0" in first_chunk
+    return StreamingHttpResponse(
+        _stream_preview(itertools.chain([first_chunk], chunks), rows, is_binary, cache_key),
+        content_type=_get_preview_content_type(filename, is_binary),
+    )
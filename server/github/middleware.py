@@ -29,7 +29,7 @@ class GithubAuthMiddleware(object):
                         avatar_url = github_info.get("avatar_url")
                         if avatar_url:
                             request.user.avatar = avatar_url
-                            request.user.save()
+                            request.user.save(update_fields=["avatar"])
                     except HTTPError as err:
                         # was unable to get user info from github, we can just
                         # return a blank avatar for this case
@@ -16,5 +16,5 @@ class GravatarMiddleware(object):
             user.avatar = "https://www.gravatar.com/avatar/{}?d=identicon".format(
                 hashlib.md5(user.email.encode("utf-8")).hexdigest()
             )
-            user.save()
+            user.save(update_fields=["avatar"])
         return self.get_response(request)
@@ -0,0 +1,165 @@
+"""
+A minimal registry of Prometheus-style metrics
+
+Values are kept in memory by each process (web or worker), and exposed in the
+Prometheus text format by `metrics_view` (or, in processes which don't serve
+web requests, by `start_metrics_server`), so each process should be scraped as
+its own target.
+"""
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_registry = {}
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    formatted = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for (k, v) in labels
+    )
+    return "{%s}" % formatted
+
+
+class Metric:
+    """
+    Base class for metrics, which hold one value per distinct set of labels
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        if name in _registry:
+            raise ValueError(f"A metric named {name} already exists")
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry[name] = self
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Expected labels {self.labelnames} for {self.name}, got {labels}")
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for (key, value) in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """
+    A value which only ever goes up (e.g. a number of requests)
+    """
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value which can go up and down (e.g. the size of a cache)
+    """
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Counts of observed values (e.g. request durations) in cumulative buckets,
+    along with their sum
+    """
+
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            counts = [count + (value <= bound) for (count, bound) in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value)
+
+    def get(self, **labels):
+        """
+        Returns the number of values observed
+        """
+        counts, _ = self._values.get(self._key(labels), ([0], 0))
+        return counts[-1]
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    le = "+Inf" if bound == float("inf") else repr(float(bound))
+                    samples.append((f"{self.name}_bucket", key + (("le", le),), count))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, counts[-1]))
+        return samples
+
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in _registry.values()) + "\n"
+
+
+def metrics_view(request):
+    if not settings.METRICS_ENABLED:
+        raise Http404("Metrics are not enabled")
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(port, address=""):
+    """
+    Serves the metrics of this process on a port, from a background thread
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -1,3 +1,4 @@
+import copy
 import logging
 
 from django.conf import settings
@@ -5,6 +6,7 @@ from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied
 from django.db import transaction
 from django.http import Http404
+from django.utils import timezone
 from requests.exceptions import HTTPError
 from rest_framework import status, viewsets
 from rest_framework.exceptions import APIException, ValidationError
@@ -12,13 +14,23 @@ from rest_framework.response import Response
 from social_django.models import UserSocialAuth
 
 from ..github import get_github_user_data
+from ..task_queues import deferred_jobs, is_queue_full
+from .draft_buffer import (
+    apply_buffered_draft,
+    buffer_draft,
+    discard_buffered_draft,
+    flush_buffered_draft,
+)
+from .locks import lock_notebook_revisions
 from .models import Notebook, NotebookRevision
+from .patches import PatchError, apply_patch, get_content_hash
 from .serializers import (
     NotebookDetailSerializer,
     NotebookListSerializer,
     NotebookRevisionDetailSerializer,
     NotebookRevisionSerializer,
 )
+from .storage import check_storage_quota
 from .tasks import execute_notebook_revisions_cleanup, tasks
 
 logger = logging.getLogger(__name__)
@@ -85,6 +97,9 @@ class NotebookViewSet(viewsets.ModelViewSet):
         serializer = self.get_serializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         notebook = serializer.save(owner=owner, forked_from=forked_from)
+        check_storage_quota(
+            notebook, NotebookRevision.get_content_size(self.request.data["content"])
+        )
         NotebookRevision.objects.create(
             notebook=notebook,
             title=self.request.data["title"],
@@ -122,30 +137,112 @@ class NotebookRevisionViewSet(viewsets.ModelViewSet):
             return NotebookRevisionSerializer
         return NotebookRevisionDetailSerializer
 
+    def get_object(self):
+        return apply_buffered_draft(super().get_object())
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        revisions = list(page if page is not None else queryset)
+        # only the latest revision (first, in this order) may have a buffered
+        # draft
+        if revisions:
+            apply_buffered_draft(revisions[0])
+        serializer = self.get_serializer(revisions, many=True)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
     def perform_destroy(self, instance):
         if instance.notebook.owner != self.request.user:
             raise PermissionDenied
         super().perform_destroy(instance)
 
+    def _apply_patch(self, serializer, parent_revision):
+        """
+        Replaces the patch given to a serializer by the content it results in
+        """
+        parent_revision = apply_buffered_draft(copy.copy(parent_revision))
+        patch = serializer.validated_data.pop("patch")
+        content_hash = serializer.validated_data.pop("content_hash")
+        try:
+            content = apply_patch(parent_revision.content, patch)
+        except PatchError as e:
+            raise ValidationError(f"Patch does not apply to revision {parent_revision.id}: {e}")
+        if get_content_hash(content) != content_hash:
+            raise ValidationError("Patched content does not match content_hash")
+        if (
+            serializer.validated_data["title"] == parent_revision.title
+            and content == parent_revision.content
+        ):
+            raise ValidationError("Revision unchanged from previous")
+        serializer.validated_data["content"] = content
+
     def perform_create(self, serializer):
         ctx = self.get_serializer_context()
 
-        notebook_owner_id = Notebook.objects.values_list("owner", flat=True).get(
-            id=ctx["notebook_id"]
-        )
-        if self.request.user.id != notebook_owner_id:
+        notebook = Notebook.objects.select_related("owner").get(id=ctx["notebook_id"])
+        if self.request.user.id != notebook.owner_id:
             raise PermissionDenied
 
-        # validate against parent revision id, if provided as an argument
-        parent_revision_id = self.request.data.get("parent_revision_id")
-        if parent_revision_id:
+        with transaction.atomic():
+            # so that no other revision can be added (nor the latest one
+            # cleaned up) between checking the parent revision and saving
+            lock_notebook_revisions(ctx["notebook_id"])
             last_revision = NotebookRevision.objects.filter(notebook_id=ctx["notebook_id"]).first()
-            try:
-                assert int(parent_revision_id) == last_revision.id
-            except (ValueError, AssertionError):
-                raise ValidationError(
-                    f"Based on non-latest revision {parent_revision_id} "
-                    f"(expected: {last_revision.id})"
+
+            # validate against parent revision id, if provided as an argument
+            parent_revision_id = self.request.data.get("parent_revision_id")
+            if parent_revision_id:
+                try:
+                    assert int(parent_revision_id) == last_revision.id
+                except (ValueError, AssertionError):
+                    raise ValidationError(
+                        f"Based on non-latest revision {parent_revision_id} "
+                        f"(expected: {last_revision.id})"
+                    )
+            if "patch" in serializer.validated_data:
+                self._apply_patch(serializer, last_revision)
+            content_size = NotebookRevision.get_content_size(serializer.validated_data["content"])
+
+            now = timezone.now()
+            if (
+                (
+                    settings.NOTEBOOK_REVISION_COALESCE_DRAFTS
+                    or settings.NOTEBOOK_REVISION_WRITE_BEHIND
                 )
-        serializer.save(**{**ctx, "is_draft": True})
-        tasks.schedule(execute_notebook_revisions_cleanup, ctx["notebook_id"])
+                and last_revision is not None
+                and last_revision.is_draft
+                and last_revision.is_in_save_window(now)
+            ):
+                # the cleanup would only keep the latest draft of the window
+                # anyway, so overwrite it rather than adding another one (it
+                # keeps its creation time, so no indexed column changes and
+                # Postgres can usually update the row in place)
+                check_storage_quota(notebook, content_size - last_revision.content_size)
+                serializer.instance = last_revision
+                if (
+                    settings.NOTEBOOK_REVISION_WRITE_BEHIND
+                    and str(self.request.data.get("flush")).lower() not in ("true", "1")
+                    and buffer_draft(
+                        last_revision,
+                        serializer.validated_data["title"],
+                        serializer.validated_data["content"],
+                    )
+                ):
+                    # respond with the revision as it will be once written
+                    last_revision.title = serializer.validated_data["title"]
+                    last_revision.content = serializer.validated_data["content"]
+                    return
+                discard_buffered_draft(ctx["notebook_id"])
+                serializer.save()
+                return
+            # earlier drafts go before the new revision
+            flush_buffered_draft(ctx["notebook_id"])
+            check_storage_quota(notebook, content_size)
+            serializer.save(**{**ctx, "is_draft": True})
+        if is_queue_full(settings.NOTEBOOKS_TASK_QUEUE):
+            # workers are behind, the periodic sweep will get to this notebook
+            deferred_jobs.inc(task=execute_notebook_revisions_cleanup.task_name)
+        else:
+            tasks.schedule(execute_notebook_revisions_cleanup, ctx["notebook_id"])
@@ -2,4 +2,4 @@ from django.apps import AppConfig
 
 
 class NotebooksConfig(AppConfig):
-    name = "notebooks"
+    name = "server.notebooks"
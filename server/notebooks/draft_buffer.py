@@ -0,0 +1,106 @@
+"""
+Write-behind buffer for autosaved draft revisions
+
+With `NOTEBOOK_REVISION_WRITE_BEHIND`, saves which would overwrite the latest
+draft revision of a notebook (a draft from the current save window, see
+`NOTEBOOK_REVISION_COALESCE_DRAFTS`) only store the new title and content in
+a cache shared by all processes (`NOTEBOOK_REVISION_BUFFER_CACHE`, normally
+Redis), and return straight away. The first save of each window still adds
+its revision to the database, so at most one window of edits is ever only
+buffered.
+
+A buffered draft is written to its revision by a periodic task, before the
+notebook's revisions are cleaned up, before a later save adds a revision, or
+when a save asks for it. Until then, reads of the revision go through
+`apply_buffered_draft`, so that they see it.
+
+All of these (but reads) must be done while holding the lock on the
+notebook's revisions (see `lock_notebook_revisions`).
+"""
+
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+from .models import NotebookRevision
+
+logger = logging.getLogger(__name__)
+
+
+def _get_cache():
+    return caches[settings.NOTEBOOK_REVISION_BUFFER_CACHE]
+
+
+def _get_cache_key(notebook_id):
+    return f"notebook-draft:{notebook_id}"
+
+
+def buffer_draft(revision, title, content):
+    """
+    Stores a new title and content for a draft revision, to be written later,
+    returning whether it could be (if not, the revision should be saved
+    straight away)
+    """
+    try:
+        _get_cache().set(
+            _get_cache_key(revision.notebook_id),
+            {"revision_id": revision.id, "title": title, "content": content},
+            settings.NOTEBOOK_REVISION_BUFFER_TIMEOUT,
+        )
+    except Exception:
+        logger.exception("Failed to buffer the draft of notebook %s", revision.notebook_id)
+        return False
+    return True
+
+
+def get_buffered_drafts(notebook_ids):
+    """
+    Returns a dictionary of the given notebook ids to their buffered draft
+    (the id of its revision, its title and its content), for those which
+    have one
+    """
+    keys = {_get_cache_key(notebook_id): notebook_id for notebook_id in notebook_ids}
+    return {keys[key]: draft for (key, draft) in _get_cache().get_many(keys).items()}
+
+
+def apply_buffered_draft(revision):
+    """
+    Replaces the title and content of a revision (which may be None) by those
+    buffered for it, if any, and returns it
+
+    Without `NOTEBOOK_REVISION_WRITE_BEHIND`, the buffer isn't looked up at
+    all: drafts left over from when it was enabled are only seen once they
+    are written.
+    """
+    if revision is not None and settings.NOTEBOOK_REVISION_WRITE_BEHIND:
+        draft = _get_cache().get(_get_cache_key(revision.notebook_id))
+        if draft is not None and draft["revision_id"] == revision.id:
+            revision.title = draft["title"]
+            revision.content = draft["content"]
+    return revision
+
+
+def discard_buffered_draft(notebook_id):
+    _get_cache().delete(_get_cache_key(notebook_id))
+
+
+def flush_buffered_draft(notebook_id):
+    """
+    Writes the buffered draft of a notebook, if any, to its revision, returning
+    whether there was one
+    """
+    draft = _get_cache().get(_get_cache_key(notebook_id))
+    if draft is None:
+        return False
+    try:
+        revision = NotebookRevision.objects.get(id=draft["revision_id"], notebook_id=notebook_id)
+    except NotebookRevision.DoesNotExist:
+        # the revision was deleted since
+        revision = None
+    if revision is not None:
+        revision.title = draft["title"]
+        revision.content = draft["content"]
+        revision.save()
+    discard_buffered_draft(notebook_id)
+    return revision is not None
@@ -0,0 +1,28 @@
+"""
+Per-notebook locks on revision history
+
+Appending a revision (after checking it is based on the latest one) and
+cleaning up a notebook's revisions take a Postgres advisory lock on the
+notebook, held until the end of the current transaction, so that they never
+run concurrently for the same notebook.
+"""
+
+from django.db import connection
+
+# the first key of the advisory locks, keeping them apart from any other use
+# of advisory locks on the same database
+REVISIONS_LOCK_CLASS = 1
+
+
+def lock_notebook_revisions(notebook_id, wait=True):
+    """
+    Locks the revision history of a notebook until the end of the current
+    transaction, returning whether the lock was taken (which, unless `wait`
+    is false, it always is once any other holder releases it)
+    """
+    function = "pg_advisory_xact_lock" if wait else "pg_try_advisory_xact_lock"
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {function}(%s, %s)", [REVISIONS_LOCK_CLASS, notebook_id])
+        acquired = cursor.fetchone()[0]
+    # pg_advisory_xact_lock returns nothing once the lock is taken
+    return acquired is not False
@@ -0,0 +1,89 @@
+import difflib
+import json
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...patches import apply_patch, get_content_hash
+
+
+def unified_diff(original, modified):
+    lines = []
+    for line in difflib.unified_diff(
+        original.splitlines(keepends=True), modified.splitlines(keepends=True)
+    ):
+        lines.append(line if line.endswith("\n") else f"{line}\n\\ No newline at end of file\n")
+    return "".join(lines)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the size of revision uploads, and the server CPU time spent on them, when "
+        "sending small edits to a notebook as patches rather than as full content"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size", type=int, default=1024 * 1024, help="Size of the notebook content"
+        )
+        parser.add_argument("--edits", type=int, default=200, help="Number of edits to upload")
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        lines = [
+            " ".join(
+                "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(1, 10)))
+                for _ in range(rng.randint(0, 12))
+            )
+            for _ in range(options["size"] // 40)
+        ]
+
+        full_bytes = patch_bytes = 0
+        full_time = patch_time = 0
+        for i in range(options["edits"]):
+            original = "\n".join(lines)
+            # a typical autosave: a few characters typed, or a line added or
+            # removed, somewhere in the notebook
+            position = rng.randrange(len(lines))
+            edit = rng.random()
+            if edit < 0.8:
+                lines[position] += rng.choice(string.ascii_lowercase)
+            elif edit < 0.9:
+                lines.insert(position, f"edit {i}")
+            else:
+                del lines[position]
+            content = "\n".join(lines)
+
+            full_body = json.dumps({"title": "Benchmark", "content": content})
+            patch_body = json.dumps(
+                {
+                    "title": "Benchmark",
+                    "patch": unified_diff(original, content),
+                    "content_hash": get_content_hash(content),
+                }
+            )
+            full_bytes += len(full_body.encode("utf-8"))
+            patch_bytes += len(patch_body.encode("utf-8"))
+
+            # what the server does with each body, besides saving the content
+            start = time.process_time()
+            json.loads(full_body)
+            full_time += time.process_time() - start
+            start = time.process_time()
+            data = json.loads(patch_body)
+            patched = apply_patch(original, data["patch"])
+            assert get_content_hash(patched) == data["content_hash"]
+            patch_time += time.process_time() - start
+
+        edits = options["edits"]
+        for name, total_bytes, total_time in (
+            ("full content", full_bytes, full_time),
+            ("patch", patch_bytes, patch_time),
+        ):
+            self.stdout.write(
+                "{}: {:.1f} kB per request, {:.2f} ms of CPU per request".format(
+                    name, total_bytes / edits / 1024, total_time / edits * 1000
+                )
+            )
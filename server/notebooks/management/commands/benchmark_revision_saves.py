@@ -0,0 +1,118 @@
+import datetime
+import random
+import string
+from unittest.mock import patch
+
+import pytz
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ....base.models import User
+from ...api_views import NotebookRevisionViewSet
+from ...models import Notebook, NotebookRevision
+from ...tasks import execute_notebook_revisions_cleanup
+
+STATS_SQL = """
+SELECT n_tup_ins, n_tup_upd, n_tup_hot_upd, n_tup_del,
+    pg_wal_lsn_diff(pg_current_wal_insert_lsn(), '0/0')
+FROM pg_stat_xact_user_tables WHERE relid = %s::regclass
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure the rows of the revision table written (and the WAL generated) as an "
+        "editing session autosaves a notebook, with and without coalescing drafts (in a "
+        "transaction which is rolled back)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--saves", type=int, default=600, help="Number of autosaves")
+        parser.add_argument("--interval", type=float, default=2, help="Seconds between autosaves")
+        parser.add_argument(
+            "--size", type=int, default=20 * 1024, help="Size of the notebook content"
+        )
+
+    def handle(self, *args, **options):
+        for coalesce in (False, True):
+            with override_settings(NOTEBOOK_REVISION_COALESCE_DRAFTS=coalesce):
+                with transaction.atomic():
+                    stats = self.run(options["saves"], options["interval"], options["size"])
+                    transaction.set_rollback(True)
+            self.stdout.write(
+                "{}: {} revisions kept, {} inserts, {} updates ({} HOT), {} deletes, "
+                "{} dead rows left for vacuum, {} kB of WAL".format(
+                    "coalescing" if coalesce else "inserting",
+                    stats["revisions"],
+                    stats["inserts"],
+                    stats["updates"],
+                    stats["hot_updates"],
+                    stats["deletes"],
+                    stats["updates"] + stats["deletes"],
+                    int(stats["wal"]) // 1024,
+                )
+            )
+
+    def run(self, saves, interval, size):
+        user = User.objects.create(username="benchmark-revision-saves")
+        notebook = Notebook.objects.create(owner=user, title="Benchmark")
+        # random words, as repeated content would compress down to nothing
+        rng = random.Random(42)
+        content = " ".join(
+            "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(1, 10)))
+            for _ in range(size // 6)
+        )[:size]
+        revision = NotebookRevision.objects.create(
+            notebook=notebook, title="Benchmark", content=content, is_draft=False
+        )
+        factory = APIRequestFactory()
+        view = NotebookRevisionViewSet.as_view({"post": "create"})
+
+        # the cleanups scheduled by saves run straight away
+        def run_cleanup(task, notebook_id):
+            execute_notebook_revisions_cleanup(notebook_id, now)
+
+        start = datetime.datetime(2020, 1, 1, tzinfo=pytz.utc)
+        NotebookRevision.objects.filter(id=revision.id).update(
+            created=start - datetime.timedelta(days=1)
+        )
+        before = self.get_stats()
+        with patch("server.notebooks.api_views.is_queue_full", return_value=False), patch(
+            "server.notebooks.api_views.tasks.schedule", run_cleanup
+        ):
+            for i in range(saves):
+                now = start + datetime.timedelta(seconds=i * interval)
+                with patch("django.utils.timezone.now", return_value=now):
+                    request = factory.post(
+                        "/",
+                        {
+                            "title": "Benchmark",
+                            "content": f"{i:08d}" + content[8:],
+                            "parent_revision_id": revision.id,
+                        },
+                        format="json",
+                    )
+                    force_authenticate(request, user)
+                    response = view(request, notebook_id=notebook.id)
+                if response.status_code != 201:
+                    raise CommandError(f"Saving failed: {response.data}")
+                revision = NotebookRevision.objects.get(id=response.data["id"])
+        # once the drafts of the session's last window are cleaned up too
+        execute_notebook_revisions_cleanup(
+            notebook.id,
+            now + datetime.timedelta(seconds=settings.NOTEBOOK_REVISION_SAVE_INTERVAL_SECS),
+        )
+        after = self.get_stats()
+
+        stats = {key: after[key] - before[key] for key in after}
+        stats["revisions"] = NotebookRevision.objects.filter(notebook=notebook).count()
+        return stats
+
+    def get_stats(self):
+        with connection.cursor() as cursor:
+            cursor.execute(STATS_SQL, [NotebookRevision._meta.db_table])
+            row = cursor.fetchone()
+        return dict(zip(("inserts", "updates", "hot_updates", "deletes", "wal"), row))
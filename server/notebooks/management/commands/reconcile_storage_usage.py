@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from ...storage import reconcile_storage_bytes
+
+
+class Command(BaseCommand):
+    help = "Recompute the storage used by each notebook and user, correcting any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            dest="batch_size",
+            type=int,
+            default=500,
+            help="Number of notebooks (or users) to update per statement",
+        )
+
+    def handle(self, *args, **options):
+        reconcile_storage_bytes(options["batch_size"])
+        self.stdout.write("Storage usage reconciled")
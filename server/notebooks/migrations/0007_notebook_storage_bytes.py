@@ -0,0 +1,18 @@
+# Generated by Django 3.0.7 on 2026-10-19 17:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notebooks', '0006_notebookrevision_is_draft'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notebook',
+            name='storage_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
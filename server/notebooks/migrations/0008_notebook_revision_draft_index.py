@@ -0,0 +1,17 @@
+# Generated by Django 3.0.7 on 2026-10-19 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('notebooks', '0007_notebook_storage_bytes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='notebookrevision',
+            index=models.Index(fields=['is_draft', 'created'], name='notebook_revision_draft'),
+        ),
+    ]
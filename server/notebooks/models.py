@@ -1,9 +1,41 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import F, Func, Sum
 from django.urls import reverse
 
 from server.base.models import User
 
 
+class OctetLength(Func):
+    """
+    The size in bytes of a text or binary column
+    """
+
+    function = "OCTET_LENGTH"
+    output_field = models.BigIntegerField()
+
+
+class NotebookQuerySet(models.QuerySet):
+    def delete(self):
+        """
+        Deletes the notebooks, taking the storage they used off their owners'
+        counters with one update per owner (rather than one per revision or
+        file deleted along with them)
+        """
+        with transaction.atomic():
+            owner_storage_bytes = list(
+                self.order_by()
+                .values("owner_id")
+                .annotate(size=Sum("storage_bytes"))
+                .values_list("owner_id", "size")
+            )
+            result = super().delete()
+            for owner_id, size in owner_storage_bytes:
+                if size:
+                    User.objects.filter(id=owner_id).update(storage_bytes=F("storage_bytes") - size)
+        return result
+
+
 class Notebook(models.Model):
     """
     The basic notebook model
@@ -19,6 +51,25 @@ class Notebook(models.Model):
     forked_from = models.ForeignKey(
         "NotebookRevision", on_delete=models.SET_NULL, null=True, blank=True, related_name="fork"
     )
+    # bytes used by the content of the notebook's revisions and files, kept
+    # up to date as they are written and deleted
+    storage_bytes = models.BigIntegerField(default=0)
+
+    objects = NotebookQuerySet.as_manager()
+
+    @classmethod
+    def update_storage_bytes(cls, notebook_id, delta):
+        """
+        Adds `delta` bytes to the storage used by a notebook and its owner
+        """
+        if delta:
+            cls.objects.filter(id=notebook_id).update(storage_bytes=F("storage_bytes") + delta)
+            User.objects.filter(notebook__id=notebook_id).update(
+                storage_bytes=F("storage_bytes") + delta
+            )
+
+    def delete(self, *args, **kwargs):
+        return type(self).objects.filter(pk=self.pk).delete()
 
     def __str__(self):  # pragma: no cover
         return self.title
@@ -33,7 +84,78 @@ class Notebook(models.Model):
         db_table = "notebook"
 
 
-class NotebookRevision(models.Model):
+class NotebookContentQuerySet(models.QuerySet):
+    def delete(self):
+        """
+        Deletes the rows, taking the size of their content (computed by the
+        database, without loading it) off their notebooks' storage counters
+        """
+        with transaction.atomic():
+            notebook_sizes = list(
+                self.order_by()
+                .values("notebook_id")
+                .annotate(size=Sum(OctetLength("content")))
+                .values_list("notebook_id", "size")
+            )
+            result = super().delete()
+            for notebook_id, size in notebook_sizes:
+                Notebook.update_storage_bytes(notebook_id, -(size or 0))
+        return result
+
+
+class NotebookContentModel(models.Model):
+    """
+    Base class for models with a `content` that counts towards the storage
+    used by a notebook
+
+    Saving or deleting an instance, or deleting a queryset of them, updates
+    the storage counters in the same transaction. Rows deleted along with
+    their notebook are not counted one by one: the notebook's whole usage is
+    taken off its owner's counter instead (see `NotebookQuerySet.delete`).
+    """
+
+    objects = NotebookContentQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    @staticmethod
+    def get_content_size(content):
+        """
+        Returns the size in bytes of some content (text being stored as UTF-8)
+        """
+        return len(content.encode("utf-8") if isinstance(content, str) else content)
+
+    @property
+    def content_size(self):
+        return self.get_content_size(self.content)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if "content" in self.get_deferred_fields() or (
+            update_fields is not None and "content" not in update_fields
+        ):
+            return super().save(*args, **kwargs)
+
+        with transaction.atomic():
+            previous_size = 0
+            if not self._state.adding:
+                previous_size = (
+                    type(self)
+                    .objects.filter(pk=self.pk)
+                    .annotate(size=OctetLength("content"))
+                    .values_list("size", flat=True)
+                    .first()
+                    or 0
+                )
+            super().save(*args, **kwargs)
+            Notebook.update_storage_bytes(self.notebook_id, self.content_size - previous_size)
+
+    def delete(self, *args, **kwargs):
+        return type(self).objects.filter(pk=self.pk).delete()
+
+
+class NotebookRevision(NotebookContentModel):
     """
     A revision of a specific notebook
     """
@@ -45,12 +167,21 @@ class NotebookRevision(models.Model):
     content = models.TextField(blank=True)
     is_draft = models.BooleanField()
 
+    def is_in_save_window(self, when):
+        """
+        Returns whether the revision was created in the same
+        `NOTEBOOK_REVISION_SAVE_INTERVAL_SECS` window as `when`
+        """
+        interval = settings.NOTEBOOK_REVISION_SAVE_INTERVAL_SECS
+        return int(self.created.timestamp()) // interval == int(when.timestamp()) // interval
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
-        # update notebook's title to be that of this new revision's
+        # update notebook's title to be that of this new revision's (only
+        # saving the title, so as not to overwrite the storage counters)
         self.notebook.title = self.title
-        self.notebook.save()
+        self.notebook.save(update_fields=["title"])
 
     def __str__(self):  # pragma: no cover
         return self.title
@@ -60,3 +191,5 @@ class NotebookRevision(models.Model):
         verbose_name_plural = "Notebook Revisions"
         ordering = ("-created",)
         db_table = "notebook_revision"
+        # for finding notebooks with stale drafts to clean up
+        indexes = [models.Index(fields=["is_draft", "created"], name="notebook_revision_draft")]
@@ -0,0 +1,124 @@
+"""
+Application of patches to revision content
+
+Clients may save a revision as a unified diff against its parent revision
+(as produced by `diff -u`, or jsdiff's `createPatch`) rather than as its full
+content, along with the md5 digest of the content it should result in, so
+that small edits to large notebooks don't mean uploading all of it again.
+Patches must apply exactly: there is no fuzz, nor any search for moved
+context.
+"""
+
+import hashlib
+import re
+
+HUNK_HEADER = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+LINE_SEARCH_CHUNK_SIZE = 4096
+
+
+class PatchError(ValueError):
+    pass
+
+
+def get_content_hash(content):
+    return hashlib.md5(content.encode("utf-8")).hexdigest()
+
+
+def _split_lines(text):
+    """
+    Splits text into lines, keeping their line feeds (unlike
+    `str.splitlines`, only on line feeds, as diffs do)
+    """
+    lines = [f"{line}\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    return lines if lines[-1] else lines[:-1]
+
+
+def _parse_hunks(patch):
+    """
+    Yields the start line (from 0) in the original text, the removed and the
+    added lines (both including context lines) of each hunk of a patch
+    """
+    patch_lines = _split_lines(patch)
+    i = 0
+    # skip any header (file names, index lines...) before the first hunk
+    while i < len(patch_lines) and not patch_lines[i].startswith("@@"):
+        i += 1
+    while i < len(patch_lines):
+        match = HUNK_HEADER.match(patch_lines[i])
+        if not match:
+            raise PatchError(f"Invalid hunk header: {patch_lines[i].rstrip()}")
+        old_start, old_count, _, new_count = (
+            int(group) if group is not None else 1 for group in match.groups()
+        )
+        i += 1
+
+        old_lines, new_lines = [], []
+        while i < len(patch_lines) and not patch_lines[i].startswith("@@"):
+            op, text = patch_lines[i][:1], patch_lines[i][1:]
+            if i + 1 < len(patch_lines) and patch_lines[i + 1].startswith("\\"):
+                # "\ No newline at end of file"
+                text = text[:-1] if text.endswith("\n") else text
+            if op in (" ", "-"):
+                old_lines.append(text)
+            if op in (" ", "+"):
+                new_lines.append(text)
+            elif op not in ("-", "\\"):
+                raise PatchError(f"Invalid patch line: {patch_lines[i].rstrip()}")
+            i += 1
+        if (len(old_lines), len(new_lines)) != (old_count, new_count):
+            raise PatchError(f"Hunk at line {old_start} doesn't match its line counts")
+
+        # hunks which only add lines start after the given line
+        yield (old_start - 1 if old_count else old_start), old_lines, new_lines
+
+
+def _skip_lines(content, offset, count):
+    """
+    Returns the offset of the line `count` lines after the one at `offset`,
+    or None if there aren't as many
+    """
+    # count line feeds a chunk at a time (which is much faster than looking
+    # for them one by one) until the chunk holding the line is found
+    while count:
+        end = offset + LINE_SEARCH_CHUNK_SIZE
+        line_feeds = content.count("\n", offset, end)
+        if line_feeds >= count or end >= len(content):
+            break
+        count -= line_feeds
+        offset = end
+    for _ in range(count):
+        offset = content.find("\n", offset)
+        if offset == -1:
+            return None
+        offset += 1
+    return offset
+
+
+def apply_patch(content, patch):
+    """
+    Returns the result of applying a unified diff to some content, raising a
+    `PatchError` if it doesn't apply
+    """
+    result = []
+    line = offset = 0
+    for start, old_lines, new_lines in _parse_hunks(patch):
+        hunk_offset = _skip_lines(content, offset, start - line) if start >= line else None
+        old_text = "".join(old_lines)
+        if (
+            hunk_offset is None
+            or not content.startswith(old_text, hunk_offset)
+            # the last line removed must end where a line does
+            or not (
+                old_text.endswith("\n")
+                or hunk_offset + len(old_text) in (hunk_offset, len(content))
+            )
+        ):
+            raise PatchError(f"Hunk at line {start + 1} doesn't apply")
+        result.append(content[offset:hunk_offset])
+        result.extend(new_lines)
+        line = start + len(old_lines)
+        offset = hunk_offset + len(old_text)
+    result.append(content[offset:])
+    return "".join(result)
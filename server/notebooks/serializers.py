@@ -2,12 +2,13 @@ from rest_framework import serializers
 
 from server.base.models import User
 
+from .draft_buffer import apply_buffered_draft
 from .models import Notebook, NotebookRevision
 
 
 class NotebookLatestRevisionField(serializers.RelatedField):
     def get_attribute(self, obj):
-        return NotebookRevision.objects.filter(notebook_id=obj.id).first()
+        return apply_buffered_draft(NotebookRevision.objects.filter(notebook_id=obj.id).first())
 
     def to_representation(self, value):
         if value:
@@ -49,18 +50,40 @@ class NotebookRevisionSerializer(serializers.ModelSerializer):
 class NotebookRevisionDetailSerializer(serializers.ModelSerializer):
     """
     Details of a revision for a notebook (includes content)
+
+    When creating a revision, a `patch` to the content of its parent revision
+    may be given instead of its content, along with the `content_hash` of the
+    resulting content; it is applied (and checked) when saving.
     """
 
+    patch = serializers.CharField(
+        write_only=True, required=False, allow_blank=True, trim_whitespace=False
+    )
+    content_hash = serializers.CharField(write_only=True, required=False)
+
     def validate(self, attrs):
-        last_revision = NotebookRevision.objects.filter(
-            notebook_id=self.context["notebook_id"]
-        ).first()
+        if "patch" in attrs:
+            if "content" in attrs:
+                raise serializers.ValidationError("Either content or a patch can be given")
+            if "content_hash" not in attrs:
+                raise serializers.ValidationError("A patch needs the content_hash of its result")
+            if not self.initial_data.get("parent_revision_id"):
+                raise serializers.ValidationError("A patch needs a parent_revision_id")
+            return super().validate(attrs)
+        if "content" not in attrs:
+            raise serializers.ValidationError({"content": ["This field is required."]})
+        # only needed to check patches
+        attrs.pop("content_hash", None)
+
+        last_revision = apply_buffered_draft(
+            NotebookRevision.objects.filter(notebook_id=self.context["notebook_id"]).first()
+        )
         if attrs["title"] == last_revision.title and attrs["content"] == last_revision.content:
             raise serializers.ValidationError("Revision unchanged from previous")
         return super().validate(attrs)
 
     class Meta:
         model = NotebookRevision
-        fields = ("id", "title", "created", "content", "is_draft")
+        fields = ("id", "title", "created", "content", "is_draft", "patch", "content_hash")
         write_only_fields = "notebook_id"
         read_only_fields = ["is_draft"]
@@ -0,0 +1,73 @@
+from django.conf import settings
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from rest_framework.exceptions import PermissionDenied
+
+from ..base.models import User
+from ..files.models import File
+from .models import Notebook, NotebookRevision, OctetLength
+
+
+def check_storage_quota(notebook, size_delta):
+    """
+    Raises an error if adding `size_delta` bytes to a notebook would put it
+    (or its owner) over the configured storage quotas
+    """
+    if size_delta <= 0:
+        return
+    quota = settings.NOTEBOOK_STORAGE_QUOTA_BYTES
+    if quota and notebook.storage_bytes + size_delta > quota:
+        raise PermissionDenied(f"Notebook storage quota of {quota} bytes exceeded")
+    quota = settings.USER_STORAGE_QUOTA_BYTES
+    if quota and notebook.owner.storage_bytes + size_delta > quota:
+        raise PermissionDenied(f"User storage quota of {quota} bytes exceeded")
+
+
+def _sum_subquery(queryset, expression, group_by):
+    return Coalesce(
+        Subquery(
+            queryset.order_by().values(group_by).annotate(total=Sum(expression)).values("total")
+        ),
+        0,
+    )
+
+
+def _iter_id_batches(model, batch_size):
+    last_id = 0
+    while True:
+        ids = list(
+            model.objects.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def reconcile_storage_bytes(batch_size):
+    """
+    Recomputes the storage counters of every notebook and user from the
+    content they actually hold, one batch of rows (and one statement) at a
+    time so that no lock is held for long
+    """
+    for notebook_ids in _iter_id_batches(Notebook, batch_size):
+        Notebook.objects.filter(id__in=notebook_ids).update(
+            storage_bytes=_sum_subquery(
+                NotebookRevision.objects.filter(notebook_id=OuterRef("id")),
+                OctetLength("content"),
+                "notebook_id",
+            )
+            + _sum_subquery(
+                File.objects.filter(notebook_id=OuterRef("id")),
+                OctetLength("content"),
+                "notebook_id",
+            )
+        )
+    for user_ids in _iter_id_batches(User, batch_size):
+        User.objects.filter(id__in=user_ids).update(
+            storage_bytes=_sum_subquery(
+                Notebook.objects.filter(owner_id=OuterRef("id")), "storage_bytes", "owner_id"
+            )
+        )
@@ -2,12 +2,26 @@ from collections import defaultdict
 from datetime import datetime, timedelta
 
 import pytz
+from django.conf import settings
+from django.db import transaction
 from spinach import Tasks
 
-from ..settings import NOTEBOOK_REVISION_SAVE_INTERVAL_SECS
+from ..settings import (
+    NOTEBOOK_REVISION_BUFFER_FLUSH_INTERVAL,
+    NOTEBOOK_REVISION_BUFFER_TIMEOUT,
+    NOTEBOOK_REVISION_SAVE_INTERVAL_SECS,
+    NOTEBOOK_REVISION_WRITE_BEHIND,
+    NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY,
+    NOTEBOOK_REVISIONS_SWEEP_BATCH_SIZE,
+    NOTEBOOK_REVISIONS_SWEEP_INTERVAL,
+    NOTEBOOKS_TASK_QUEUE,
+)
+from ..task_queues import is_queue_full
+from .draft_buffer import flush_buffered_draft, get_buffered_drafts
+from .locks import lock_notebook_revisions
 from .models import NotebookRevision
 
-tasks = Tasks()
+tasks = Tasks(queue=NOTEBOOKS_TASK_QUEUE)
 
 
 @tasks.task(name="notebooks:execute_notebook_revisions_cleanup")
@@ -20,7 +34,18 @@ def execute_notebook_revisions_cleanup(notebook_id, now_utc=None):
 
     * Time window: This task groups draft revisions into fixed-size windows
       (also called Tumbling windows).
+
+    Nothing is done if the notebook's revisions are locked: either another
+    cleanup is already running, or a revision is being added, which schedules
+    a cleanup of its own.
     """
+    with transaction.atomic():
+        if lock_notebook_revisions(notebook_id, wait=False):
+            flush_buffered_draft(notebook_id)
+            _prune_notebook_revisions(notebook_id, now_utc)
+
+
+def _prune_notebook_revisions(notebook_id, now_utc):
     draft_revisions = NotebookRevision.objects.filter(notebook_id=notebook_id, is_draft=True)
     try:
         latest_non_draft_revision = NotebookRevision.objects.filter(
@@ -68,3 +93,92 @@ def execute_notebook_revisions_cleanup(notebook_id, now_utc=None):
     NotebookRevision.objects.filter(id__in=draft_revisions, created__lt=now_utc - threshold).update(
         is_draft=False
     )
+
+
+@tasks.task(name="notebooks:execute_notebook_revisions_cleanups")
+def execute_notebook_revisions_cleanups(notebook_ids, now_utc=None):
+    """Prune the revision history of a batch of notebooks."""
+    for notebook_id in notebook_ids:
+        execute_notebook_revisions_cleanup(notebook_id, now_utc)
+
+
+@tasks.task(
+    name="notebooks:sweep_notebook_revisions_cleanups",
+    periodicity=timedelta(seconds=NOTEBOOK_REVISIONS_SWEEP_INTERVAL),
+)
+def sweep_notebook_revisions_cleanups(now_utc=None):
+    """Schedule the cleanup of notebooks which still need it.
+
+    Cleanups are normally scheduled whenever a revision is saved, so drafts of
+    notebooks which stopped being edited (or whose cleanup was skipped while
+    the queue was too long) are never pruned. This finds notebooks with draft
+    revisions older than the window length, and schedules their cleanup in
+    batches of `NOTEBOOK_REVISIONS_SWEEP_BATCH_SIZE` notebooks, one batch
+    every `NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY` seconds, so that the sweep
+    never takes up the workers at once. Notebooks which don't fit before the
+    next sweep are left to it.
+    """
+    now_utc = now_utc or datetime.now(tz=pytz.utc)
+    threshold = timedelta(seconds=NOTEBOOK_REVISION_SAVE_INTERVAL_SECS)
+    max_batches = max(1, NOTEBOOK_REVISIONS_SWEEP_INTERVAL // NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY)
+    stale_notebook_ids = (
+        NotebookRevision.objects.filter(is_draft=True, created__lt=now_utc - threshold)
+        .order_by("notebook_id")
+        .values_list("notebook_id", flat=True)
+        .distinct()
+    )
+
+    last_notebook_id = 0
+    for batch in range(max_batches):
+        if is_queue_full(NOTEBOOKS_TASK_QUEUE):
+            return
+        notebook_ids = list(
+            stale_notebook_ids.filter(notebook_id__gt=last_notebook_id)[
+                :NOTEBOOK_REVISIONS_SWEEP_BATCH_SIZE
+            ]
+        )
+        if not notebook_ids:
+            return
+        tasks.schedule_at(
+            execute_notebook_revisions_cleanups,
+            now_utc + timedelta(seconds=batch * NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY),
+            notebook_ids,
+        )
+        last_notebook_id = notebook_ids[-1]
+
+
+@tasks.task(
+    name="notebooks:flush_buffered_drafts",
+    periodicity=(
+        timedelta(seconds=NOTEBOOK_REVISION_BUFFER_FLUSH_INTERVAL)
+        if NOTEBOOK_REVISION_WRITE_BEHIND
+        else None
+    ),
+)
+def flush_buffered_drafts(now_utc=None):
+    """Write the drafts buffered by autosaves to their revisions.
+
+    Buffered drafts always belong to a draft revision created no earlier than
+    the buffer's timeout (plus a window) ago. Notebooks whose revisions are
+    locked are left to the next run.
+
+    This only runs (periodically) with `NOTEBOOK_REVISION_WRITE_BEHIND`:
+    otherwise, drafts left over from when it was enabled are written before
+    their notebook's revisions are cleaned up.
+    """
+    if not settings.NOTEBOOK_REVISION_WRITE_BEHIND:
+        return
+    now_utc = now_utc or datetime.now(tz=pytz.utc)
+    horizon = timedelta(
+        seconds=NOTEBOOK_REVISION_BUFFER_TIMEOUT + NOTEBOOK_REVISION_SAVE_INTERVAL_SECS
+    )
+    notebook_ids = (
+        NotebookRevision.objects.filter(is_draft=True, created__gte=now_utc - horizon)
+        .order_by("notebook_id")
+        .values_list("notebook_id", flat=True)
+        .distinct()
+    )
+    for notebook_id in get_buffered_drafts(notebook_ids):
+        with transaction.atomic():
+            if lock_notebook_revisions(notebook_id, wait=False):
+                flush_buffered_draft(notebook_id)
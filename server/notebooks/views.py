@@ -16,6 +16,7 @@ from django.views.decorators.http import require_http_methods
 from ..base.models import User
 from ..files.models import File
 from ..views import get_base_page_info_dict, get_user_info_dict
+from .draft_buffer import apply_buffered_draft
 from .models import Notebook, NotebookRevision
 from .names import get_random_compound
 
@@ -48,6 +49,7 @@ def notebook_view(request, pk):
     else:
         revision = notebook.revisions.first()
         latest_revision_id = revision.id
+    apply_buffered_draft(revision)
 
     notebook_info = {
         "username": notebook.owner.username,
@@ -44,7 +44,7 @@ class OpenIDCAuthMiddleware(object):
             if not user.email:
                 with transaction.atomic():
                     user.email = openidc_email
-                    user.save()
+                    user.save(update_fields=["email"])
         except self.User.DoesNotExist:
             user = self.User(username=openidc_email, email=openidc_email)
             with transaction.atomic():
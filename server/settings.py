@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/2.0/ref/settings/
 """
 
+import datetime
 import os
 import re
 
@@ -52,6 +53,9 @@ IODIDE_REDIRECTS = env("IODIDE_REDIRECTS", default="")
 # Dockerflow
 DOCKERFLOW_ENABLED = env.bool("DOCKERFLOW_ENABLED", default=False)
 
+# Expose Prometheus-style metrics under /__metrics__
+METRICS_ENABLED = env.bool("METRICS_ENABLED", default=False)
+
 # Social auth
 SOCIAL_AUTH_GITHUB_KEY = env.str("GITHUB_CLIENT_ID", None)
 SOCIAL_AUTH_GITHUB_SECRET = env.str("GITHUB_CLIENT_SECRET", None)
@@ -71,6 +75,99 @@ GA_TRACKING_ID = env.str("GA_TRACKING_ID", None)
 MAX_FILENAME_LENGTH = 120
 MAX_FILE_SIZE = 1024 * 1024 * 10  # 10 megabytes is the default
 
+# API request bodies can be sent compressed (with gzip, deflate or, if the
+# zstandard package is installed, zstd), but are refused if they decompress to
+# more than this
+REQUEST_BODY_MAX_DECOMPRESSED_SIZE = env.int(
+    "REQUEST_BODY_MAX_DECOMPRESSED_SIZE", default=MAX_FILE_SIZE * 2
+)
+
+# Limits for the file preview endpoint (first rows of text files, or first
+# bytes of binary ones)
+FILE_PREVIEW_DEFAULT_ROWS = 20
+FILE_PREVIEW_MAX_ROWS = 1000
+FILE_PREVIEW_MAX_BYTES = 1024 * 64
+FILE_PREVIEW_CHUNK_SIZE = 1024 * 16
+FILE_PREVIEW_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Storage quotas, in bytes of revision and file content (0 means unlimited).
+# Usage is tracked as content is written; run the `reconcile_storage_usage`
+# management command to recompute it from scratch
+NOTEBOOK_STORAGE_QUOTA_BYTES = env.int("NOTEBOOK_STORAGE_QUOTA_BYTES", default=0)
+USER_STORAGE_QUOTA_BYTES = env.int("USER_STORAGE_QUOTA_BYTES", default=0)
+
+# Budget for the per-process cache of frequently served file contents (0
+# disables the cache)
+FILE_CONTENT_CACHE_MAX_BYTES = env.int("FILE_CONTENT_CACHE_MAX_BYTES", default=0)
+
+# Limits for refreshing file sources: scheduled refreshes are fetched in
+# batches, with up to FILE_FETCH_CONCURRENCY requests in flight per batch (and
+# up to FILE_FETCH_PER_HOST_CONCURRENCY to the same host). Timeouts are in
+# seconds. Downloads are streamed (and written to the database) in chunks of
+# FILE_FETCH_CHUNK_SIZE bytes
+FILE_FETCH_BATCH_SIZE = env.int("FILE_FETCH_BATCH_SIZE", default=100)
+FILE_FETCH_CONCURRENCY = env.int("FILE_FETCH_CONCURRENCY", default=20)
+FILE_FETCH_PER_HOST_CONCURRENCY = env.int("FILE_FETCH_PER_HOST_CONCURRENCY", default=4)
+FILE_FETCH_TIMEOUT = env.int("FILE_FETCH_TIMEOUT", default=30)
+FILE_FETCH_CHUNK_SIZE = env.int("FILE_FETCH_CHUNK_SIZE", default=1024 * 1024)
+# Fetches are recorded in metrics labelled by host, for the first
+# FILE_FETCH_METRICS_MAX_HOSTS hosts seen by each process (and as "other" past
+# that)
+FILE_FETCH_METRICS_MAX_HOSTS = env.int("FILE_FETCH_METRICS_MAX_HOSTS", default=100)
+
+# How often (in seconds) the scheduler polls for file sources due for a
+# refresh. Each source is refreshed at a stable offset within its update
+# interval, so that refreshes are spread out rather than all run at once
+FILE_SOURCE_SCHEDULER_INTERVAL = env.int("FILE_SOURCE_SCHEDULER_INTERVAL", default=60)
+
+# How long (in seconds) the content downloaded from a url is reused for other
+# file sources pointing at the same url, rather than downloaded again (0
+# disables sharing across jobs). This should be shorter than the minimum update
+# interval (an hour)
+FILE_FETCH_CACHE_TIMEOUT = env.int("FILE_FETCH_CACHE_TIMEOUT", default=10 * 60)
+
+# Refreshes failing for transient reasons (timeouts, connection errors, 429
+# and 5xx responses) are retried up to FILE_FETCH_MAX_ATTEMPTS times in all,
+# with an exponential backoff (with jitter) starting at
+# FILE_FETCH_RETRY_BASE_DELAY seconds. No more than FILE_FETCH_RETRY_BUDGET
+# operations may be waiting for a retry at once, so that an outage upstream
+# doesn't snowball into a flood of retries
+FILE_FETCH_MAX_ATTEMPTS = env.int("FILE_FETCH_MAX_ATTEMPTS", default=4)
+FILE_FETCH_RETRY_BASE_DELAY = env.int("FILE_FETCH_RETRY_BASE_DELAY", default=30)
+FILE_FETCH_RETRY_MAX_DELAY = env.int("FILE_FETCH_RETRY_MAX_DELAY", default=60 * 60)
+FILE_FETCH_RETRY_BUDGET = env.int("FILE_FETCH_RETRY_BUDGET", default=100)
+
+# Progress of file source downloads is published to the cache at most every
+# FILE_UPDATE_PROGRESS_INTERVAL seconds, which is how often clients should poll
+# it
+FILE_UPDATE_PROGRESS_INTERVAL = env.float("FILE_UPDATE_PROGRESS_INTERVAL", default=1)
+
+# Pending or running update operations are reclaimed once stuck for longer than
+# FILE_UPDATE_OPERATION_STALE_TIMEOUT seconds (e.g. because the worker running
+# them died, or their job was lost): running ones are marked as failed, and
+# pending ones queued again. This must be longer than a whole batch of
+# refreshes can take
+FILE_UPDATE_OPERATION_STALE_TIMEOUT = env.int(
+    "FILE_UPDATE_OPERATION_STALE_TIMEOUT", default=30 * 60
+)
+
+# History kept for each file source: the latest
+# FILE_UPDATE_OPERATION_RETENTION_COUNT update operations, plus any failed in
+# the last FILE_UPDATE_OPERATION_FAILURE_RETENTION_DAYS days. Older ones are
+# deleted every FILE_UPDATE_OPERATION_PRUNE_INTERVAL seconds, at most
+# FILE_UPDATE_OPERATION_PRUNE_BATCH_SIZE rows at a time (a count of 0 keeps
+# the whole history)
+FILE_UPDATE_OPERATION_RETENTION_COUNT = env.int("FILE_UPDATE_OPERATION_RETENTION_COUNT", default=10)
+FILE_UPDATE_OPERATION_FAILURE_RETENTION_DAYS = env.int(
+    "FILE_UPDATE_OPERATION_FAILURE_RETENTION_DAYS", default=30
+)
+FILE_UPDATE_OPERATION_PRUNE_INTERVAL = env.int(
+    "FILE_UPDATE_OPERATION_PRUNE_INTERVAL", default=60 * 60
+)
+FILE_UPDATE_OPERATION_PRUNE_BATCH_SIZE = env.int(
+    "FILE_UPDATE_OPERATION_PRUNE_BATCH_SIZE", default=1000
+)
+
 # Maximum length of file source URL
 MAX_FILE_SOURCE_URL_LENGTH = 8192
 
@@ -116,6 +213,7 @@ MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.middleware.gzip.GZipMiddleware",
+    "server.base.middleware.RequestDecompressionMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -249,5 +347,48 @@ REDIS_HOST = env.str("REDIS_HOST", default="redis")
 REDIS_URL = env.str("REDIS_URL", default=f"redis://{REDIS_HOST}:6379/1")
 SPINACH_BROKER = RedisBroker(redis.from_url(REDIS_URL, **recommended_socket_opts))
 
+# Background tasks are split between queues, each consumed by its own pool of
+# workers (started with `./manage.py run_worker <queue>`), so that slow file
+# source downloads can't hold up the cleanup of notebook revisions
+NOTEBOOKS_TASK_QUEUE = "notebooks"
+FILES_TASK_QUEUE = "files"
+TASK_QUEUE_WORKER_THREADS = {
+    NOTEBOOKS_TASK_QUEUE: env.int("NOTEBOOKS_WORKER_THREADS", default=4),
+    FILES_TASK_QUEUE: env.int("FILES_WORKER_THREADS", default=8),
+}
+# The tasks of spinach's Django app run on the notebooks queue (nothing consumes
+# spinach's default queue), expired sessions being cleared once a day
+SPINACH_CLEAR_SESSIONS_PERIODICITY = datetime.timedelta(days=1)
+# Past this many jobs waiting in a queue (0 for no limit), revision cleanups
+# are left to the periodic sweep (run every NOTEBOOK_REVISIONS_SWEEP_INTERVAL
+# seconds), and scheduled file source refreshes wait for workers to catch up
+TASK_QUEUE_MAX_DEPTH = {
+    NOTEBOOKS_TASK_QUEUE: env.int("NOTEBOOKS_QUEUE_MAX_DEPTH", default=1000),
+    FILES_TASK_QUEUE: env.int("FILES_QUEUE_MAX_DEPTH", default=100),
+}
+NOTEBOOK_REVISIONS_SWEEP_INTERVAL = env.int("NOTEBOOK_REVISIONS_SWEEP_INTERVAL", default=5 * 60)
+# The sweep schedules the cleanup of notebooks with stale drafts in batches of
+# this many notebooks, one batch every NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY
+# seconds
+NOTEBOOK_REVISIONS_SWEEP_BATCH_SIZE = env.int("NOTEBOOK_REVISIONS_SWEEP_BATCH_SIZE", default=50)
+NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY = env.int("NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY", default=10)
+
+# Workers serve their metrics (if METRICS_ENABLED) on this port (0 disables it)
+WORKER_METRICS_PORT = env.int("WORKER_METRICS_PORT", default=0)
+
+CACHES = {"default": env.cache("CACHE_URL", default=f"rediscache://{REDIS_HOST}:6379/2")}
+
 # Spacing for permanently-saved notebook revisions
 NOTEBOOK_REVISION_SAVE_INTERVAL_SECS = 60
+# Whether saving a revision overwrites the latest one, if it is a draft from
+# the same save interval, instead of adding a revision the cleanup would delete
+NOTEBOOK_REVISION_COALESCE_DRAFTS = env.bool("NOTEBOOK_REVISION_COALESCE_DRAFTS", default=False)
+# Whether such saves only store the draft in a cache (which must not evict
+# keys before they expire) to write it to the database later: at least every
+# NOTEBOOK_REVISION_BUFFER_FLUSH_INTERVAL seconds, if workers keep up
+NOTEBOOK_REVISION_WRITE_BEHIND = env.bool("NOTEBOOK_REVISION_WRITE_BEHIND", default=False)
+NOTEBOOK_REVISION_BUFFER_CACHE = env.str("NOTEBOOK_REVISION_BUFFER_CACHE", default="default")
+NOTEBOOK_REVISION_BUFFER_TIMEOUT = env.int("NOTEBOOK_REVISION_BUFFER_TIMEOUT", default=24 * 60 * 60)
+NOTEBOOK_REVISION_BUFFER_FLUSH_INTERVAL = env.int(
+    "NOTEBOOK_REVISION_BUFFER_FLUSH_INTERVAL", default=10
+)
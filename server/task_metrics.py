@@ -0,0 +1,84 @@
+"""
+Metrics and logs on the background tasks run by this process
+
+For each job, workers record how long it waited from the time it was due to
+the time it started, how long it ran, how it ended (succeeded, retried or
+failed) and the type of any exception it raised, and log a line summing it up.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+
+from spinach import signals
+from spinach.contrib.spinachd.apps import spin
+from spinach.job import JobStatus
+
+from .metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
+
+TASK_DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+
+queue_latency = Histogram(
+    "iodide_task_queue_latency_seconds",
+    "Time jobs waited between being due and starting, by task",
+    ["task"],
+    buckets=TASK_DURATION_BUCKETS,
+)
+run_time = Histogram(
+    "iodide_task_run_time_seconds",
+    "Time taken to run jobs, by task",
+    ["task"],
+    buckets=TASK_DURATION_BUCKETS,
+)
+jobs = Counter(
+    "iodide_task_jobs_total",
+    "Jobs run, by task and outcome (succeeded, retried or failed)",
+    ["task", "outcome"],
+)
+exceptions = Counter(
+    "iodide_task_exceptions_total",
+    "Exceptions raised by jobs, by task and type",
+    ["task", "exception"],
+)
+
+OUTCOMES = {JobStatus.SUCCEEDED: "succeeded", JobStatus.FAILED: "failed"}
+
+# the job running in the current worker thread
+_current = threading.local()
+
+
+@signals.job_started.connect_via(spin.namespace)
+def job_started(namespace, job=None, **kwargs):
+    _current.started_at = time.monotonic()
+    _current.queue_latency = max((datetime.now(timezone.utc) - job.at).total_seconds(), 0)
+    _current.exception = None
+    queue_latency.observe(_current.queue_latency, task=job.task_name)
+
+
+@signals.job_schedule_retry.connect_via(spin.namespace)
+@signals.job_failed.connect_via(spin.namespace)
+def job_errored(namespace, job=None, err=None, **kwargs):
+    _current.exception = type(err).__name__
+    exceptions.inc(task=job.task_name, exception=_current.exception)
+
+
+@signals.job_finished.connect_via(spin.namespace)
+def job_finished(namespace, job=None, **kwargs):
+    duration = time.monotonic() - _current.started_at
+    # jobs to be retried go back to being unscheduled
+    outcome = OUTCOMES.get(job.status, "retried")
+    run_time.observe(duration, task=job.task_name)
+    jobs.inc(task=job.task_name, outcome=outcome)
+    logger.info(
+        "task=%s job=%s outcome=%s queue_latency=%.3f run_time=%.3f retries=%s exception=%s",
+        job.task_name,
+        job.id,
+        outcome,
+        _current.queue_latency,
+        duration,
+        job.retries,
+        _current.exception,
+    )
@@ -0,0 +1,48 @@
+"""
+Backpressure for the background task queues
+
+When workers fall behind, scheduling more jobs only makes their queue grow, so
+callers check its depth first and, past `TASK_QUEUE_MAX_DEPTH`, defer the work
+(e.g. to a periodic task) instead.
+"""
+
+from django.conf import settings
+from spinach import RedisBroker
+from spinach.contrib.spinachd.tasks import tasks as spinachd_tasks
+
+from .metrics import Counter, Gauge
+
+queue_depth = Gauge("iodide_task_queue_depth", "Jobs waiting in each task queue", ["queue"])
+deferred_jobs = Counter(
+    "iodide_task_deferred_jobs_total", "Jobs not scheduled because their queue was full", ["task"]
+)
+
+
+def get_queue_depth(queue):
+    """
+    Returns the number of jobs waiting in a queue (not counting those
+    scheduled to start later)
+    """
+    # spinach has no public API for this, so we look at its data structures
+    broker = settings.SPINACH_BROKER
+    if isinstance(broker, RedisBroker):
+        depth = broker._r.llen(broker._to_namespaced(queue))
+    else:
+        depth = broker._get_queue(queue).qsize()
+    queue_depth.set(depth, queue=queue)
+    return depth
+
+
+def is_queue_full(queue):
+    max_depth = settings.TASK_QUEUE_MAX_DEPTH.get(queue)
+    return bool(max_depth) and get_queue_depth(queue) >= max_depth
+
+
+def route_spinachd_tasks(queue):
+    """
+    Moves the tasks of spinach's Django app (sending emails and clearing
+    expired sessions) from spinach's default queue, which no worker pool
+    consumes, to one of ours
+    """
+    for task in spinachd_tasks.tasks.values():
+        task.queue = queue
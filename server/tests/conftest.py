@@ -3,6 +3,7 @@ import logging
 import time
 
 import pytest
+from django.core.cache import cache
 from rest_framework.test import APIClient
 from spinach.contrib.spinachd.apps import spin
 
@@ -34,6 +35,11 @@ def spinach_worker(request):
     request.addfinalizer(stop_workers)
 
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
 @pytest.fixture
 def api_client():
     """
@@ -3,3 +3,5 @@ from spinach import MemoryBroker
 from server.settings import *  # noqa
 
 SPINACH_BROKER = MemoryBroker()
+
+CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
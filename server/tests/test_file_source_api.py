@@ -1,9 +1,11 @@
 from datetime import timedelta
 
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
-from server.files.models import FileSource
+from server.files.models import FileSource, FileUpdateOperation
 
 
 @pytest.fixture
@@ -75,6 +77,34 @@ def test_list_file_sources_for_notebook_unauthorized(
     ]
 
 
+@pytest.mark.parametrize("logged_in", [True, False])
+def test_list_file_sources_query_count(client, test_notebook, fake_user, logged_in):
+    # the number of queries shouldn't depend on the number of file sources
+    if logged_in:
+        client.force_login(user=fake_user)
+    url = reverse("notebook-file-sources-list", kwargs={"notebook_id": test_notebook.id})
+    # the first request of a session does some extra bookkeeping
+    client.get(url)
+    query_counts = []
+    for i in range(2):
+        for j in range(5):
+            file_source = FileSource.objects.create(
+                notebook=test_notebook, filename=f"{i}-{j}.csv", url=f"https://iodide.io/{i}/{j}"
+            )
+            for status in [FileUpdateOperation.FAILED, FileUpdateOperation.COMPLETED]:
+                FileUpdateOperation.objects.create(file_source=file_source, status=status)
+        with CaptureQueriesContext(connection) as queries:
+            resp = client.get(url)
+        assert resp.status_code == 200
+        query_counts.append(len(queries))
+
+    assert query_counts[0] == query_counts[1]
+    latest_operations = [
+        file_source["latest_file_update_operation"]["status"] for file_source in resp.json()
+    ]
+    assert latest_operations == [FileUpdateOperation.COMPLETED] * 10
+
+
 def test_delete_file_source(client, test_file_source, fake_user):
     client.force_login(user=fake_user)
     resp = client.delete(reverse("file-sources-detail", kwargs={"pk": test_file_source.id}))
@@ -114,10 +144,12 @@ def test_create_file_source_invalid_interval(
 ):
     client.force_login(user=fake_user)
     resp = client.post(
-        reverse("file-sources-list"), {**file_source_post_blob, "update_interval": "1:00:00"}
+        reverse("file-sources-list"), {**file_source_post_blob, "update_interval": "0:30:00"}
     )
     assert resp.status_code == 400
-    assert resp.json() == {"update_interval": ['"1:00:00" is not a valid choice.']}
+    assert resp.json() == {
+        "update_interval": ["Ensure this value is greater than or equal to 1:00:00."]
+    }
     assert FileSource.objects.count() == 0
 
 
@@ -1,15 +1,42 @@
+import collections
 import datetime
+import hashlib
+import io
 import json
-from unittest.mock import call, patch
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import Mock, call, patch
 
 import pytest
+import requests
 import responses
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import IntegrityError, transaction
 from django.urls import reverse
 from django.utils import timezone
-from freezegun import freeze_time
+from django.utils.dateparse import parse_datetime
 
+from server.files.fetch_cache import fetches, normalize_url, saved_bytes, saved_fetches
+from server.files.fetcher import (
+    FetchJob,
+    fetch,
+    fetch_all,
+    fetch_bytes,
+    fetch_durations,
+    fetch_outcomes,
+)
 from server.files.models import File, FileSource, FileUpdateOperation
-from server.files.tasks import execute_file_update_operation, execute_scheduled_file_operations
+from server.files.progress import ProgressReporter, get_progress, set_progress
+from server.files.serializers import FileUpdateOperationSerializer
+from server.files.tasks import (
+    execute_file_update_operation,
+    execute_file_update_operations,
+    execute_scheduled_file_operations,
+    prune_file_update_operations,
+)
+from server.notebooks.models import Notebook
 
 
 @responses.activate
@@ -75,6 +102,118 @@ def test_execute_file_update_operation_file_too_big(settings, test_notebook, tes
     assert File.objects.count() == 0
 
 
+@responses.activate
+@pytest.mark.parametrize("file_exists", [True, False])
+def test_execute_file_update_operation_in_chunks(
+    settings, test_notebook, test_file_source, file_exists
+):
+    # the content is streamed and written in several chunks, but should end
+    # up whole (with storage usage accounted for)
+    settings.FILE_FETCH_CHUNK_SIZE = 4
+    if file_exists:
+        File.objects.create(
+            notebook_id=test_notebook.id, filename=test_file_source.filename, content=b"12345678"
+        )
+    initial_storage_bytes = Notebook.objects.get(id=test_notebook.id).storage_bytes
+    content = b"0123456789abcdefghij"
+    responses.add(responses.GET, test_file_source.url, body=content, stream=True)
+
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+    execute_file_update_operation(update_operation.id)
+
+    update_operation.refresh_from_db()
+    assert update_operation.status == FileUpdateOperation.COMPLETED
+    file = File.objects.get(notebook_id=test_notebook.id, filename=test_file_source.filename)
+    assert file.content.tobytes() == content
+    assert file.content_hash == hashlib.md5(content).hexdigest()
+    assert Notebook.objects.get(id=test_notebook.id).storage_bytes == initial_storage_bytes + (
+        len(content) - 8 if file_exists else len(content)
+    )
+
+
+@responses.activate
+def test_execute_file_update_operation_unchanged(test_notebook, test_file_source):
+    # content identical to what is already stored is not written again
+    content = b"1234"
+    original_file = File.objects.create(
+        notebook_id=test_notebook.id, filename=test_file_source.filename, content=content
+    )
+    initial_storage_bytes = Notebook.objects.get(id=test_notebook.id).storage_bytes
+    responses.add(responses.GET, test_file_source.url, body=content, stream=True)
+
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+    execute_file_update_operation(update_operation.id)
+
+    update_operation.refresh_from_db()
+    assert update_operation.status == FileUpdateOperation.COMPLETED
+    assert update_operation.outcome == FileUpdateOperation.UNCHANGED
+    file = File.objects.get(id=original_file.id)
+    assert file.last_updated == original_file.last_updated
+    assert file.content.tobytes() == content
+    assert Notebook.objects.get(id=test_notebook.id).storage_bytes == initial_storage_bytes
+
+
+def test_upsert_content_chunks(test_notebook):
+    chunks = [b"12", b"34"]
+    content_hash = hashlib.md5(b"".join(chunks)).hexdigest()
+    file_id = File.upsert_content_chunks(test_notebook.id, "test.csv", iter(chunks), content_hash)
+    file = File.objects.get(id=file_id)
+    assert (file.notebook_id, file.filename) == (test_notebook.id, "test.csv")
+    assert file.content.tobytes() == b"1234"
+    assert Notebook.objects.get(id=test_notebook.id).storage_bytes == (
+        file.content_size + test_notebook.revisions.get().content_size
+    )
+
+    # writing the same content again is a no-op, other content replaces it
+    assert File.upsert_content_chunks(test_notebook.id, "test.csv", [b"1234"], content_hash) is None
+    new_hash = hashlib.md5(b"56").hexdigest()
+    assert File.upsert_content_chunks(test_notebook.id, "test.csv", [b"56"], new_hash) == file_id
+    assert File.objects.get(id=file_id).content.tobytes() == b"56"
+    assert File.objects.count() == 1
+
+    # any bytes make it through, and empty chunks are skipped
+    content = bytes(range(256)) * 3
+    chunks = [b"", content[:100], b"", content[100:]]
+    new_hash = hashlib.md5(content).hexdigest()
+    assert File.upsert_content_chunks(test_notebook.id, "test.csv", chunks, new_hash) == file_id
+    assert File.objects.get(id=file_id).content.tobytes() == content
+    empty_hash = hashlib.md5(b"").hexdigest()
+    assert File.upsert_content_chunks(test_notebook.id, "test.csv", [], empty_hash) == file_id
+    assert File.objects.get(id=file_id).content.tobytes() == b""
+    assert Notebook.objects.get(id=test_notebook.id).storage_bytes == (
+        test_notebook.revisions.get().content_size
+    )
+
+
+@responses.activate
+@pytest.mark.parametrize("send_content_length", [True, False])
+def test_fetch_file_too_large_aborts_early(settings, send_content_length):
+    settings.MAX_FILE_SIZE = 10
+    settings.FILE_FETCH_CHUNK_SIZE = 4
+
+    class Body(io.RawIOBase):
+        bytes_sent = 0
+
+        def readable(self):
+            return True
+
+        def readinto(self, buffer):
+            # an endless stream of data, 4 bytes at a time
+            buffer[:4] = b"1234"
+            self.bytes_sent += 4
+            return 4
+
+    body = Body()
+    url = "https://iodide.io/large.csv"
+    headers = {"Content-Length": "400"} if send_content_length else {}
+    responses.add(responses.GET, url, body=io.BufferedReader(body, 4), headers=headers, stream=True)
+    with requests.Session() as session:
+        with pytest.raises(ValueError, match="File too large"):
+            fetch(session, FetchJob(url, {}))
+    # we should stop reading as soon as we know the file is too large
+    assert body.bytes_sent == (0 if send_content_length else 12)
+
+
 @responses.activate
 def test_execute_file_update_operation_permission_denied(test_notebook, test_file_source):
     # test that we set the failure status correctly if the operation itself
@@ -95,40 +234,358 @@ def test_execute_file_update_operation_permission_denied(test_notebook, test_fil
     assert File.objects.count() == 0
 
 
-@pytest.mark.parametrize("date", ["2019-07-08", "2019-07-10"])
-def test_run_scheduled_file_operations(fake_user, test_notebook, date):
-    # three file source operations: one should be executed daily, one weekly,
-    # one never
+@responses.activate
+def test_execute_file_update_operation_stores_validators(test_notebook, test_file_source):
+    responses.add(
+        responses.GET,
+        test_file_source.url,
+        body="1234",
+        headers={"ETag": '"abc"', "Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"},
+        stream=True,
+    )
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+    execute_file_update_operation(update_operation.id)
+
+    update_operation.refresh_from_db()
+    assert update_operation.status == FileUpdateOperation.COMPLETED
+    assert update_operation.outcome == FileUpdateOperation.UPDATED
+    test_file_source.refresh_from_db()
+    assert test_file_source.etag == '"abc"'
+    assert test_file_source.last_modified == "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert test_file_source.content_hash == hashlib.md5(b"1234").hexdigest()
+    # the first request can't be conditional, since we had no validators
+    assert "If-None-Match" not in responses.calls[0].request.headers
+
+
+@responses.activate
+@pytest.mark.parametrize("file_state", ["fetched", "replaced", "missing"])
+def test_execute_file_update_operation_not_modified(test_notebook, test_file_source, file_state):
+    test_file_source.etag = '"abc"'
+    test_file_source.last_modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+    test_file_source.content_hash = hashlib.md5(b"1234").hexdigest()
+    test_file_source.save()
+    if file_state != "missing":
+        original_file = File.objects.create(
+            notebook_id=test_notebook.id,
+            filename=test_file_source.filename,
+            content=b"1234" if file_state == "fetched" else b"local",
+        )
+    if file_state == "fetched":
+        responses.add(responses.GET, test_file_source.url, status=304, stream=True)
+    else:
+        # if the file went away, or no longer holds what we fetched, we need
+        # to fetch it in full again
+        responses.add(responses.GET, test_file_source.url, body="5678", stream=True)
+
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+    execute_file_update_operation(update_operation.id)
+
+    request_headers = responses.calls[0].request.headers
+    update_operation.refresh_from_db()
+    test_file_source.refresh_from_db()
+    assert update_operation.status == FileUpdateOperation.COMPLETED
+    file = File.objects.get(notebook_id=test_notebook.id, filename=test_file_source.filename)
+    if file_state == "fetched":
+        assert request_headers["If-None-Match"] == '"abc"'
+        assert request_headers["If-Modified-Since"] == "Wed, 21 Oct 2015 07:28:00 GMT"
+        assert update_operation.outcome == FileUpdateOperation.NOT_MODIFIED
+        # the file is left untouched, and the validators are kept
+        assert file.content.tobytes() == b"1234"
+        assert file.last_updated == original_file.last_updated
+        assert test_file_source.etag == '"abc"'
+        assert test_file_source.content_hash == hashlib.md5(b"1234").hexdigest()
+    else:
+        assert "If-None-Match" not in request_headers
+        assert "If-Modified-Since" not in request_headers
+        assert update_operation.outcome == FileUpdateOperation.UPDATED
+        assert file.content.tobytes() == b"5678"
+        assert test_file_source.etag is None
+        assert test_file_source.content_hash == hashlib.md5(b"5678").hexdigest()
+
+
+@responses.activate
+def test_execute_file_update_operation_retries(settings, test_notebook, test_file_source):
+    settings.FILE_FETCH_RETRY_BASE_DELAY = 60
+    responses.add(responses.GET, test_file_source.url, status=503, stream=True)
+    responses.add(responses.GET, test_file_source.url, body="1234", stream=True)
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+
+    # a transient failure puts the operation back to pending, and schedules
+    # another attempt for later
+    with patch("server.files.tasks.tasks.schedule_at") as mock_schedule_at:
+        execute_file_update_operation(update_operation.id)
+    update_operation.refresh_from_db()
+    assert update_operation.status == FileUpdateOperation.PENDING
+    assert update_operation.attempts == 1
+    (failed_attempt,) = update_operation.attempt_history
+    delay = update_operation.next_attempt_at - parse_datetime(failed_attempt["ended_at"])
+    assert 30 <= delay.total_seconds() <= 60
+    mock_schedule_at.assert_called_once_with(
+        execute_file_update_operation, update_operation.next_attempt_at, update_operation.id
+    )
+    assert failed_attempt["failure_reason"].startswith("503 Server Error")
+
+    with patch("server.files.tasks.tasks.schedule_at") as mock_schedule_at:
+        execute_file_update_operation(update_operation.id)
+    update_operation.refresh_from_db()
+    assert update_operation.status == FileUpdateOperation.COMPLETED
+    assert update_operation.next_attempt_at is None
+    assert not mock_schedule_at.called
+    assert File.objects.get(notebook_id=test_notebook.id).content.tobytes() == b"1234"
+
+    # both attempts are visible through the api
+    data = FileUpdateOperationSerializer(update_operation).data
+    assert data["attempts"] == 2
+    assert [attempt["status"] for attempt in data["attempt_history"]] == [
+        FileUpdateOperation.FAILED,
+        FileUpdateOperation.COMPLETED,
+    ]
+
+
+@responses.activate
+@pytest.mark.parametrize(
+    "status,headers,max_attempts,budget_used,expected_delay",
+    [
+        (503, {"Retry-After": "600"}, 4, 0, 600),
+        (429, {}, 4, 0, 60),
+        (404, {}, 4, 0, None),  # not a transient error
+        (503, {}, 1, 0, None),  # no attempts left
+        (503, {}, 4, 1, None),  # no retry budget left
+    ],
+)
+def test_execute_file_update_operation_retry_limits(
+    settings,
+    test_notebook,
+    test_file_source,
+    status,
+    headers,
+    max_attempts,
+    budget_used,
+    expected_delay,
+):
+    settings.FILE_FETCH_RETRY_BASE_DELAY = 60
+    settings.FILE_FETCH_MAX_ATTEMPTS = max_attempts
+    settings.FILE_FETCH_RETRY_BUDGET = 1
+    if budget_used:
+        other_file_source = FileSource.objects.create(
+            notebook=test_notebook, filename="other.json", url="https://iodide.io/other.json"
+        )
+        FileUpdateOperation.objects.create(file_source=other_file_source, attempts=1)
+    responses.add(responses.GET, test_file_source.url, status=status, headers=headers, stream=True)
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+
+    with patch("server.files.tasks.tasks.schedule_at") as mock_schedule_at:
+        execute_file_update_operation(update_operation.id)
+
+    update_operation.refresh_from_db()
+    if expected_delay is None:
+        assert update_operation.status == FileUpdateOperation.FAILED
+        assert not mock_schedule_at.called
+    else:
+        assert update_operation.status == FileUpdateOperation.PENDING
+        ended_at = parse_datetime(update_operation.attempt_history[0]["ended_at"])
+        delay = (update_operation.next_attempt_at - ended_at).total_seconds()
+        assert expected_delay / 2 <= delay <= expected_delay
+        assert mock_schedule_at.called
+
+
+def test_schedule_offsets_are_stable_and_spread_out():
+    offsets = [
+        FileSource(id=i, update_interval=FileSource.DAILY).get_schedule_offset()
+        for i in range(1, 2401)
+    ]
+    assert offsets == [
+        FileSource(id=i, update_interval=FileSource.DAILY).get_schedule_offset()
+        for i in range(1, 2401)
+    ]
+    assert all(0 <= offset < 86400 for offset in offsets)
+    # with 100 sources per hour on average, no hour should be swamped
+    sources_per_hour = collections.Counter(offset // 3600 for offset in offsets)
+    assert len(sources_per_hour) == 24
+    assert max(sources_per_hour.values()) < 150
+
+
+@pytest.mark.parametrize(
+    "interval",
+    [FileSource.HOURLY, FileSource.DAILY, FileSource.WEEKLY, datetime.timedelta(hours=5)],
+)
+def test_get_next_run(interval):
+    file_source = FileSource(id=42, update_interval=interval)
+    start = datetime.datetime(2019, 7, 10, 12, 34, 56, tzinfo=datetime.timezone.utc)
+    next_run = file_source.get_next_run(start)
+    assert start <= next_run < start + interval
+    # the next run after that is exactly one interval later
+    assert file_source.get_next_run(next_run + datetime.timedelta(seconds=1)) == (
+        next_run + interval
+    )
+
+
+@pytest.mark.freeze_time("2019-07-10 12:00:00")
+def test_file_source_next_run_at(test_notebook):
+    file_source = FileSource.objects.create(
+        notebook=test_notebook,
+        filename="test.json",
+        url="https://iodide.io/test.json",
+        update_interval=FileSource.DAILY,
+    )
+    file_source.refresh_from_db()
+    assert file_source.next_run_at == file_source.get_next_run(timezone.now())
+
+    file_source.update_interval = None
+    file_source.save()
+    file_source.refresh_from_db()
+    assert file_source.next_run_at is None
+
+
+@pytest.mark.parametrize(
+    "interval,valid",
+    [
+        (datetime.timedelta(minutes=59), False),
+        (FileSource.HOURLY, True),
+        (datetime.timedelta(days=3), True),
+        (None, True),
+    ],
+)
+def test_file_source_update_interval_validation(test_notebook, interval, valid):
+    file_source = FileSource(
+        notebook=test_notebook,
+        filename="test.json",
+        url="https://iodide.io/test.json",
+        update_interval=interval,
+    )
+    if valid:
+        file_source.full_clean()
+    else:
+        with pytest.raises(ValidationError):
+            file_source.full_clean()
+
+
+@pytest.mark.freeze_time("2019-07-10 12:00:00")
+def test_run_scheduled_file_operations(settings, fake_user, test_notebook):
+    settings.FILE_FETCH_BATCH_SIZE = 2
+    now = timezone.now()
+    next_run_ats = [
+        now - datetime.timedelta(minutes=1),
+        now,
+        # a run missed a long time ago should still be caught up (once)
+        now - datetime.timedelta(days=30),
+        now - datetime.timedelta(seconds=30),
+        now - datetime.timedelta(hours=2),
+        now + datetime.timedelta(minutes=1),
+        None,
+    ]
+    file_sources = []
+    for i, next_run_at in enumerate(next_run_ats):
+        file_source = FileSource.objects.create(
+            notebook=test_notebook,
+            filename=f"{i}.json",
+            url=f"https://iodide.io/{i}.json",
+            update_interval=FileSource.HOURLY if next_run_at else None,
+        )
+        FileSource.objects.filter(id=file_source.id).update(next_run_at=next_run_at)
+        file_sources.append(file_source)
+
+    with patch("server.files.tasks.tasks.schedule") as mock_schedule:
+        execute_scheduled_file_operations()
+        # running again right away has nothing more to queue
+        execute_scheduled_file_operations()
+
+    due_ids = {file_source.id for file_source in file_sources[:5]}
+    update_operations = FileUpdateOperation.objects.all()
+    assert set(update_operations.values_list("file_source_id", flat=True)) == due_ids
+    # the most overdue sources are queued first, in batches
+    assert [ids for ((_, ids), _) in mock_schedule.call_args_list] == [
+        list(update_operations.filter(file_source_id__in=ids).values_list("id", flat=True))
+        for ids in [
+            [file_sources[2].id, file_sources[4].id],
+            [file_sources[0].id, file_sources[3].id],
+            [file_sources[1].id],
+        ]
+    ]
+    for file_source in file_sources:
+        file_source.refresh_from_db()
+        if file_source.id in due_ids:
+            assert file_source.last_run_at == now
+            assert now < file_source.next_run_at <= now + FileSource.HOURLY
+            assert file_source.next_run_at == file_source.get_next_run(file_source.next_run_at)
+        else:
+            assert file_source.last_run_at is None
+
+
+@responses.activate
+def test_execute_file_update_operations(settings, fake_user, test_notebook):
+    settings.MAX_FILE_SIZE = 8
+    settings.FILE_FETCH_CONCURRENCY = 3
+    settings.FILE_FETCH_PER_HOST_CONCURRENCY = 2
+    File.objects.create(notebook=test_notebook, filename="0.json", content=b"old")
+    bodies = [b"0", b"1", b"too large!", b"3", b"4", b"5"]
     file_sources = []
-    for (i, interval) in enumerate([datetime.timedelta(days=1), datetime.timedelta(weeks=1), None]):
+    for i, body in enumerate(bodies):
+        url = f"https://host{i % 2}.example.com/{i}.json"
+        responses.add(responses.GET, url, body=body, headers={"ETag": f'"{i}"'}, stream=True)
         file_sources.append(
-            FileSource.objects.create(
-                notebook=test_notebook,
-                filename=f"{i}.json",
-                url=f"https://iodide.io/{i}.json",
-                update_interval=interval,
-            )
+            FileSource.objects.create(notebook=test_notebook, filename=f"{i}.json", url=url)
         )
-    weekly_ids = set([file_sources[0].id, file_sources[1].id])
-    daily_ids = set([file_sources[0].id])
-
-    with freeze_time(date):
-        with patch("server.files.tasks.tasks.schedule") as mock_schedule:
-            execute_scheduled_file_operations()
-            update_operations = FileUpdateOperation.objects.all()
-            if date == "2019-07-08":
-                # 2019-07-08 is a monday, so the weekly task should have run
-                assert set(update_operations.values_list("file_source_id", flat=True)) == weekly_ids
-            else:  # 2019-07-10
-                # only the daily task should have run
-                assert set(update_operations.values_list("file_source_id", flat=True)) == daily_ids
-            # also make sure we queued the relevant async tasks
-            mock_schedule.assert_has_calls(
-                [
-                    call(execute_file_update_operation, id)
-                    for id in update_operations.values_list("id", flat=True)
-                ]
-            )
+    # one of the sources is unreachable
+    file_sources.append(
+        FileSource.objects.create(
+            notebook=test_notebook, filename="6.json", url="https://host2.example.com/6.json"
+        )
+    )
+    update_operations = [
+        FileUpdateOperation.objects.create(file_source=file_source) for file_source in file_sources
+    ]
+
+    with patch("server.files.tasks.tasks.schedule_at") as mock_schedule_at:
+        execute_file_update_operations([op.id for op in update_operations])
+
+    for update_operation in update_operations:
+        update_operation.refresh_from_db()
+    assert [update_operation.status for update_operation in update_operations] == [
+        FileUpdateOperation.COMPLETED
+    ] * 2 + [FileUpdateOperation.FAILED] + [FileUpdateOperation.COMPLETED] * 3 + [
+        FileUpdateOperation.PENDING
+    ]
+    for update_operation in update_operations[:-1]:
+        assert update_operation.started_at and update_operation.ended_at
+    # the unreachable source will be retried
+    mock_schedule_at.assert_called_once_with(
+        execute_file_update_operation,
+        update_operations[-1].next_attempt_at,
+        update_operations[-1].id,
+    )
+    assert update_operations[2].failure_reason == "File too large"
+    assert dict(File.objects.values_list("filename", "content_hash")) == {
+        f"{i}.json": hashlib.md5(body).hexdigest() for (i, body) in enumerate(bodies) if i != 2
+    }
+    assert list(FileSource.objects.values_list("etag", flat=True)) == [
+        f'"{i}"' if i != 2 else None for i in range(6)
+    ] + [None]
+
+
+@responses.activate
+def test_execute_file_update_operations_save_failure(two_test_notebooks):
+    update_operations = []
+    for i, notebook in enumerate(two_test_notebooks):
+        url = f"https://iodide.io/{i}.csv"
+        responses.add(responses.GET, url, body=b"1,2", stream=True)
+        file_source = FileSource.objects.create(notebook=notebook, filename="data.csv", url=url)
+        update_operations.append(FileUpdateOperation.objects.create(file_source=file_source))
+
+    def fetch_all_and_delete_notebook(*args, **kwargs):
+        results = fetch_all(*args, **kwargs)
+        # the file of the deleted notebook can't be saved any more
+        two_test_notebooks[1].delete()
+        return results
+
+    with patch("server.files.tasks.fetch_all", side_effect=fetch_all_and_delete_notebook):
+        execute_file_update_operations([op.id for op in update_operations])
+
+    # but that doesn't prevent saving the other one
+    update_operations[0].refresh_from_db()
+    assert update_operations[0].status == FileUpdateOperation.COMPLETED
+    assert list(File.objects.values_list("notebook_id", flat=True)) == [two_test_notebooks[0].id]
+    assert not FileUpdateOperation.objects.filter(id=update_operations[1].id).exists()
 
 
 @pytest.mark.freeze_time("2017-05-21")
@@ -153,3 +610,567 @@ def test_post_file_update_operation(fake_user, test_notebook, test_file_source,
         mock_schedule.assert_has_calls(
             [call(execute_file_update_operation, file_update_operation.id)]
         )
+
+
+def test_post_file_update_operation_while_active(
+    fake_user, test_notebook, test_file_source, client
+):
+    client.force_login(user=fake_user)
+    with patch("server.files.tasks.tasks.schedule") as mock_schedule:
+        first_resp = client.post(
+            reverse("file-update-operations-list"), {"file_source_id": test_file_source.id}
+        )
+        # as long as the first operation is pending or running, asking for
+        # another one just returns it
+        for status in [FileUpdateOperation.PENDING, FileUpdateOperation.RUNNING]:
+            FileUpdateOperation.objects.update(status=status)
+            resp = client.post(
+                reverse("file-update-operations-list"), {"file_source_id": test_file_source.id}
+            )
+            assert resp.status_code == 200
+            assert resp.json()["id"] == first_resp.json()["id"]
+        assert FileUpdateOperation.objects.count() == 1
+        assert mock_schedule.call_count == 1
+
+        # once it is over, a new one can be created
+        FileUpdateOperation.objects.update(status=FileUpdateOperation.COMPLETED)
+        resp = client.post(
+            reverse("file-update-operations-list"), {"file_source_id": test_file_source.id}
+        )
+        assert resp.status_code == 201
+        assert FileUpdateOperation.objects.count() == 2
+        assert mock_schedule.call_count == 2
+
+
+def test_post_file_update_operation_while_stale(fake_user, test_notebook, test_file_source, client):
+    client.force_login(user=fake_user)
+    long_ago = timezone.now() - datetime.timedelta(hours=1)
+    url = reverse("file-update-operations-list")
+    with patch("server.files.tasks.tasks.schedule") as mock_schedule:
+        # a pending operation whose job was lost is queued again
+        update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+        FileUpdateOperation.objects.update(scheduled_at=long_ago)
+        resp = client.post(url, {"file_source_id": test_file_source.id})
+        assert resp.status_code == 200
+        assert resp.json()["id"] == update_operation.id
+        mock_schedule.assert_called_once_with(execute_file_update_operation, update_operation.id)
+
+        # one left running by a dead worker is given up on
+        FileUpdateOperation.objects.update(status=FileUpdateOperation.RUNNING, started_at=long_ago)
+        resp = client.post(url, {"file_source_id": test_file_source.id})
+        assert resp.status_code == 201
+        update_operation.refresh_from_db()
+        assert update_operation.status == FileUpdateOperation.FAILED
+        assert update_operation.failure_reason == "Abandoned while running"
+        mock_schedule.assert_called_with(execute_file_update_operation, resp.json()["id"])
+
+
+def test_post_file_update_operation_while_retrying(
+    fake_user, test_notebook, test_file_source, client
+):
+    client.force_login(user=fake_user)
+    update_operation = FileUpdateOperation.objects.create(
+        file_source=test_file_source,
+        attempts=1,
+        next_attempt_at=timezone.now() + datetime.timedelta(minutes=30),
+    )
+    with patch("server.files.tasks.tasks.schedule") as mock_schedule:
+        resp = client.post(
+            reverse("file-update-operations-list"), {"file_source_id": test_file_source.id}
+        )
+
+    # the retry runs straight away
+    assert resp.status_code == 200
+    assert resp.json()["id"] == update_operation.id
+    mock_schedule.assert_called_once_with(execute_file_update_operation, update_operation.id)
+    update_operation.refresh_from_db()
+    assert update_operation.next_attempt_at is None
+
+
+def test_single_active_file_update_operation(test_notebook, test_file_source):
+    FileUpdateOperation.objects.create(
+        file_source=test_file_source, status=FileUpdateOperation.COMPLETED
+    )
+    FileUpdateOperation.objects.create(file_source=test_file_source)
+    with pytest.raises(IntegrityError), transaction.atomic():
+        FileUpdateOperation.objects.create(file_source=test_file_source)
+
+
+@pytest.mark.parametrize("status", [FileUpdateOperation.RUNNING, FileUpdateOperation.COMPLETED])
+def test_execute_file_update_operation_not_pending(test_notebook, test_file_source, status):
+    # an operation which was already picked up by another job is left alone
+    update_operation = FileUpdateOperation.objects.create(
+        file_source=test_file_source, status=status
+    )
+    execute_file_update_operation(update_operation.id)
+    update_operation.refresh_from_db()
+    assert update_operation.status == status
+    assert update_operation.attempts == 0
+
+
+@pytest.mark.freeze_time("2019-07-10 12:00:00")
+def test_run_scheduled_file_operations_while_active(test_notebook, test_file_source):
+    FileSource.objects.update(next_run_at=timezone.now())
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+
+    with patch("server.files.tasks.tasks.schedule") as mock_schedule:
+        execute_scheduled_file_operations()
+
+    # the pending operation will do, but the source still moves on to its
+    # next run
+    assert list(FileUpdateOperation.objects.all()) == [update_operation]
+    assert not mock_schedule.called
+    test_file_source.refresh_from_db()
+    assert test_file_source.next_run_at > timezone.now()
+
+
+@pytest.mark.freeze_time("2019-07-10 12:00:00")
+def test_run_scheduled_file_operations_while_stale(test_notebook, test_file_source):
+    long_ago = timezone.now() - datetime.timedelta(hours=1)
+    other_file_source = FileSource.objects.create(
+        notebook=test_notebook,
+        filename="bar.csv",
+        url="https://iodide.io/bar",
+        update_interval=datetime.timedelta(days=1),
+    )
+    FileSource.objects.update(next_run_at=timezone.now())
+    running = FileUpdateOperation.objects.create(
+        file_source=test_file_source, status=FileUpdateOperation.RUNNING, started_at=long_ago
+    )
+    pending = FileUpdateOperation.objects.create(file_source=other_file_source)
+    FileUpdateOperation.objects.filter(id=pending.id).update(scheduled_at=long_ago)
+
+    with patch("server.files.tasks.tasks.schedule") as mock_schedule:
+        execute_scheduled_file_operations()
+
+    running.refresh_from_db()
+    assert running.status == FileUpdateOperation.FAILED
+    new_operation = FileUpdateOperation.objects.get(
+        file_source=test_file_source, status=FileUpdateOperation.PENDING
+    )
+    assert mock_schedule.call_args_list == [
+        call(execute_file_update_operation, pending.id),
+        call(execute_file_update_operations, [new_operation.id]),
+    ]
+
+
+def test_run_scheduled_file_operations_queue_full(settings, test_notebook, test_file_source):
+    FileSource.objects.update(next_run_at=timezone.now())
+    settings.TASK_QUEUE_MAX_DEPTH = {settings.FILES_TASK_QUEUE: 10}
+
+    with patch("server.task_queues.get_queue_depth", return_value=10), patch(
+        "server.files.tasks.tasks.schedule"
+    ) as mock_schedule:
+        execute_scheduled_file_operations()
+
+    # the source stays due until the workers catch up
+    assert not FileUpdateOperation.objects.exists()
+    assert not mock_schedule.called
+    test_file_source.refresh_from_db()
+    assert test_file_source.next_run_at <= timezone.now()
+
+
+@pytest.mark.parametrize(
+    "url,normalized",
+    [
+        ("https://iodide.io/data.csv", "https://iodide.io/data.csv"),
+        ("HTTPS://Iodide.IO:443/data.csv#top", "https://iodide.io/data.csv"),
+        ("http://iodide.io:8080", "http://iodide.io:8080/"),
+        ("https://iodide.io/data.csv?b=2&a=1&c=", "https://iodide.io/data.csv?a=1&b=2&c="),
+        ("https://user:pw@iodide.io/Data.csv", "https://user:pw@iodide.io/Data.csv"),
+    ],
+)
+def test_normalize_url(url, normalized):
+    assert normalize_url(url) == normalized
+
+
+def create_shared_file_sources(notebook, urls):
+    file_sources = [
+        FileSource.objects.create(notebook=notebook, filename=f"{i}.csv", url=url)
+        for (i, url) in enumerate(urls)
+    ]
+    return [
+        FileUpdateOperation.objects.create(file_source=file_source).id
+        for file_source in file_sources
+    ]
+
+
+@responses.activate
+def test_execute_file_update_operations_shared_url(fake_user, test_notebook):
+    content = b"a,b\n1,2\n"
+    responses.add(responses.GET, "https://iodide.io/data.csv", body=content, stream=True)
+    responses.add(responses.GET, "https://iodide.io/other.csv", body=b"other", stream=True)
+    initial_storage_bytes = Notebook.objects.get(id=test_notebook.id).storage_bytes
+    initial_metrics = (fetches.get(), saved_fetches.get(), saved_bytes.get())
+
+    update_operation_ids = create_shared_file_sources(
+        test_notebook,
+        [
+            "https://iodide.io/data.csv",
+            "https://IODIDE.io/data.csv#fragment",
+            "https://iodide.io/other.csv",
+        ],
+    )
+    execute_file_update_operations(update_operation_ids)
+
+    # the shared url was only downloaded once
+    assert len(responses.calls) == 2
+    assert set(FileUpdateOperation.objects.values_list("status", "outcome")) == {
+        (FileUpdateOperation.COMPLETED, FileUpdateOperation.UPDATED)
+    }
+    assert [bytes(content) for content in File.objects.values_list("content", flat=True)] == [
+        content,
+        content,
+        b"other",
+    ]
+    assert Notebook.objects.get(id=test_notebook.id).storage_bytes == (
+        initial_storage_bytes + 2 * len(content) + len(b"other")
+    )
+    assert (fetches.get(), saved_fetches.get(), saved_bytes.get()) == (
+        initial_metrics[0] + 2,
+        initial_metrics[1] + 1,
+        initial_metrics[2] + len(content),
+    )
+
+
+@responses.activate
+def test_execute_file_update_operations_fetch_cache(settings, fake_user, test_notebook):
+    content = b"a,b\n1,2\n"
+    responses.add(responses.GET, "https://iodide.io/data.csv", body=content, stream=True)
+    update_operation_ids = create_shared_file_sources(
+        test_notebook, ["https://iodide.io/data.csv"] * 4
+    )
+
+    # a later batch reuses the content downloaded by an earlier one...
+    execute_file_update_operations(update_operation_ids[:1])
+    execute_file_update_operations(update_operation_ids[1:2])
+    assert len(responses.calls) == 1
+    assert bytes(File.objects.get(filename="1.csv").content) == content
+
+    # ...as long as it is still there
+    File.objects.filter(filename__in=["0.csv", "1.csv"]).delete()
+    execute_file_update_operations(update_operation_ids[2:3])
+    assert len(responses.calls) == 2
+
+    # and refreshes requested individually always download the url
+    execute_file_update_operation(update_operation_ids[3])
+    assert len(responses.calls) == 3
+    assert File.objects.count() == 2
+    assert set(FileUpdateOperation.objects.values_list("status", flat=True)) == {
+        FileUpdateOperation.COMPLETED
+    }
+
+
+@responses.activate
+@pytest.mark.parametrize("batched", [True, False])
+def test_execute_file_update_operations_not_modified_owners(fake_user, fake_user2, batched):
+    # two users' notebooks refresh the same url, but the first user has since
+    # replaced their copy with private content
+    url = "https://iodide.io/data.csv"
+    content_hash = hashlib.md5(b"public").hexdigest()
+    update_operation_ids = []
+    for user, content in ((fake_user, b"private"), (fake_user2, b"public")):
+        notebook = Notebook.objects.create(owner=user, title="Fake notebook")
+        File.objects.create(notebook=notebook, filename="data.csv", content=content)
+        file_source = FileSource.objects.create(
+            notebook=notebook, filename="data.csv", url=url, etag='"abc"', content_hash=content_hash
+        )
+        update_operation_ids.append(FileUpdateOperation.objects.create(file_source=file_source).id)
+    # (a server answering 304 whatever the request)
+    responses.add(responses.GET, url, status=304, stream=True)
+
+    if batched:
+        execute_file_update_operations(update_operation_ids)
+    else:
+        # an individual refresh, followed by a batch which could reuse it
+        execute_file_update_operation(update_operation_ids[0])
+        execute_file_update_operations(update_operation_ids[1:])
+
+    # the first file can't be kept or shared, and the second one stays as is
+    assert "If-None-Match" not in responses.calls[0].request.headers
+    assert list(FileUpdateOperation.objects.order_by("id").values_list("status", "outcome")) == [
+        (FileUpdateOperation.FAILED, None),
+        (FileUpdateOperation.COMPLETED, FileUpdateOperation.NOT_MODIFIED),
+    ]
+    assert sorted(bytes(content) for content in File.objects.values_list("content", flat=True)) == [
+        b"private",
+        b"public",
+    ]
+    assert File.objects.get(notebook__owner=fake_user2).content.tobytes() == b"public"
+
+
+@pytest.mark.freeze_time("2019-07-10 12:00:00")
+def test_prune_file_update_operations(settings, test_notebook):
+    settings.FILE_UPDATE_OPERATION_RETENTION_COUNT = 3
+    settings.FILE_UPDATE_OPERATION_FAILURE_RETENTION_DAYS = 7
+    settings.FILE_UPDATE_OPERATION_PRUNE_BATCH_SIZE = 2
+    now = timezone.now()
+    statuses = [
+        (FileUpdateOperation.FAILED, 10),
+        (FileUpdateOperation.FAILED, 6),
+        (FileUpdateOperation.COMPLETED, 5),
+        (FileUpdateOperation.COMPLETED, 4),
+        (FileUpdateOperation.COMPLETED, 3),
+        (FileUpdateOperation.COMPLETED, 2),
+        (FileUpdateOperation.FAILED, 1),
+        (FileUpdateOperation.PENDING, 0),
+    ]
+    kept = collections.defaultdict(list)
+    for i in range(3):
+        file_source = FileSource.objects.create(
+            notebook=test_notebook, filename=f"{i}.csv", url=f"https://iodide.io/{i}.csv"
+        )
+        # the last source has a short history, which is kept whole
+        history = statuses[-2:] if i == 2 else statuses
+        for j, (status, days_ago) in enumerate(history):
+            update_operation = FileUpdateOperation.objects.create(
+                file_source=file_source, status=status
+            )
+            FileUpdateOperation.objects.filter(id=update_operation.id).update(
+                scheduled_at=now - datetime.timedelta(days=days_ago)
+            )
+            # the latest 3, and recent failures
+            if i == 2 or j >= 5 or j == 1:
+                kept[file_source.id].append(update_operation.id)
+
+    prune_file_update_operations()
+
+    remaining = collections.defaultdict(list)
+    for file_source_id, update_operation_id in FileUpdateOperation.objects.values_list(
+        "file_source_id", "id"
+    ):
+        remaining[file_source_id].append(update_operation_id)
+    assert remaining == kept
+
+    # nothing is pruned if the history is kept whole
+    settings.FILE_UPDATE_OPERATION_RETENTION_COUNT = 0
+    FileUpdateOperation.objects.create(
+        file_source=file_source, status=FileUpdateOperation.COMPLETED
+    )
+    prune_file_update_operations()
+    assert FileUpdateOperation.objects.count() == sum(map(len, kept.values())) + 1
+
+
+@responses.activate
+def test_fetch_progress(settings):
+    settings.FILE_FETCH_CHUNK_SIZE = 4
+    settings.FILE_UPDATE_PROGRESS_INTERVAL = 0
+    url = "https://iodide.io/data.csv"
+    responses.add(
+        responses.GET, url, body=b"0123456789", headers={"Content-Length": "10"}, stream=True
+    )
+    progress = Mock()
+
+    with requests.Session() as session:
+        fetch(session, FetchJob(url, {}, progress))
+
+    assert progress.call_args_list == [
+        call(0, 10),
+        call(4, 10),
+        call(8, 10),
+        call(10, 10),
+        call(10, 10, final=True),
+    ]
+
+
+def test_progress_reporter_is_throttled(settings):
+    settings.FILE_UPDATE_PROGRESS_INTERVAL = 1
+    report = ProgressReporter([1, 2])
+    published = []
+    with patch("server.files.progress.time.monotonic", side_effect=[0, 0.5, 1, 1.5, 1.6]):
+        for bytes_downloaded in [0, 1, 2, 3]:
+            report(bytes_downloaded, 4)
+            published.append(get_progress(1)["bytes_downloaded"])
+        report(4, 4, final=True)
+    assert published == [0, 0, 2, 2]
+    assert (
+        get_progress(1)
+        == get_progress(2)
+        == {
+            "status": FileUpdateOperation.RUNNING,
+            "bytes_downloaded": 4,
+            "expected_bytes": 4,
+        }
+    )
+
+
+@responses.activate
+def test_execute_file_update_operation_progress(settings, test_notebook, test_file_source):
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+
+    def request_callback(request):
+        assert get_progress(update_operation.id)["status"] == FileUpdateOperation.RUNNING
+        return (200, {}, "1234")
+
+    with responses.RequestsMock() as requests_mock:
+        requests_mock._matches.append(
+            responses.CallbackResponse("GET", test_file_source.url, request_callback, stream=True)
+        )
+        execute_file_update_operation(update_operation.id)
+
+    assert get_progress(update_operation.id)["status"] == FileUpdateOperation.COMPLETED
+
+
+def test_get_file_update_operation_progress(client, test_file_source):
+    update_operation = FileUpdateOperation.objects.create(file_source=test_file_source)
+    url = reverse("file-update-operations-progress", kwargs={"pk": update_operation.id})
+
+    # without published progress, the status comes from the database
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.json() == {"status": "pending", "bytes_downloaded": None, "expected_bytes": None}
+
+    FileUpdateOperation.objects.filter(id=update_operation.id).update(
+        status=FileUpdateOperation.RUNNING
+    )
+    set_progress([update_operation.id], FileUpdateOperation.RUNNING, 4, 10)
+    progress = {"status": "running", "bytes_downloaded": 4, "expected_bytes": 10}
+    assert client.get(url).json() == progress
+    resp = client.get(reverse("file-update-operations-detail", kwargs={"pk": update_operation.id}))
+    assert resp.json()["progress"] == progress
+
+    # the progress is returned straight away, whatever the client asks for
+    start = time.monotonic()
+    assert client.get(url, {"since": 4, "wait": "nan"}).json() == progress
+    assert time.monotonic() - start < 1
+
+    # ids are looked up as integers, and anything else isn't found
+    for pk, status_code in [(f"00{update_operation.id}", 200), ("abc", 404), ("999999", 404)]:
+        resp = client.get(reverse("file-update-operations-progress", kwargs={"pk": pk}))
+        assert resp.status_code == status_code
+        if status_code == 200:
+            assert resp.json() == progress
+
+
+class ContentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = b"" if self.path == "/missing" else b"1234"
+        self.send_response(404 if self.path == "/missing" else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_fetch_metrics():
+    for metric in [fetch_outcomes, fetch_bytes, fetch_durations]:
+        metric.clear()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ContentHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    try:
+        results = fetch_all(
+            [FetchJob(f"http://{host}:{port}/{path}", {}) for path in ["data", "missing"]],
+            concurrent=False,
+        )
+    finally:
+        server.shutdown()
+
+    assert results[0].size == 4 and results[0].duration > 0
+    assert results[1].duration > 0
+    assert fetch_outcomes.get(host=host, outcome="ok") == 1
+    assert fetch_outcomes.get(host=host, outcome="http_error") == 1
+    assert fetch_bytes.get(host=host) == 4
+    # both requests went through the same connection
+    assert fetch_durations.get(host=host, phase="connect") == 1
+    assert fetch_durations.get(host=host, phase="ttfb") == 2
+    assert fetch_durations.get(host=host, phase="total") == 2
+
+
+class SlowContentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "100")
+        self.end_headers()
+        # never times out a read, but takes forever overall
+        try:
+            for _ in range(100):
+                self.wfile.write(b"1")
+                self.wfile.flush()
+                time.sleep(0.2)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.mark.parametrize("concurrent", [True, False])
+def test_fetch_deadline(settings, concurrent):
+    settings.FILE_FETCH_TIMEOUT = 1
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowContentHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    start = time.monotonic()
+    try:
+        (result,) = fetch_all([FetchJob(f"http://{host}:{port}/data", {})], concurrent=concurrent)
+    finally:
+        server.shutdown()
+
+    assert isinstance(result, requests.exceptions.Timeout)
+    assert time.monotonic() - start < 2
+
+
+def test_fetch_metrics_host_labels(settings):
+    settings.FILE_FETCH_METRICS_MAX_HOSTS = 1
+    fetch_outcomes.clear()
+    with patch("server.files.fetcher._host_labels", set()):
+        with responses.RequestsMock() as mock:
+            for host in ["host1.example.com", "host2.example.com", "host3.example.com"]:
+                mock.add(responses.GET, f"https://{host}/data", body=b"1234")
+            fetch_all(
+                [
+                    FetchJob(f"https://{host}.example.com/data", {})
+                    for host in ["host1", "host2", "host3", "host1"]
+                ],
+                concurrent=False,
+            )
+
+    # hosts past the first are lumped together
+    assert fetch_outcomes.get(host="host1.example.com", outcome="ok") == 2
+    assert fetch_outcomes.get(host="other", outcome="ok") == 2
+    assert fetch_outcomes.get(host="host2.example.com", outcome="ok") == 0
+
+
+def test_report_slow_file_sources(test_notebook):
+    durations = {
+        "https://iodide.io/fast.csv": [0.1, 0.3],
+        "https://iodide.io/slow.csv": [2, 4, None],
+        "https://iodide.io/old.csv": [],
+    }
+    for i, (url, url_durations) in enumerate(durations.items()):
+        file_source = FileSource.objects.create(
+            notebook=test_notebook, filename=f"{i}.csv", url=url
+        )
+        for fetch_duration in url_durations:
+            FileUpdateOperation.objects.create(
+                file_source=file_source,
+                status=(
+                    FileUpdateOperation.COMPLETED if fetch_duration else FileUpdateOperation.FAILED
+                ),
+                fetch_duration=fetch_duration,
+            )
+    # operations from before the period are left out
+    old_operation = FileUpdateOperation.objects.create(
+        file_source=file_source, status=FileUpdateOperation.FAILED, fetch_duration=100
+    )
+    FileUpdateOperation.objects.filter(id=old_operation.id).update(
+        scheduled_at=timezone.now() - datetime.timedelta(days=8)
+    )
+
+    stdout = io.StringIO()
+    call_command("report_slow_file_sources", days=7, stdout=stdout)
+    lines = [line.split() for line in stdout.getvalue().splitlines()]
+    assert lines == [
+        ["Slowest", "urls", "(average", "/", "max", "fetch", "duration,", "operations):"],
+        ["3.00s", "4.00s", "3", "https://iodide.io/slow.csv"],
+        ["0.20s", "0.30s", "2", "https://iodide.io/fast.csv"],
+        ["Most", "failing", "urls", "(failures", "/", "operations):"],
+        ["1", "/", "3", "https://iodide.io/slow.csv"],
+    ]
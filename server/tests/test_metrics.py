@@ -0,0 +1,104 @@
+import datetime
+import logging
+import urllib.request
+
+import pytest
+from django.urls import reverse
+from spinach import signals
+from spinach.contrib.spinachd.apps import spin
+from spinach.job import Job, JobStatus
+
+from server.metrics import Counter, Gauge, Histogram, render_metrics, start_metrics_server
+from server.task_metrics import exceptions, jobs, queue_latency, run_time
+
+
+def test_metrics_disabled(client, settings):
+    settings.METRICS_ENABLED = False
+    resp = client.get(reverse("metrics"))
+    assert resp.status_code == 404
+
+
+def test_metrics_view(client, settings):
+    settings.METRICS_ENABLED = True
+    counter = Counter("iodide_test_requests_total", "Test requests", ["method"])
+    counter.inc(method="GET")
+    counter.inc(2, method="GET")
+    counter.inc(method="POST")
+
+    resp = client.get(reverse("metrics"))
+    assert resp.status_code == 200
+    assert resp["Content-Type"].startswith("text/plain")
+    body = resp.content.decode("utf-8")
+    assert "# TYPE iodide_test_requests_total counter" in body
+    assert 'iodide_test_requests_total{method="GET"} 3' in body
+    assert 'iodide_test_requests_total{method="POST"} 1' in body
+
+
+def test_metric_labels_are_checked():
+    gauge = Gauge("iodide_test_gauge", "Test gauge", ["host"])
+    with pytest.raises(ValueError):
+        gauge.set(1)
+    gauge.set(1, host='weird"host')
+    assert 'iodide_test_gauge{host="weird\\"host"} 1' in render_metrics()
+
+
+def test_histogram():
+    histogram = Histogram("iodide_test_duration_seconds", "Test durations", buckets=(1, 0.5))
+    for value in [0.2, 0.5, 0.7, 3]:
+        histogram.observe(value)
+    assert histogram.get() == 4
+    body = render_metrics()
+    assert "# TYPE iodide_test_duration_seconds histogram" in body
+    assert 'iodide_test_duration_seconds_bucket{le="0.5"} 2' in body
+    assert 'iodide_test_duration_seconds_bucket{le="1.0"} 3' in body
+    assert 'iodide_test_duration_seconds_bucket{le="+Inf"} 4' in body
+    assert "iodide_test_duration_seconds_sum 4.4" in body
+    assert "iodide_test_duration_seconds_count 4" in body
+
+
+def test_metrics_server():
+    counter = Counter("iodide_test_worker_jobs_total", "Test jobs")
+    counter.inc()
+    server = start_metrics_server(0, "127.0.0.1")
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:%s/" % server.server_address[1]) as resp:
+            assert resp.headers["Content-Type"].startswith("text/plain")
+            assert "iodide_test_worker_jobs_total 1" in resp.read().decode("utf-8")
+    finally:
+        server.shutdown()
+
+
+@pytest.mark.parametrize(
+    "status, error, outcome",
+    [
+        (JobStatus.SUCCEEDED, None, "succeeded"),
+        (JobStatus.NOT_SET, ValueError("oops"), "retried"),
+        (JobStatus.FAILED, KeyError("oops"), "failed"),
+    ],
+)
+def test_task_metrics(caplog, status, error, outcome):
+    for metric in [queue_latency, run_time, jobs, exceptions]:
+        metric.clear()
+    caplog.set_level(logging.INFO, logger="server.task_metrics")
+    due = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=5)
+    job = Job("test:task", "test", due, max_retries=1)
+
+    signals.job_started.send(spin.namespace, job=job)
+    job.status = status
+    if status == JobStatus.NOT_SET:
+        signals.job_schedule_retry.send(spin.namespace, job=job, err=error)
+    elif status == JobStatus.FAILED:
+        signals.job_failed.send(spin.namespace, job=job, err=error)
+    signals.job_finished.send(spin.namespace, job=job)
+
+    assert queue_latency.get(task="test:task") == 1
+    assert 'iodide_task_queue_latency_seconds_bucket{task="test:task",le="1.0"} 0' in (
+        render_metrics()
+    )
+    assert run_time.get(task="test:task") == 1
+    assert jobs.get(task="test:task", outcome=outcome) == 1
+    exception = type(error).__name__ if error else None
+    if error:
+        assert exceptions.get(task="test:task", exception=exception) == 1
+    assert f"task=test:task job={job.id} outcome={outcome}" in caplog.text
+    assert f"exception={exception}" in caplog.text
@@ -0,0 +1,168 @@
+import datetime
+from unittest.mock import patch
+
+import pytest
+import pytz
+from django.urls import reverse
+
+from server.notebooks.draft_buffer import flush_buffered_draft, get_buffered_drafts
+from server.notebooks.models import NotebookRevision
+from server.notebooks.tasks import execute_notebook_revisions_cleanup, flush_buffered_drafts
+
+START = datetime.datetime(2020, 1, 1, 10, 0, 10, tzinfo=pytz.utc)
+
+
+@pytest.fixture
+def write_behind(settings, test_notebook):
+    settings.NOTEBOOK_REVISION_WRITE_BEHIND = True
+    NotebookRevision.objects.update(created=START - datetime.timedelta(days=1))
+
+
+@pytest.fixture
+def save_revision(fake_user, test_notebook, client):
+    client.force_login(user=fake_user)
+
+    def save_revision(seconds, content, **extra):
+        last_revision = NotebookRevision.objects.filter(notebook_id=test_notebook.id).first()
+        with patch(
+            "django.utils.timezone.now", return_value=START + datetime.timedelta(seconds=seconds)
+        ), patch("server.notebooks.api_views.tasks.schedule"):
+            resp = client.post(
+                reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id}),
+                {
+                    "parent_revision_id": last_revision.id,
+                    "title": f"Title of {content}",
+                    "content": content,
+                    **extra,
+                },
+            )
+        assert resp.status_code == 201
+        return resp.json()
+
+    return save_revision
+
+
+def test_buffered_draft(write_behind, test_notebook, save_revision, client):
+    draft = save_revision(0, "first draft")
+    assert NotebookRevision.objects.get(id=draft["id"]).content == "first draft"
+
+    # the following saves in the window are only buffered
+    buffered = save_revision(20, "second draft")
+    assert buffered == {**draft, "title": "Title of second draft", "content": "second draft"}
+    assert NotebookRevision.objects.get(id=draft["id"]).content == "first draft"
+    assert NotebookRevision.objects.filter(notebook=test_notebook).count() == 2
+
+    # but reads see them
+    resp = client.get(
+        reverse(
+            "notebook-revisions-detail",
+            kwargs={"notebook_id": test_notebook.id, "pk": draft["id"]},
+        )
+    )
+    assert resp.json() == buffered
+    resp = client.get(reverse("notebooks-detail", kwargs={"pk": test_notebook.id}))
+    assert resp.json()["latest_revision"] == buffered
+    list_url = reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id})
+    resp = client.get(list_url, {"full": 1})
+    assert resp.json()[0] == buffered
+    resp = client.get(list_url)
+    assert resp.json()[0]["title"] == buffered["title"]
+
+    # saving the same content again is still refused
+    last_revision = NotebookRevision.objects.filter(notebook_id=test_notebook.id).first()
+    resp = client.post(
+        reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id}),
+        {
+            "parent_revision_id": last_revision.id,
+            "title": buffered["title"],
+            "content": buffered["content"],
+        },
+    )
+    assert resp.status_code == 400
+
+    flush_buffered_drafts(START + datetime.timedelta(seconds=30))
+    revision = NotebookRevision.objects.get(id=draft["id"])
+    assert (revision.title, revision.content) == ("Title of second draft", "second draft")
+    test_notebook.refresh_from_db()
+    assert test_notebook.title == "Title of second draft"
+    assert test_notebook.storage_bytes == sum(
+        revision.content_size for revision in NotebookRevision.objects.all()
+    )
+    assert get_buffered_drafts([test_notebook.id]) == {}
+
+
+def test_buffered_draft_flushed_by_next_revision(write_behind, test_notebook, save_revision):
+    draft = save_revision(0, "first draft")
+    save_revision(20, "second draft")
+
+    # the next window starts with a revision of its own, after the buffered
+    # draft is written to the previous one
+    next_draft = save_revision(60, "third draft")
+    assert next_draft["id"] != draft["id"]
+    assert list(
+        NotebookRevision.objects.filter(notebook=test_notebook).values_list("content", flat=True)
+    ) == ["third draft", "second draft", "*fake notebook content*"]
+    assert get_buffered_drafts([test_notebook.id]) == {}
+
+
+def test_buffered_draft_flushed_on_request(write_behind, test_notebook, save_revision):
+    draft = save_revision(0, "first draft")
+    save_revision(20, "second draft")
+    save_revision(30, "saved draft", flush=True)
+
+    assert NotebookRevision.objects.get(id=draft["id"]).content == "saved draft"
+    assert get_buffered_drafts([test_notebook.id]) == {}
+
+
+def test_buffered_draft_cache_failure(write_behind, test_notebook, save_revision):
+    draft = save_revision(0, "first draft")
+    with patch("django.core.cache.backends.locmem.LocMemCache.set", side_effect=ConnectionError):
+        save_revision(20, "second draft")
+
+    # the draft was written straight away instead
+    assert NotebookRevision.objects.get(id=draft["id"]).content == "second draft"
+
+
+def test_buffered_draft_flushed_by_cleanup(write_behind, test_notebook, save_revision):
+    draft = save_revision(0, "first draft")
+    save_revision(20, "second draft")
+
+    execute_notebook_revisions_cleanup(test_notebook.id, START + datetime.timedelta(minutes=5))
+
+    revision = NotebookRevision.objects.get(id=draft["id"])
+    assert (revision.content, revision.is_draft) == ("second draft", False)
+    assert get_buffered_drafts([test_notebook.id]) == {}
+
+
+def test_buffered_draft_after_write_behind_disabled(
+    settings, write_behind, test_notebook, save_revision, client
+):
+    draft = save_revision(0, "first draft")
+    save_revision(20, "second draft")
+    settings.NOTEBOOK_REVISION_WRITE_BEHIND = False
+
+    # the buffer is no longer looked up, not even by the periodic flush...
+    with patch("server.notebooks.draft_buffer._get_cache") as mock_get_cache:
+        resp = client.get(
+            reverse(
+                "notebook-revisions-detail",
+                kwargs={"notebook_id": test_notebook.id, "pk": draft["id"]},
+            )
+        )
+        flush_buffered_drafts(START + datetime.timedelta(seconds=30))
+    assert resp.json()["content"] == "first draft"
+    assert not mock_get_cache.called
+
+    # ...but leftover drafts are still written before a cleanup
+    execute_notebook_revisions_cleanup(test_notebook.id, START + datetime.timedelta(minutes=5))
+    assert NotebookRevision.objects.get(id=draft["id"]).content == "second draft"
+
+
+def test_buffered_draft_of_deleted_revision(write_behind, test_notebook, save_revision):
+    draft = save_revision(0, "first draft")
+    save_revision(20, "second draft")
+    NotebookRevision.objects.filter(id=draft["id"]).delete()
+
+    assert not flush_buffered_draft(test_notebook.id)
+    assert get_buffered_drafts([test_notebook.id]) == {}
+    assert not NotebookRevision.objects.filter(content="second draft").exists()
@@ -0,0 +1,52 @@
+import pytest
+
+from server.notebooks.patches import PatchError, apply_patch
+
+
+@pytest.mark.parametrize(
+    "content,patch,expected",
+    [
+        # a line changed, with a header
+        (
+            "a\nb\nc\n",
+            "--- a\n+++ b\n@@ -1,3 +1,3 @@\n a\n-b\n+B\n c\n",
+            "a\nB\nc\n",
+        ),
+        # lines added at the start and the end, without context
+        ("a\nb\n", "@@ -0,0 +1 @@\n+start\n@@ -2,0 +4 @@\n+end\n", "start\na\nb\nend\n"),
+        # a line removed, only the first and last lines are kept as is
+        ("a\nb\nc\n", "@@ -2 +1,0 @@\n-b\n", "a\nc\n"),
+        # no newline at the end, before and after
+        ("a\nb", "@@ -2 +2 @@\n-b\n\\ No newline at end of file\n+c\n", "a\nc\n"),
+        ("a\nb\n", "@@ -2 +2 @@\n-b\n+c\n\\ No newline at end of file\n", "a\nc"),
+        # line separators other than line feeds are kept in their line
+        ("a b\nc\r\n", "@@ -2 +2 @@\n-c\r\n+d\r\n", "a b\nd\r\n"),
+        # an empty patch
+        ("a\n", "", "a\n"),
+    ],
+)
+def test_apply_patch(content, patch, expected):
+    assert apply_patch(content, patch) == expected
+
+
+@pytest.mark.parametrize(
+    "patch",
+    [
+        # context which doesn't match
+        "@@ -1,2 +1,2 @@\n a\n-c\n+d\n",
+        # beyond the end
+        "@@ -5 +5 @@\n-e\n+f\n",
+        # a partial last line
+        "@@ -2 +2 @@\n-b\n\\ No newline at end of file\n+c\n",
+        # wrong line counts
+        "@@ -1,3 +1,3 @@\n a\n-b\n+c\n",
+        # hunks out of order
+        "@@ -2 +2 @@\n-b\n+c\n@@ -1 +1 @@\n-a\n+d\n",
+        # garbage
+        "@@ -1 +1 @@\n-a\n*b\n",
+        "@@ nope @@\n",
+    ],
+)
+def test_apply_patch_error(patch):
+    with pytest.raises(PatchError):
+        apply_patch("a\nb\n", patch)
@@ -1,4 +1,9 @@
+import datetime
+import hashlib
+from unittest.mock import patch
+
 import pytest
+import pytz
 from django.urls import reverse
 
 from server.notebooks.models import NotebookRevision
@@ -186,6 +191,125 @@ def test_create_notebook_revision(fake_user, test_notebook, client):
     }
 
 
+def test_create_notebook_revision_coalesces_drafts(settings, fake_user, test_notebook, client):
+    settings.NOTEBOOK_REVISION_COALESCE_DRAFTS = True
+    start = datetime.datetime(2020, 1, 1, 10, 0, 10, tzinfo=pytz.utc)
+    NotebookRevision.objects.update(created=start - datetime.timedelta(days=1))
+    url = reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id})
+    client.force_login(user=fake_user)
+
+    def post(seconds, content):
+        last_revision = NotebookRevision.objects.filter(notebook_id=test_notebook.id).first()
+        post_blob = {"parent_revision_id": last_revision.id, "title": "Draft", "content": content}
+        with patch(
+            "django.utils.timezone.now", return_value=start + datetime.timedelta(seconds=seconds)
+        ), patch("server.notebooks.api_views.tasks.schedule") as mock_schedule:
+            resp = client.post(url, post_blob)
+        assert resp.status_code == 201
+        return resp.json(), mock_schedule.called
+
+    # the first save of a window adds a draft, which the following saves in
+    # the same window overwrite
+    first, scheduled = post(0, "first draft")
+    assert scheduled
+    second, scheduled = post(30, "second draft")
+    assert not scheduled
+    assert second == {**first, "content": "second draft"}
+    assert NotebookRevision.objects.filter(notebook=test_notebook).count() == 2
+
+    # but not once the window is over
+    third, scheduled = post(settings.NOTEBOOK_REVISION_SAVE_INTERVAL_SECS, "third draft")
+    assert scheduled
+    assert third["id"] != first["id"]
+    assert list(
+        NotebookRevision.objects.filter(notebook=test_notebook).values_list("content", flat=True)
+    ) == ["third draft", "second draft", "*fake notebook content*"]
+
+    # non-draft revisions are never overwritten
+    NotebookRevision.objects.update(is_draft=False)
+    fourth, scheduled = post(settings.NOTEBOOK_REVISION_SAVE_INTERVAL_SECS + 1, "fourth draft")
+    assert fourth["id"] != third["id"]
+    test_notebook.refresh_from_db()
+    assert test_notebook.title == "Draft"
+    assert test_notebook.storage_bytes == sum(
+        revision.content_size for revision in NotebookRevision.objects.all()
+    )
+
+
+def test_create_notebook_revision_from_patch(fake_user, test_notebook, client):
+    last_revision = NotebookRevision.objects.filter(notebook_id=test_notebook.id).first()
+    content = "*fake notebook content*\nmore content\n"
+    post_blob = {
+        "parent_revision_id": last_revision.id,
+        "title": "My cool notebook",
+        "patch": (
+            "@@ -1 +1,2 @@\n-*fake notebook content*\n\\ No newline at end of file\n"
+            "+*fake notebook content*\n+more content\n"
+        ),
+        "content_hash": hashlib.md5(content.encode()).hexdigest(),
+    }
+    client.force_login(user=fake_user)
+    resp = client.post(
+        reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id}), post_blob
+    )
+    assert resp.status_code == 201
+    new_notebook_revision = NotebookRevision.objects.first()
+    assert new_notebook_revision.content == content
+    assert resp.json()["content"] == content
+    test_notebook.refresh_from_db()
+    assert test_notebook.storage_bytes == sum(
+        revision.content_size for revision in NotebookRevision.objects.all()
+    )
+
+
+@pytest.mark.parametrize(
+    "post_blob,error",
+    [
+        (
+            {"patch": "@@ -1 +1 @@\n-nope\n+new\n", "content_hash": "x"},
+            "Patch does not apply to revision {id}: Hunk at line 1 doesn't apply",
+        ),
+        (
+            {
+                "patch": "@@ -1 +1 @@\n-*fake notebook content*\n\\ No newline at end of file\n"
+                "+new\n",
+                "content_hash": "x",
+            },
+            "Patched content does not match content_hash",
+        ),
+        (
+            {"patch": "", "content_hash": hashlib.md5(b"*fake notebook content*").hexdigest()},
+            "Revision unchanged from previous",
+        ),
+        ({"patch": ""}, "A patch needs the content_hash of its result"),
+        (
+            {"patch": "", "content_hash": "x", "content": "x"},
+            "Either content or a patch can be given",
+        ),
+        (
+            {"patch": "", "content_hash": "x", "parent_revision_id": ""},
+            "A patch needs a parent_revision_id",
+        ),
+    ],
+)
+def test_create_notebook_revision_from_bad_patch(
+    fake_user, test_notebook, client, post_blob, error
+):
+    last_revision = NotebookRevision.objects.filter(notebook_id=test_notebook.id).first()
+    client.force_login(user=fake_user)
+    resp = client.post(
+        reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id}),
+        {"parent_revision_id": last_revision.id, "title": last_revision.title, **post_blob},
+    )
+    assert resp.status_code == 400
+    assert NotebookRevision.objects.count() == 1
+    if error:
+        errors = resp.json()
+        if isinstance(errors, dict):
+            errors = errors["non_field_errors"]
+        assert errors == [error.format(id=last_revision.id)]
+
+
 @pytest.mark.parametrize("bad_revision_id", [10, "abc"])
 def test_create_notebook_revision_incorrect_parent_id(
     fake_user, test_notebook, client, bad_revision_id
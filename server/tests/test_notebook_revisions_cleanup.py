@@ -1,12 +1,20 @@
-from datetime import datetime
+import threading
+from datetime import datetime, timedelta
 from unittest.mock import call, patch
 
 import pytest
 import pytz
+from django.db import connection, transaction
 from django.urls import reverse
 
+from server.notebooks.locks import lock_notebook_revisions
 from server.notebooks.models import Notebook, NotebookRevision
-from server.notebooks.tasks import execute_notebook_revisions_cleanup
+from server.notebooks.tasks import (
+    execute_notebook_revisions_cleanup,
+    execute_notebook_revisions_cleanups,
+    sweep_notebook_revisions_cleanups,
+)
+from server.task_queues import deferred_jobs
 
 NOW_UTC = datetime(2019, 11, 20, 10, 15, 50, tzinfo=pytz.utc)
 # sorted by time asc
@@ -121,3 +129,107 @@ def test_execute_notebook_revisions_cleanup_is_scheduled(fake_user, test_noteboo
 
         # also make sure we queued the relevant async tasks
         mock_schedule.assert_has_calls([call(execute_notebook_revisions_cleanup, test_notebook.id)])
+
+
+def test_execute_notebook_revisions_cleanup_is_deferred(settings, fake_user, test_notebook, client):
+    # when the queue is full, the cleanup is left to the periodic sweep
+    settings.TASK_QUEUE_MAX_DEPTH = {settings.NOTEBOOKS_TASK_QUEUE: 10}
+    deferred_jobs.clear()
+    with patch("server.task_queues.get_queue_depth", return_value=10), patch(
+        "server.notebooks.tasks.tasks.schedule"
+    ) as mock_schedule:
+        client.force_login(user=fake_user)
+        resp = client.post(
+            reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id}),
+            {"title": "My cool notebook", "content": "*modified test content"},
+        )
+        assert resp.status_code == 201
+        assert not mock_schedule.called
+    assert deferred_jobs.get(task=execute_notebook_revisions_cleanup.task_name) == 1
+
+
+def test_sweep_notebook_revisions_cleanups(settings, notebook_with_draft_revisions, test_notebook):
+    recent_revision = NotebookRevision.objects.create(
+        notebook=test_notebook, title="Recent", content="recent content", is_draft=True
+    )
+    recent_revision.created = NOW_UTC
+    recent_revision.save()
+    stale_notebooks = [notebook_with_draft_revisions]
+    for i in range(2):
+        notebook = Notebook.objects.create(owner=test_notebook.owner, title=f"Stale {i}")
+        NotebookRevision.objects.create(
+            notebook=notebook, title=f"Stale {i}", content="", is_draft=True
+        )
+        stale_notebooks.append(notebook)
+    NotebookRevision.objects.filter(title__startswith="Stale").update(created=CREATED_DATETIMES[0])
+
+    with patch("server.notebooks.tasks.NOTEBOOK_REVISIONS_SWEEP_BATCH_SIZE", 2), patch(
+        "server.notebooks.tasks.tasks.schedule_at"
+    ) as mock_schedule_at:
+        sweep_notebook_revisions_cleanups(NOW_UTC)
+
+    # the notebook with only recent drafts has nothing to clean up yet, and
+    # the others are spread over batches
+    assert mock_schedule_at.call_args_list == [
+        call(
+            execute_notebook_revisions_cleanups,
+            NOW_UTC,
+            [stale_notebooks[0].id, stale_notebooks[1].id],
+        ),
+        call(
+            execute_notebook_revisions_cleanups,
+            NOW_UTC + timedelta(seconds=settings.NOTEBOOK_REVISIONS_SWEEP_BATCH_DELAY),
+            [stale_notebooks[2].id],
+        ),
+    ]
+
+
+def test_sweep_notebook_revisions_cleanups_queue_full(settings, notebook_with_draft_revisions):
+    settings.TASK_QUEUE_MAX_DEPTH = {settings.NOTEBOOKS_TASK_QUEUE: 10}
+    with patch("server.task_queues.get_queue_depth", return_value=10), patch(
+        "server.notebooks.tasks.tasks.schedule_at"
+    ) as mock_schedule_at:
+        sweep_notebook_revisions_cleanups(NOW_UTC)
+    assert not mock_schedule_at.called
+
+
+def test_execute_notebook_revisions_cleanups(notebook_with_draft_revisions):
+    execute_notebook_revisions_cleanups([notebook_with_draft_revisions.id], NOW_UTC)
+
+    # same as if the cleanup had been run for the notebook alone
+    updated_revisions = NotebookRevision.objects.filter(notebook=notebook_with_draft_revisions)
+    assert [revision.is_draft for revision in updated_revisions] == [True, True, False, False]
+
+
+def test_execute_notebook_revisions_cleanup_is_skipped_while_locked(
+    notebook_with_draft_revisions,
+):
+    locked = threading.Event()
+    release = threading.Event()
+
+    def hold_lock():
+        # from another database connection, as locks are reentrant
+        try:
+            with transaction.atomic():
+                lock_notebook_revisions(notebook_with_draft_revisions.id)
+                locked.set()
+                release.wait(10)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    try:
+        assert locked.wait(10)
+        assert not lock_notebook_revisions(notebook_with_draft_revisions.id, wait=False)
+        execute_notebook_revisions_cleanup(notebook_with_draft_revisions.id, NOW_UTC)
+    finally:
+        release.set()
+        thread.join()
+
+    # nothing was cleaned up
+    assert NotebookRevision.objects.filter(
+        notebook=notebook_with_draft_revisions, is_draft=True
+    ).count() == len(CREATED_DATETIMES)
+    with transaction.atomic():
+        assert lock_notebook_revisions(notebook_with_draft_revisions.id, wait=False)
@@ -0,0 +1,101 @@
+import gzip
+import json
+import zlib
+
+import pytest
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.urls import reverse
+
+from server.base.middleware import RequestDecompressionMiddleware
+from server.notebooks.models import NotebookRevision
+
+CONTENT = "a large notebook\n" * 100000
+
+
+@pytest.fixture
+def revision_body(test_notebook):
+    last_revision = NotebookRevision.objects.filter(notebook_id=test_notebook.id).first()
+    return json.dumps(
+        {"parent_revision_id": last_revision.id, "title": "Compressed", "content": CONTENT}
+    ).encode("utf-8")
+
+
+@pytest.fixture
+def post_revision(fake_user, test_notebook, client):
+    client.force_login(user=fake_user)
+
+    def post_revision(body, encoding):
+        return client.post(
+            reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id}),
+            body,
+            content_type="application/json",
+            HTTP_CONTENT_ENCODING=encoding,
+        )
+
+    return post_revision
+
+
+@pytest.mark.parametrize(
+    "encoding,compress",
+    [("gzip", gzip.compress), ("GZip", gzip.compress), ("deflate", zlib.compress)],
+)
+def test_compressed_request_body(revision_body, post_revision, encoding, compress):
+    resp = post_revision(compress(revision_body), encoding)
+    assert resp.status_code == 201
+    assert NotebookRevision.objects.get(id=resp.json()["id"]).content == CONTENT.strip()
+
+
+@pytest.mark.parametrize("encoding", ["", "identity"])
+def test_uncompressed_request_body(revision_body, post_revision, encoding):
+    resp = post_revision(revision_body, encoding)
+    assert resp.status_code == 201
+
+
+def test_unsupported_request_body_encoding(revision_body, post_revision):
+    resp = post_revision(revision_body, "br")
+    assert resp.status_code == 415
+    assert "gzip" in resp["Accept-Encoding"].split(", ")
+
+
+@pytest.mark.parametrize(
+    "body", [b"not gzip at all", gzip.compress(b'{"title": "truncated"}')[:-10]]
+)
+def test_invalid_compressed_request_body(post_revision, body):
+    resp = post_revision(body, "gzip")
+    assert resp.status_code == 400
+    assert not NotebookRevision.objects.filter(title="truncated").exists()
+
+
+def test_request_body_decompression_limit(settings, revision_body, post_revision):
+    settings.REQUEST_BODY_MAX_DECOMPRESSED_SIZE = len(revision_body) - 1
+    # a body which compresses very well must not expand past the limit
+    compressed = gzip.compress(revision_body)
+    assert len(compressed) < len(revision_body) / 100
+    resp = post_revision(compressed, "gzip")
+    assert resp.status_code == 413
+
+    settings.REQUEST_BODY_MAX_DECOMPRESSED_SIZE = len(revision_body)
+    resp = post_revision(compressed, "gzip")
+    assert resp.status_code == 201
+
+
+def test_request_body_decompression_only_for_api():
+    bodies = []
+
+    def get_response(request):
+        bodies.append(request.body)
+        return HttpResponse()
+
+    middleware = RequestDecompressionMiddleware(get_response)
+    compressed = gzip.compress(b"some data")
+    for path in ("/api/v1/files/", "/notebooks/1/"):
+        middleware(
+            RequestFactory().post(
+                path,
+                compressed,
+                content_type="application/octet-stream",
+                HTTP_CONTENT_ENCODING="gzip",
+            )
+        )
+    assert bodies == [b"some data", compressed]
@@ -1,5 +1,21 @@
+import pytest
 from django.urls import reverse
 
+from server.files.content_cache import (
+    FileContentCache,
+    cache_hits,
+    cache_served_bytes,
+    file_content_cache,
+)
+from server.files.models import File
+
+CSV_CONTENT = b"a,b\n12,34\n56,78"
+
+
+@pytest.fixture(autouse=True)
+def clear_file_content_cache():
+    file_content_cache.clear()
+
 
 def test_read_server_file(client, test_file):
     resp = client.get(
@@ -10,3 +26,115 @@ def test_read_server_file(client, test_file):
     )
     assert resp.status_code == 200
     assert [k for k in resp.streaming_content][0] == test_file.content
+
+
+def read_server_file(client, file):
+    resp = client.get(
+        reverse("file-view", kwargs={"notebook_pk": file.notebook.id, "filename": file.filename})
+    )
+    return b"".join(resp.streaming_content)
+
+
+def test_read_server_file_cached(client, settings, test_file, django_assert_num_queries):
+    settings.FILE_CONTENT_CACHE_MAX_BYTES = 1024
+    hits = cache_hits.get()
+    served_bytes = cache_served_bytes.get()
+
+    # first read populates the cache, second is served from it (only
+    # checking the content hash)
+    assert read_server_file(client, test_file) == CSV_CONTENT
+    with django_assert_num_queries(1):
+        assert read_server_file(client, test_file) == CSV_CONTENT
+    assert file_content_cache.size == len(CSV_CONTENT)
+    assert cache_hits.get() == hits + 1
+    assert cache_served_bytes.get() == served_bytes + len(CSV_CONTENT)
+
+    # saving the file invalidates its entry
+    test_file.content = b"c,d"
+    test_file.save()
+    assert file_content_cache.size == 0
+    assert read_server_file(client, test_file) == b"c,d"
+
+
+def test_read_server_file_cache_skips_stale_entries(client, settings, test_file):
+    settings.FILE_CONTENT_CACHE_MAX_BYTES = 1024
+    assert read_server_file(client, test_file) == CSV_CONTENT
+
+    # an update made elsewhere (without signals) is still picked up
+    File.objects.filter(id=test_file.id).update(content=b"c,d", content_hash="new")
+    assert read_server_file(client, test_file) == b"c,d"
+
+
+def test_file_content_cache_eviction(settings):
+    settings.FILE_CONTENT_CACHE_MAX_BYTES = 10
+    content_cache = FileContentCache()
+    content_cache.set(1, "a", "hash-a", b"aaaa")
+    content_cache.set(1, "b", "hash-b", b"bbbb")
+    assert content_cache.get(1, "a", "hash-a") == b"aaaa"
+
+    # adding a third entry evicts the least recently used one ("b")
+    content_cache.set(1, "c", "hash-c", b"cccc")
+    assert content_cache.size == 8
+    assert content_cache.get(1, "b", "hash-b") is None
+    assert content_cache.get(1, "a", "hash-a") == b"aaaa"
+    assert content_cache.get(1, "a", "other-hash") is None
+
+    # entries larger than the budget are never cached
+    content_cache.set(1, "d", "hash-d", b"d" * 11)
+    assert content_cache.get(1, "d", "hash-d") is None
+
+
+def get_preview(client, file, **params):
+    return client.get(
+        reverse(
+            "file-preview", kwargs={"notebook_pk": file.notebook.id, "filename": file.filename}
+        ),
+        params,
+    )
+
+
+@pytest.mark.parametrize("rows,expected", [(1, b"a,b\n"), (2, b"a,b\n12,34\n"), (10, CSV_CONTENT)])
+def test_preview_server_file(client, test_file, rows, expected):
+    resp = get_preview(client, test_file, rows=rows)
+    assert resp.status_code == 200
+    assert resp["Content-Type"] == "text/csv"
+    assert b"".join(resp.streaming_content) == expected
+
+
+def test_preview_server_file_is_read_in_chunks(client, settings, test_file):
+    settings.FILE_PREVIEW_CHUNK_SIZE = 4
+    resp = get_preview(client, test_file, rows=2)
+    assert b"".join(resp.streaming_content) == b"a,b\n12,34\n"
+
+
+def test_preview_binary_server_file(client, settings, test_notebook):
+    settings.FILE_PREVIEW_MAX_BYTES = 8
+    binary_file = File.objects.create(
+        notebook=test_notebook, filename="test.bin", content=b"\0\n\1\n\2\n\3\n\4\n\5\n"
+    )
+    resp = get_preview(client, binary_file, rows=1)
+    assert resp.status_code == 200
+    assert resp["Content-Type"] == "application/octet-stream"
+    assert b"".join(resp.streaming_content) == b"\0\n\1\n\2\n\3\n"
+
+
+def test_preview_server_file_is_cached_by_content(client, test_file, django_assert_num_queries):
+    resp = get_preview(client, test_file, rows=1)
+    assert b"".join(resp.streaming_content) == b"a,b\n"
+
+    # a second request is served from the cache without reading the content
+    with django_assert_num_queries(1):
+        resp = get_preview(client, test_file, rows=1)
+    assert resp.content == b"a,b\n"
+
+    # ... but a change of content is not
+    test_file.content = b"c,d\n"
+    test_file.save()
+    resp = get_preview(client, test_file, rows=1)
+    assert b"".join(resp.streaming_content) == b"c,d\n"
+
+
+@pytest.mark.parametrize("rows", ["foo", "0", "100000"])
+def test_preview_server_file_invalid_rows(client, test_file, rows):
+    resp = get_preview(client, test_file, rows=rows)
+    assert resp.status_code == 400
@@ -0,0 +1,112 @@
+import json
+import tempfile
+
+from django.core.management import call_command
+from django.urls import reverse
+
+from server.base.models import User
+from server.files.models import File
+from server.notebooks.models import Notebook, NotebookRevision
+
+# size of the content of the revision created by the `test_notebook` fixture
+INITIAL_REVISION_SIZE = len("*fake notebook content*")
+
+
+def get_storage_bytes(notebook):
+    notebook.refresh_from_db()
+    notebook.owner.refresh_from_db()
+    return (notebook.storage_bytes, notebook.owner.storage_bytes)
+
+
+def test_storage_usage_tracks_revisions_and_files(fake_user, test_notebook):
+    assert get_storage_bytes(test_notebook) == (INITIAL_REVISION_SIZE,) * 2
+
+    revision = NotebookRevision.objects.create(
+        notebook=test_notebook, title="Revision 2", content="été", is_draft=True
+    )
+    # sizes are counted in bytes, not characters
+    assert get_storage_bytes(test_notebook) == (INITIAL_REVISION_SIZE + 5,) * 2
+
+    file = File.objects.create(notebook=test_notebook, filename="test.csv", content=b"1234")
+    assert get_storage_bytes(test_notebook) == (INITIAL_REVISION_SIZE + 9,) * 2
+
+    file.content = b"12"
+    file.save()
+    assert get_storage_bytes(test_notebook) == (INITIAL_REVISION_SIZE + 7,) * 2
+
+    # bulk deletes are counted too
+    NotebookRevision.objects.filter(id=revision.id).delete()
+    file.delete()
+    assert get_storage_bytes(test_notebook) == (INITIAL_REVISION_SIZE,) * 2
+
+
+def test_storage_usage_on_notebook_deletion(fake_user, two_test_notebooks):
+    deleted_notebook, remaining_notebook = two_test_notebooks
+    File.objects.create(notebook=deleted_notebook, filename="test.csv", content=b"1234")
+
+    deleted_notebook.delete()
+    fake_user.refresh_from_db()
+    assert fake_user.storage_bytes == remaining_notebook.revisions.get().content_size
+
+
+def test_storage_usage_bulk_deletes(fake_user, test_notebook, django_assert_max_num_queries):
+    NotebookRevision.objects.bulk_create(
+        NotebookRevision(notebook=test_notebook, title="Draft", content="x" * 10, is_draft=True)
+        for _ in range(50)
+    )
+    Notebook.update_storage_bytes(test_notebook.id, 500)
+
+    # the counters are adjusted once, however many revisions are deleted
+    with django_assert_max_num_queries(8):
+        NotebookRevision.objects.filter(notebook=test_notebook, is_draft=True).delete()
+    assert get_storage_bytes(test_notebook) == (INITIAL_REVISION_SIZE,) * 2
+
+
+def test_create_file_over_quota(fake_user, client, settings, test_notebook):
+    settings.NOTEBOOK_STORAGE_QUOTA_BYTES = INITIAL_REVISION_SIZE + 4
+    client.force_login(user=fake_user)
+    for content, expected_status in [("hello", 403), ("hell", 201)]:
+        with tempfile.NamedTemporaryFile(mode="w+") as f:
+            f.write(content)
+            f.seek(0)
+            resp = client.post(
+                reverse("files-list"),
+                {
+                    "metadata": json.dumps(
+                        {"filename": "test.txt", "notebook_id": test_notebook.id}
+                    ),
+                    "file": open(f.name),
+                },
+            )
+        assert resp.status_code == expected_status
+    assert get_storage_bytes(test_notebook) == (INITIAL_REVISION_SIZE + 4,) * 2
+
+
+def test_create_revision_over_quota(fake_user, client, settings, test_notebook):
+    settings.USER_STORAGE_QUOTA_BYTES = INITIAL_REVISION_SIZE + 10
+    client.force_login(user=fake_user)
+    resp = client.post(
+        reverse("notebook-revisions-list", kwargs={"notebook_id": test_notebook.id}),
+        {"title": "My cool notebook", "content": "x" * 11},
+    )
+    assert resp.status_code == 403
+    assert NotebookRevision.objects.count() == 1
+
+
+def test_reconcile_storage_usage(fake_user, fake_user2, two_test_notebooks):
+    File.objects.create(notebook=two_test_notebooks[0], filename="test.csv", content=b"1234")
+    expected = {
+        notebook.id: sum(r.content_size for r in notebook.revisions.all())
+        + sum(f.content_size for f in File.objects.filter(notebook=notebook))
+        for notebook in two_test_notebooks
+    }
+    Notebook.objects.update(storage_bytes=12345)
+    User.objects.update(storage_bytes=12345)
+
+    call_command("reconcile_storage_usage", batch_size=1)
+
+    assert dict(Notebook.objects.values_list("id", "storage_bytes")) == expected
+    assert dict(User.objects.values_list("id", "storage_bytes")) == {
+        fake_user.id: sum(expected.values()),
+        fake_user2.id: 0,
+    }
@@ -0,0 +1,48 @@
+from unittest.mock import call, patch
+
+import pytest
+from django.core.management import call_command
+from spinach.contrib.spinachd.tasks import tasks as spinachd_tasks
+
+from server.files.tasks import tasks as file_tasks
+from server.notebooks.tasks import tasks as notebook_tasks
+from server.task_queues import get_queue_depth, is_queue_full, queue_depth
+
+
+def test_tasks_are_routed_to_their_queue(settings):
+    assert {task.queue for task in notebook_tasks.tasks.values()} == {settings.NOTEBOOKS_TASK_QUEUE}
+    assert {task.queue for task in file_tasks.tasks.values()} == {settings.FILES_TASK_QUEUE}
+    # spinach's own tasks aren't left in a queue no worker consumes
+    assert {task.queue for task in spinachd_tasks.tasks.values()} == {
+        settings.NOTEBOOKS_TASK_QUEUE
+    }
+
+
+@pytest.mark.parametrize("threads", [None, 2])
+@pytest.mark.parametrize("metrics_enabled", [True, False])
+def test_run_worker(settings, threads, metrics_enabled):
+    settings.TASK_QUEUE_WORKER_THREADS = {"notebooks": 3, "files": 5}
+    settings.METRICS_ENABLED = metrics_enabled
+    command = "server.base.management.commands.run_worker"
+    with patch(f"{command}.call_command") as mock_call_command, patch(
+        f"{command}.start_metrics_server"
+    ) as mock_start_metrics_server:
+        call_command("run_worker", "files", threads=threads, metrics_port=9100)
+    mock_call_command.assert_called_once_with("spinach", queue="files", threads=threads or 5)
+    assert mock_start_metrics_server.call_args_list == ([call(9100)] if metrics_enabled else [])
+
+
+def test_get_queue_depth(settings):
+    queue = settings.SPINACH_BROKER._get_queue("test-queue")
+    for i in range(3):
+        queue.put(i)
+    assert get_queue_depth("test-queue") == 3
+    assert queue_depth.get(queue="test-queue") == 3
+
+    settings.TASK_QUEUE_MAX_DEPTH = {"test-queue": 3}
+    assert is_queue_full("test-queue")
+    queue.get()
+    assert not is_queue_full("test-queue")
+    settings.TASK_QUEUE_MAX_DEPTH = {"test-queue": 0}
+    queue.put(3)
+    assert not is_queue_full("test-queue")
@@ -8,6 +8,7 @@ from rest_framework_simplejwt.views import TokenRefreshView
 
 import server.views
 from server.jwt.api_views import TokenObtainPairView
+from server.metrics import metrics_view
 
 if admin.site.is_registered(Group):
     admin.site.unregister(Group)  # Hide the group, not used right now
@@ -52,6 +53,7 @@ urlpatterns = [
     url(r"^token/$", TokenObtainPairView.as_view(), name="token_obtain_pair"),
     # admin stuff
     path("admin/", admin.site.urls),
+    url(r"^__metrics__/?$", metrics_view, name="metrics"),
     url(r"^$", server.views.index, name="index"),
 ]
 
@@ -0,0 +1 @@
+/root/.pyenv/versions/3.11.7/lib/python3.11/site-packages/django/contrib/admin/static/admin/js/actions.js
\ No newline at end of file
@@ -0,0 +1 @@
+/root/.pyenv/versions/3.11.7/lib/python3.11/site-packages/rest_framework/static/rest_framework/docs/js/api.js
\ No newline at end of file